@@ -0,0 +1,50 @@
+from typing import Iterator, Tuple, Iterable
+import numpy as np
+
+class AskBids:
+    '''
+    某个交易对按时间排列的卖一价和买一价, 以列的形式存储
+    '''
+    def __init__(self, timestamps: np.ndarray, asks: np.ndarray, bids: np.ndarray) -> None:
+        assert len(timestamps) == len(asks) == len(bids)
+        self.timestamps: np.ndarray = timestamps # Unix毫秒级时间戳
+        self.asks: np.ndarray = asks # 卖一价
+        self.bids: np.ndarray = bids # 买一价
+        self.start: int = int(timestamps[0]) if len(timestamps) > 0 else 0
+        self.step: int = int(timestamps[1] - timestamps[0]) if len(timestamps) > 1 else 1 # 时间粒度, 单位为毫秒
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, index: int) -> Tuple[int, Tuple[float, float]]:
+        return (int(self.timestamps[index]), (float(self.asks[index]), float(self.bids[index])))
+
+    def __iter__(self) -> Iterator[Tuple[int, Tuple[float, float]]]:
+        return zip(self.timestamps.tolist(), zip(self.asks.tolist(), self.bids.tolist()))
+
+    def index(self, timestamp: int) -> int:
+        '''
+        由时间戳直接计算其下标, 即 (timestamp - start)/step
+        '''
+        offset, rem = divmod(timestamp - self.start, self.step)
+        if rem != 0 or not 0 <= offset < len(self):
+            raise ValueError(f"Timestamp {timestamp} is out of range")
+        return offset
+
+    def indices(self, timestamps: Iterable[int]) -> np.ndarray:
+        '''
+        index 的批量版本
+        '''
+        if not isinstance(timestamps, np.ndarray):
+            timestamps = np.fromiter(timestamps, dtype=np.int64)
+        offsets, rems = np.divmod(timestamps - self.start, self.step)
+        invalid = (rems != 0) | (offsets < 0) | (offsets >= len(self))
+        if invalid.any():
+            raise ValueError(f"Timestamp {int(timestamps[invalid.argmax()])} is out of range")
+        return offsets
+
+    def at(self, timestamp: int) -> Tuple[float, float]:
+        '''
+        获取 timestamp 时刻的卖一价和买一价
+        '''
+        return self[self.index(timestamp)][1]
@@ -1,52 +1,220 @@
+from bisect import bisect_right
 from copy import deepcopy
-from typing import List, Dict, Tuple
-from utils.helper import validate_currency
+from typing import List, Dict, Tuple, Iterable, Iterator, Union, Optional
+import numpy as np
+from utils.helper import Column, valid_Ccy, locate_timestamp, locate_timestamps, timestamp_window
+from utils.fixedpoint import to_units, from_units, format_units
+
+class CurrencyTable:
+    '''
+    币种符号表
+    币种在第一次登记时检查是否合法并分配一个编号, 之后的访问只需查表, 不再逐字符检查
+    '''
+    def __init__(self, currencies: Iterable[str] = ()) -> None:
+        self.names: List[str] = [] # 编号 -> 币种
+        self._ids: Dict[str, int] = {} # 币种 -> 编号
+        for ccy in currencies:
+            self.intern(ccy)
+
+    def intern(self, ccy: str) -> int:
+        '''
+        获取 ccy 的编号, 第一次出现时检查并登记
+        '''
+        id = self._ids.get(ccy)
+        if id is None:
+            assert valid_Ccy(ccy), f"Invalid currency {ccy}"
+            id = len(self.names)
+            self._ids[ccy] = id
+            self.names.append(ccy)
+        return id
+
+    def id(self, ccy: str) -> int:
+        '''
+        获取已登记的 ccy 的编号, 未登记时抛出 KeyError
+        '''
+        return self._ids[ccy]
+
+    def ids(self, currencies: Iterable[str]) -> np.ndarray:
+        return np.array([self.intern(ccy) for ccy in currencies], dtype=np.int64)
+
+    def __contains__(self, ccy: str) -> bool:
+        return ccy in self._ids
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+DefaultCurrencyTable = CurrencyTable() # Balance 默认使用的符号表
 
 class Balance:
-    def __init__(self) -> None:
-        self._balances: Dict[str, float] = {}
-    
-    
-    @validate_currency
+    '''
+    账户余额
+    以币种编号为下标的定长数组存储, 同时提供 dict 形式的访问; 币种只在 CurrencyTable 中登记时检查一次
+    NOTICE: copy() 返回与原 Balance 共享数组的快照, 任何一方第一次写入时才复制数组(写时复制)
+    NOTICE: 遍历顺序与 dict 一致, 为币种第一次被写入的顺序
+    '''
+    __slots__ = ('table', '_values', '_present', '_order', '_shared')
+
+    def __init__(self, table: Optional[CurrencyTable] = None, dtype = np.float64) -> None:
+        self.table: CurrencyTable = table if table is not None else DefaultCurrencyTable
+        self._values: np.ndarray = np.zeros(len(self.table), dtype=dtype) # 编号 -> 余额
+        self._present: np.ndarray = np.zeros(len(self.table), dtype=bool) # 编号 -> 是否存在
+        self._order: List[int] = [] # 存在的币种的编号, 按写入顺序
+        self._shared: bool = False # 数组是否与其它快照共享
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[str, float]], table: Optional[CurrencyTable] = None, dtype = np.float64) -> 'Balance':
+        balance = cls(table, dtype)
+        for ccy, value in items:
+            balance[ccy] = value
+        return balance
+
+    def _index(self, key: str) -> int:
+        id = self.table._ids.get(key)
+        if id is None or id >= len(self._present) or not self._present[id]:
+            raise KeyError(key)
+        return id
+
+    def _writable(self, size: int) -> None:
+        '''
+        写入前调用: 共享的数组先复制, 并保证数组能容纳 size 个币种
+        '''
+        if self._shared or size > len(self._values):
+            size = max(size, len(self.table))
+            values = np.zeros(size, dtype=self._values.dtype)
+            values[:len(self._values)] = self._values
+            present = np.zeros(size, dtype=bool)
+            present[:len(self._present)] = self._present
+            self._values, self._present, self._order = values, present, list(self._order)
+            self._shared = False
+
     def __getitem__(self, key: str) -> float:
-        return self._balances[key]
-    
-    
-    @validate_currency
+        return self._values[self._index(key)].item()
+
     def __setitem__(self, key: str, value: float) -> None:
         assert value >= 0, "Balance must be not negative"
-        self._balances[key] = value
+        id = self.table.intern(key)
+        self._writable(id + 1)
+        self._values[id] = value
+        if not self._present[id]:
+            self._present[id] = True
+            self._order.append(id)
+
+    def __contains__(self, key: str) -> bool:
+        id = self.table._ids.get(key)
+        return id is not None and id < len(self._present) and bool(self._present[id])
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def keys(self) -> List[str]:
+        return [self.table.names[id] for id in self._order]
+
+    def values(self) -> List[float]:
+        return self._values[self._order].tolist()
+
+    def items(self) -> List[Tuple[str, float]]:
+        return list(zip(self.keys(), self.values()))
+
+    def get(self, key: str, default: Optional[float] = None) -> Optional[float]:
+        return self[key] if key in self else default
+
+    def add(self, currencies: Iterable[str], amounts: Union[np.ndarray, List[float]]) -> None:
+        '''
+        批量增加余额, 同一币种可以出现多次; 结果为负时抛出 AssertionError 且余额不变
+        '''
+        ids = self.table.ids(currencies)
+        if len(ids) == 0:
+            return
+        self._writable(int(ids.max()) + 1)
+        values = self._values.copy()
+        np.add.at(values, ids, amounts)
+        assert (values[ids] >= 0).all(), "Balance must be not negative"
+        self._values = values
+        for id in ids.tolist():
+            if not self._present[id]:
+                self._present[id] = True
+                self._order.append(id)
+
+    def subtract(self, currencies: Iterable[str], amounts: Union[np.ndarray, List[float]]) -> None:
+        '''
+        批量减少余额, 见 add
+        '''
+        self.add(currencies, -np.asarray(amounts))
+
+    def copy(self) -> 'Balance':
+        '''
+        写时复制的快照
+        '''
+        snapshot = Balance.__new__(Balance)
+        snapshot.table = self.table
+        snapshot._values, snapshot._present, snapshot._order = self._values, self._present, self._order
+        snapshot._shared = self._shared = True
+        return snapshot
+
+    def __deepcopy__(self, memo) -> 'Balance':
+        return self.copy()
 
     def in_USD(self) -> float:
         '''TODO: Calculate total USD value of all currencies'''
         return -1.0
-    
+
     def __str__(self) -> str:
-        sorted_balances = sorted(self._balances.items(), key=lambda x: x[0], reverse=False)
+        sorted_balances = sorted(self.items(), key=lambda x: x[0], reverse=False)
         return str(dict(sorted_balances))
 
     def asdict(self):
-        return deepcopy(self._balances)
+        return dict(self.items())
 
 class BalancesHistory:
     def __init__(self) -> None:
         self.slice: List[Tuple[int, Balance]] = []
+        self._timestamps: List[int] = [] # 与 slice 一一对应的升序时间戳索引
 
     def append(self, timestamp: int, balance: Balance) -> None:
-        self.slice.append((timestamp, balance))
-        self.slice.sort(key=lambda x: x[0], reverse=False)
+        if len(self._timestamps) == 0 or timestamp >= self._timestamps[-1]:
+            self._timestamps.append(timestamp)
+            self.slice.append((timestamp, balance))
+        else:
+            index = bisect_right(self._timestamps, timestamp)
+            self._timestamps.insert(index, timestamp)
+            self.slice.insert(index, (timestamp, balance))
     
     
     def at(self, timestamp: int) -> Balance:
-        for i in range(len(self.slice)):
-            if self.slice[i][0] > timestamp:
-                return self.slice[i-1][1]
-        raise ValueError(f"Timestamp {timestamp} is out of range")
+        '''
+        获取 timestamp 时刻的 Balance, 即最后一个不晚于 timestamp 的 Balance
+        '''
+        return self.slice[locate_timestamp(self._timestamps, timestamp)][1]
+    
+    def at_many(self, timestamps: Iterable[int]) -> List[Balance]:
+        '''
+        at 的批量版本
+        '''
+        return [self.slice[i][1] for i in locate_timestamps(self._timestamps, timestamps)]
+    
+    def window(self, t0: int, t1: int) -> Iterator[Tuple[int, Balance]]:
+        '''
+        依次访问时间戳位于 [t0, t1) 的 Balance
+        '''
+        for i in timestamp_window(self._timestamps, t0, t1):
+            yield self.slice[i]
     
     def __str__(self) -> str:
-        self.slice.sort(key=lambda x: x[0], reverse=False)
         return str({x[0]: str(x[1]) for x in self.slice})
 
+    def iterdicts(self) -> Iterator[Tuple[int, Dict[str, float]]]:
+        '''
+        依次访问各个 Balance 的字典形式, 用于流式写出
+        '''
+        for ts, balance in self:
+            yield (ts, balance.asdict())
+
     def asdict(self):
         return {x[0]: x[1].asdict() for x in self.slice}
     
@@ -56,6 +224,235 @@ class BalancesHistory:
     def __len__(self) -> int:
         return len(self.slice)
 
+class BalanceLedger(BalancesHistory):
+    '''
+    以列的形式记录余额变化的 BalancesHistory
+    币种被映射为列号; 每一行记录一次成交后被修改的各列的新余额, 存储在预分配的数组中.
+    每隔 checkpointInterval 行保存一次完整的余额, Balance 在访问时由最近的检查点重放得到.
+    NOTICE: 记录的是修改后的余额而不是差值, 因此重建的 Balance 与逐笔计算的结果完全一致
+    NOTICE: 给定 digits(币种 -> 小数位数)时为定点模式, 余额以 int64 单位存储, value/record 使用整数单位,
+            重建的 Balance 仍然是浮点数, asdict/iterdicts 输出十进制字符串
+    '''
+    def __init__(self, 
+                original: Balance, 
+                timestamp: int = 0, 
+                checkpointInterval: int = 256, 
+                digits: Optional[Dict[str, int]] = None,
+                ) -> None:
+        self._init(checkpointInterval, digits)
+        self.append(timestamp, original)
+
+    def _init(self, checkpointInterval: int, digits: Optional[Dict[str, int]]) -> None:
+        self.checkpointInterval = checkpointInterval
+        self.digits: Optional[Dict[str, int]] = digits
+        self.table = CurrencyTable() # 列号即币种在 table 中的编号
+        self._born: List[int] = [] # 各列首次出现的行号
+        self._current: List[float] = [] # 最新一行的余额
+        self._timestamps: List[int] = []
+        self._offsets = Column(np.int64) # 第 i 行的修改位于 [offsets[i], offsets[i+1])
+        self._offsets.append(0)
+        self._cols = Column(np.int32)
+        self._vals = Column(np.float64 if digits is None else np.int64)
+        self._checkpoints: List[np.ndarray] = []
+
+    @classmethod
+    def from_columns(cls, 
+                    currencies: List[str], 
+                    checkpointInterval: int, 
+                    columns: Dict[str, np.ndarray], 
+                    digits: Optional[Dict[str, int]] = None,
+                    ) -> 'BalanceLedger':
+        '''
+        由 columns() 格式的数组构建 BalanceLedger, 数组不会被复制(可以是只读的内存映射数组)
+        '''
+        ledger = cls.__new__(cls)
+        ledger.checkpointInterval = checkpointInterval
+        ledger.digits = digits
+        ledger.table = CurrencyTable(currencies)
+        ledger._born = columns['born']
+        ledger._timestamps = columns['ts']
+        ledger._offsets = Column.wrap(columns['offsets'])
+        ledger._cols = Column.wrap(columns['cols'])
+        ledger._vals = Column.wrap(columns['vals'])
+        ledger._checkpoints = columns['checkpoints']
+        ledger._current = ledger._values(len(ledger) - 1).tolist() if len(ledger) > 0 else []
+        return ledger
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        '''
+        以列的形式导出全部记录, 检查点被补齐为 (检查点数量, 币种数量) 的二维数组
+        '''
+        checkpoints = np.zeros((len(self._checkpoints), len(self.currencies)), dtype=self._vals.values.dtype)
+        for i, checkpoint in enumerate(self._checkpoints):
+            checkpoints[i, :len(checkpoint)] = checkpoint
+        return {
+            'ts': np.asarray(self._timestamps, dtype=np.int64),
+            'offsets': self._offsets.values,
+            'cols': self._cols.values,
+            'vals': self._vals.values,
+            'checkpoints': checkpoints,
+            'born': np.asarray(self._born, dtype=np.int64),
+        }
+
+    def tail(self) -> 'BalanceLedger':
+        '''
+        只包含最新一行的账本, 之后可以继续 record, 用于流式生成
+        NOTICE: 币种的顺序和定点模式下的整数单位都原样保留, 因此后续各行与在原账本上继续记录的结果相同
+        '''
+        ledger = self.__class__.__new__(self.__class__)
+        ledger._init(self.checkpointInterval, self.digits)
+        ledger.record(int(self._timestamps[-1]), dict(zip(self.currencies, self._current)))
+        return ledger
+
+    @classmethod
+    def from_history(cls, history: BalancesHistory, checkpointInterval: int = 256) -> 'BalanceLedger':
+        '''
+        将普通的 BalancesHistory 转换为 BalanceLedger, 每一行记录完整的余额
+        '''
+        if isinstance(history, BalanceLedger):
+            return history
+        ledger = cls(history[0][1], history[0][0], checkpointInterval)
+        for i in range(1, len(history)):
+            ledger.append(*history[i])
+        return ledger
+
+    @property
+    def currencies(self) -> List[str]:
+        '''
+        列号 -> 币种
+        '''
+        return self.table.names
+
+    def _column(self, ccy: str) -> int:
+        col = self.table._ids.get(ccy)
+        if col is None:
+            assert self.digits is None or ccy in self.digits, f"No digits for currency {ccy}"
+            col = self.table.intern(ccy)
+            self._born.append(len(self._timestamps))
+            self._current.append(0.0 if self.digits is None else 0)
+        return col
+
+    def value(self, ccy: str) -> float:
+        '''
+        获取最新一行中 ccy 的余额, 定点模式下为整数单位
+        '''
+        return self._current[self.table.id(ccy)]
+
+    def record(self, timestamp: int, changes: Dict[str, float]) -> None:
+        '''
+        记录 timestamp 时刻的一次余额变化, changes 为被修改的币种及其新余额
+        '''
+        if len(self._timestamps) > 0 and timestamp < self._timestamps[-1]:
+            raise ValueError(f"Timestamp {timestamp} is earlier than the last record")
+        assert isinstance(self._timestamps, list), "BalanceLedger is read-only"
+        cols = [self._column(ccy) for ccy in changes]
+        for col, value in zip(cols, changes.values()):
+            assert value >= 0, "Balance must be not negative"
+            self._current[col] = value
+        self._cols.extend(cols)
+        self._vals.extend(list(changes.values()))
+        self._offsets.append(len(self._cols))
+        self._timestamps.append(timestamp)
+        if (len(self._timestamps) - 1) % self.checkpointInterval == 0:
+            self._checkpoints.append(np.array(self._current))
+
+    def trade(self, timestamp: int, ccy1: str, value1: float, ccy2: str, value2: float) -> None:
+        '''
+        记录一次成交, 成交后 ccy1 和 ccy2 的余额分别为 value1 和 value2
+        '''
+        self.record(timestamp, {ccy1: value1, ccy2: value2})
+
+    def append(self, timestamp: int, balance: Balance) -> None:
+        if self.digits is None:
+            self.record(timestamp, balance.asdict())
+        else:
+            self.record(timestamp, {ccy: int(to_units(value, self.digits[ccy])) for ccy, value in balance.items()})
+
+    def _float(self, ccy: str, value) -> float:
+        return value if self.digits is None else from_units(value, self.digits[ccy])
+
+    def _values(self, index: int) -> np.ndarray:
+        '''
+        由最近的检查点重放得到第 index 行的各列余额
+        '''
+        checkpoint = index // self.checkpointInterval
+        values = np.zeros(len(self.currencies), dtype=self._vals.values.dtype)
+        values[:len(self._checkpoints[checkpoint])] = self._checkpoints[checkpoint]
+        offsets = self._offsets.values
+        start, end = offsets[checkpoint*self.checkpointInterval + 1], offsets[index + 1]
+        if end > start:
+            # 同一列被多次修改时以最后一次为准
+            cols = self._cols.values[start:end][::-1]
+            vals = self._vals.values[start:end][::-1]
+            cols, first = np.unique(cols, return_index=True)
+            values[cols] = vals[first]
+        return values
+
+    def _balance(self, index: int) -> Balance:
+        '''
+        由最近的检查点重放得到第 index 行的 Balance
+        '''
+        return Balance.from_items((ccy, self._float(ccy, value)) 
+                                  for ccy, value, born in zip(self.currencies, self._values(index).tolist(), self._born) 
+                                  if born <= index)
+
+    @property
+    def slice(self) -> List[Tuple[int, Balance]]:
+        '''
+        NOTICE: 会重建全部的 Balance, 仅用于兼容
+        '''
+        return list(self)
+
+    def at(self, timestamp: int) -> Balance:
+        return self._balance(locate_timestamp(self._timestamps, timestamp))
+
+    def at_many(self, timestamps: Iterable[int]) -> List[Balance]:
+        return [self._balance(i) for i in locate_timestamps(self._timestamps, timestamps)]
+
+    def window(self, t0: int, t1: int) -> Iterator[Tuple[int, Balance]]:
+        for i in timestamp_window(self._timestamps, t0, t1):
+            yield (int(self._timestamps[i]), self._balance(i))
+
+    def __str__(self) -> str:
+        return str({ts: str(balance) for ts, balance in self})
+
+    def iterdicts(self) -> Iterator[Tuple[int, Dict[str, Union[float, str]]]]:
+        if self.digits is None:
+            yield from super().iterdicts()
+            return
+        for ts, values in self._iterrows():
+            yield (ts, {ccy: format_units(value, self.digits[ccy]) for ccy, value in values.items()})
+
+    def asdict(self):
+        return dict(self.iterdicts())
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Tuple[int, Balance], List[Tuple[int, Balance]]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("BalancesHistory index out of range")
+        return (int(self._timestamps[index]), self._balance(index))
+
+    def __len__(self) -> int:
+        return len(self._timestamps)
+
+    def _iterrows(self) -> Iterator[Tuple[int, Dict[str, float]]]:
+        # 顺序访问时逐行重放, 不必每次都从检查点开始
+        offsets = self._offsets.values.tolist()
+        cols = self._cols.values.tolist()
+        vals = self._vals.values.tolist()
+        values: Dict[str, float] = {}
+        for i in range(len(self)):
+            for j in range(offsets[i], offsets[i+1]):
+                values[self.currencies[cols[j]]] = vals[j]
+            yield (int(self._timestamps[i]), {ccy: values[ccy] for ccy in self.currencies if ccy in values})
+
+    def __iter__(self) -> Iterator[Tuple[int, Balance]]:
+        for ts, values in self._iterrows():
+            yield (ts, Balance.from_items((ccy, self._float(ccy, value)) for ccy, value in values.items()))
+
 def test_Balance():
     b = Balance()
     b['BTC'] = 1.0
@@ -67,4 +464,48 @@ def test_Balance():
     
     new_balance['BTC'] = 2.0
     assert new_balance['BTC'] == 2.0
-    assert b['BTC'] == 3.0
\ No newline at end of file
+    assert b['BTC'] == 3.0
+    snapshot = b.copy()
+    b.add(['BTC', 'ETH', 'BTC'], [1.0, 2.0, 0.5])
+    assert b.asdict() == {'BTC': 4.5, 'ETH': 2.0}
+    assert snapshot.asdict() == {'BTC': 3.0}
+    b.subtract(['ETH'], [2.0])
+    assert b['ETH'] == 0.0
+    try:
+        b.subtract(['BTC'], [5.0])
+    except AssertionError:
+        pass
+    assert b['BTC'] == 4.5
+
+def test_BalanceLedger():
+    # 由检查点重放得到的 at(t) 与逐条指令顺序计算的余额一致
+    from benchmark import fixture_factory
+    for fixedPoint in (False, True):
+        tf = fixture_factory(5)
+        tf.fixedPoint = fixedPoint
+        lastPrices = tf.marketData.get_lastPrice('SPOT')
+        pairs = tf.genPairs(3, ['USDT-'], lastPrices)
+        bt_period = tf.genBackTestPeriod(3000)
+        askbids = tf.genAskBidsBatch(pairs, {pair: lastPrices[pair] for pair in pairs}, bt_period)
+        insts = tf.fillInsts(askbids, tf.genInsts(bt_period, pairs), lastPrices)
+        original = tf.genBalance(pairs, lastPrices)
+        ledger = tf.calBalanceHist(insts, original)
+        assert len(ledger) > ledger.checkpointInterval # 跨越多个检查点
+        # 逐条指令继续记录在同一个账本之后, 每条指令后的余额取自最新一行
+        digits = tf.getCcyDigits(set(inst.pair for inst in insts), original) if fixedPoint else None
+        sequential = BalanceLedger(original, 0, digits=digits)
+        expected = [(0, {ccy: sequential._float(ccy, sequential.value(ccy)) for ccy in sequential.currencies})]
+        for inst in insts:
+            sequential = tf.calBalanceHist([inst], original, balanceHist=sequential)
+            expected.append((inst.ts, {ccy: sequential._float(ccy, sequential.value(ccy)) for ccy in sequential.currencies}))
+        assert expected[0][1] == original.asdict()
+        for ts, balance in expected:
+            for t in (ts, ts + 1): # 恰好位于指令时刻, 以及两条指令之间
+                assert ledger.at(t).asdict() == balance, (fixedPoint, t)
+        assert ledger.at(insts[0].ts - 1).asdict() == original.asdict() # 第一条指令之前
+        assert [x.asdict() for x in ledger.at_many([ts for ts, _ in expected])] == [x for _, x in expected]
+        try:
+            ledger.at(-1)
+            assert False, "ValueError expected"
+        except ValueError:
+            pass
@@ -1,7 +1,18 @@
-from copy import deepcopy
-from typing import List, Dict, Tuple
+from bisect import bisect_right
+from copy import copy
+from typing import List, Dict, Tuple, Iterator, Union, Iterable, Optional
+import numpy as np
+from utils.helper import Column, locate_timestamp, locate_timestamps, timestamp_window, \
+                         derive_seed, generate_order_seqs, generate_random_seqs
+from utils.fixedpoint import format_units, from_units, to_units
+
+ASK = 0
+BID = 1
+NOSIDE = -1 # LazyBook 中没有指令档位的时刻
 
 class BookItem:
+    __slots__ = ('price', 'size')
+
     def __init__(self, price: float, size: float) -> None:
         assert price >= 0, "Price must be not negative"
         assert size > 0, "Size must be not negative"
@@ -9,89 +20,707 @@ class BookItem:
         self.size: float = size
 
     def __str__(self) -> str:
-        return f"{self.price}:{self.size}"
+        return format_level(self.price, self.size)
+
+# 单个方向的价格档位, 卖单按价格升序, 买单按价格降序, 价格相同时保持添加顺序
+LevelDtype = np.dtype([('price', np.float64), ('size', np.float64)])
+FixedLevelDtype = np.dtype([('price', np.int64), ('size', np.int64)]) # 定点模式, 见 DeltaBook
+
+def format_level(price: float, size: float) -> str:
+    '''
+    价格档位的字符串形式, 置零的档位 size 输出为 0
+    '''
+    return f"{price}:{size if size != 0 else 0}"
+
+def _to_levels(items: Iterable[Tuple[float, float]]) -> np.ndarray:
+    levels = np.array([(x[0], x[1]) for x in items], dtype=LevelDtype)
+    assert (levels['price'] >= 0).all(), "Price must be not negative"
+    assert (levels['size'] > 0).all(), "Size must be not negative"
+    return levels
+
+def _merge_levels(levels: np.ndarray, items: np.ndarray, side: int) -> np.ndarray:
+    '''
+    将 items 合并到已排序的 levels 中, 结果与逐个追加后稳定排序一致
+    NOTICE: 只对 items 排序, 再由 searchsorted 确定插入位置, levels 不需要重新排序;
+            side='right' 使价格相同时已有的档位在前
+    '''
+    if len(items) == 0:
+        return levels
+    keys = items['price'] if side == ASK else -items['price']
+    if len(items) > 1:
+        order = np.argsort(keys, kind='stable')
+        items, keys = items[order], keys[order]
+    if len(levels) == 0:
+        return items
+    positions = np.searchsorted(levels['price'] if side == ASK else -levels['price'], keys, side='right')
+    return np.insert(levels, positions, items)
 
 class BookSlice:
+    '''
+    订单簿切片, 每个方向的价格档位保存为一个 LevelDtype 结构化数组
+    NOTICE: 档位在构建时即排序; asks/bids 返回 BookItem 的副本, 修改它们不会影响切片
+    '''
+    __slots__ = ('askLevels', 'bidLevels')
+
     def __init__(self, asks: List[Tuple[float, float]], bids: List[Tuple[float, float]]) -> None:
-        self.asks: List[BookItem] = [BookItem(x[0], x[1]) for x in asks]
-        self.bids: List[BookItem] = [BookItem(x[0], x[1]) for x in bids]
-    
-    
+        self.askLevels: np.ndarray = _merge_levels(np.empty(0, dtype=LevelDtype), _to_levels(asks), ASK)
+        self.bidLevels: np.ndarray = _merge_levels(np.empty(0, dtype=LevelDtype), _to_levels(bids), BID)
+
+    @classmethod
+    def from_levels(cls, askLevels: np.ndarray, bidLevels: np.ndarray) -> 'BookSlice':
+        '''
+        由已排序的 LevelDtype 数组构建切片, 数组不会被复制
+        '''
+        book_slice = cls.__new__(cls)
+        book_slice.askLevels = askLevels
+        book_slice.bidLevels = bidLevels
+        return book_slice
+
+    @property
+    def asks(self) -> List[BookItem]:
+        return [_level_item(p, s) for p, s in self.askLevels.tolist()]
+
+    @property
+    def bids(self) -> List[BookItem]:
+        return [_level_item(p, s) for p, s in self.bidLevels.tolist()]
+
     def add_ask(self, price: float, size: float) -> None:
-        self.asks.append(BookItem(price, size))
-        self.asks.sort(key=lambda x: x.price, reverse=False)
-    
+        self.add_many_asks([(price, size)])
+
     def add_many_asks(self, asks: List[Tuple[float, float]]) -> None:
-        for ask in asks:
-            self.add_ask(ask[0], ask[1])
-    
-    
+        self.askLevels = _merge_levels(self.askLevels, _to_levels(asks), ASK)
+
     def add_bid(self, price: float, size: float) -> None:
-        self.bids.append(BookItem(price, size))
-        self.bids.sort(key=lambda x: x.price, reverse=True)
-    
-    
+        self.add_many_bids([(price, size)])
+
     def add_many_bids(self, bids: List[Tuple[float, float]]) -> None:
-        for bid in bids:
-            self.add_bid(bid[0], bid[1])
-    
+        self.bidLevels = _merge_levels(self.bidLevels, _to_levels(bids), BID)
+
     def remove_zero_size(self) -> None:
-        self.asks = [x for x in self.asks if x.size > 0]
-        self.bids = [x for x in self.bids if x.size > 0]
-    
-    
+        self.askLevels = self.askLevels[self.askLevels['size'] > 0]
+        self.bidLevels = self.bidLevels[self.bidLevels['size'] > 0]
+
     def set_zero(self) -> None:
-        for item in self.asks:
-            item.size = 0
-        for item in self.bids:
-            item.size = 0
+        # 先复制, 数组可能与其它切片共享
+        self.askLevels = self.askLevels.copy()
+        self.askLevels['size'] = 0
+        self.bidLevels = self.bidLevels.copy()
+        self.bidLevels['size'] = 0
+
+    def __deepcopy__(self, memo) -> 'BookSlice':
+        return BookSlice.from_levels(self.askLevels.copy(), self.bidLevels.copy())
 
     def asdict(self):
         return {
-            "asks": [str(x) for x in self.asks],
-            "bids": [str(x) for x in self.bids]
+            "asks": [format_level(p, s) for p, s in self.askLevels.tolist()],
+            "bids": [format_level(p, s) for p, s in self.bidLevels.tolist()]
         }
 
+def _level_item(price: float, size: float) -> BookItem:
+    # 置零的档位 size 为 0, 不经过 BookItem 的检查
+    item = BookItem.__new__(BookItem)
+    item.price = price
+    item.size = size
+    return item
+
 class Book:
+    digits: Optional[Tuple[int, int]] = None # 只有 DeltaBook 支持定点模式
+
     def __init__(self, pair: str) -> None:
         self.pair: str = pair
         self.slices: List[Tuple[int, BookSlice]] = []
+        self._timestamps: List[int] = [] # 与 slices 一一对应的升序时间戳索引
     
     def add_slice(self, timestamp: int, asks: List[Tuple[float, float]], bids: List[Tuple[float, float]]) -> None:
-        last_slice = deepcopy(self.slices[-1][1]) if len(self.slices) > 0 else None
+        last_slice = None
+        if len(self.slices) > 0:
+            # BookSlice 的操作不会原地修改档位数组, 共享数组即可
+            last_slice = BookSlice.from_levels(self.slices[-1][1].askLevels, self.slices[-1][1].bidLevels)
         if last_slice:
             last_slice.remove_zero_size()
             last_slice.set_zero()
             new_slice = last_slice
-            for ask in asks:
-                new_slice.add_ask(ask[0], ask[1])
-            for bid in bids:
-                new_slice.add_bid(bid[0], bid[1])
+            new_slice.add_many_asks(asks)
+            new_slice.add_many_bids(bids)
         else:
             new_slice = BookSlice(asks, bids)
-        self.slices.append((timestamp, new_slice))
-        self.slices.sort(key=lambda x: x[0], reverse=False)
+        index = bisect_right(self._timestamps, timestamp)
+        self._timestamps.insert(index, timestamp)
+        self.slices.insert(index, (timestamp, new_slice))
     
     def __getitem__(self, index: int) -> Tuple[int, BookSlice]:
         return self.slices[index]
     
     def at(self, timestamp: int) -> BookSlice:
-        for i in range(len(self.slices)):
-            if self.slices[i][0] > timestamp:
-                return self.slices[i-1][1]
-        raise ValueError(f"Timestamp {timestamp} is out of range")
+        '''
+        获取 timestamp 时刻生效的订单簿, 即最后一个不晚于 timestamp 的切片
+        '''
+        return self.slices[locate_timestamp(self._timestamps, timestamp)][1]
+    
+    def at_many(self, timestamps: Iterable[int]) -> List[BookSlice]:
+        '''
+        at 的批量版本
+        '''
+        return [self.slices[i][1] for i in locate_timestamps(self._timestamps, timestamps)]
+    
+    def window(self, t0: int, t1: int) -> Iterator[Tuple[int, BookSlice]]:
+        '''
+        依次访问时间戳位于 [t0, t1) 的切片
+        '''
+        for i in timestamp_window(self._timestamps, t0, t1):
+            yield self.slices[i]
     
+    def levelsAt(self, timestamp: int, side: int) -> np.ndarray:
+        '''
+        timestamp 时刻生效的切片中某一方向的价格档位, 见 matching.MatchingEngine
+        '''
+        book_slice = self.at(timestamp)
+        return book_slice.askLevels if side == ASK else book_slice.bidLevels
+
     def __len__(self) -> int:
         return len(self.slices)
     
+    def extend(self, other: 'Book') -> None:
+        '''
+        将 other 的切片依次接在最后, 结果与按时间顺序 add_slice 全部切片相同
+        NOTICE: other 的第一个切片不能早于最后一个切片, 用于拼接按时间分片生成的订单簿
+        '''
+        columns = other.columns()
+        offsets, price, size, side = columns['offsets'], columns['price'], columns['size'], columns['side']
+        for i, timestamp in enumerate(columns['ts'].tolist()):
+            rows = slice(offsets[i], offsets[i+1])
+            levels = list(zip(price[rows].tolist(), size[rows].tolist()))
+            sides = side[rows].tolist()
+            self.add_slice(timestamp, [x for x, s in zip(levels, sides) if s == ASK], 
+                                      [x for x, s in zip(levels, sides) if s == BID])
+    
     
+    def tail(self) -> 'Book':
+        '''
+        只包含最后一个切片的订单簿, 之后可以继续 extend 后续的切片, 用于流式生成
+        NOTICE: 只保留最后一个切片中 size 不为零的档位, 在下一个切片中它们同样会被置零
+        '''
+        book = Book(self.pair)
+        if len(self.slices) > 0:
+            timestamp, book_slice = self.slices[-1]
+            book.add_slice(timestamp, book_slice.askLevels[book_slice.askLevels['size'] > 0].tolist(),
+                                      book_slice.bidLevels[book_slice.bidLevels['size'] > 0].tolist())
+        return book
+
     def __iter__(self):
         return iter(self.slices)
     
     
+    def columns(self) -> Dict[str, np.ndarray]:
+        '''
+        以列的形式导出每个时刻新增的价格档位, 格式与 DeltaBook 的存储一致
+        NOTICE: 新增的价格档位即切片中 size 不为零的档位
+        '''
+        ts, offsets, price, size, side = [], [0], [], [], []
+        for timestamp, book_slice in self.slices:
+            for levels, level_side in ((book_slice.askLevels, ASK), (book_slice.bidLevels, BID)):
+                levels = levels[levels['size'] > 0]
+                price.append(levels['price'])
+                size.append(levels['size'])
+                side.append(np.full(len(levels), level_side, dtype=np.int8))
+            ts.append(timestamp)
+            offsets.append(offsets[-1] + len(price[-1]) + len(price[-2]))
+        return {
+            'ts': np.array(ts, dtype=np.int64),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'price': np.concatenate(price) if price else np.empty(0, dtype=np.float64),
+            'size': np.concatenate(size) if size else np.empty(0, dtype=np.float64),
+            'side': np.concatenate(side) if side else np.empty(0, dtype=np.int8),
+        }
+    
+    def iterdicts(self) -> Iterator[Tuple[int, Dict[str, List[str]]]]:
+        '''
+        依次访问各个切片的字典形式, 用于流式写出
+        '''
+        for ts, book_slice in self:
+            yield (ts, book_slice.asdict())
+    
     def asdict(self):
         return {
             "pair": self.pair,
             "slices": {x[0]: x[1].asdict() for x in self.slices}
         }
 
+
+class DeltaBook(Book):
+    '''
+    以增量形式存储的订单簿
+    只保存每个时刻新增的价格档位(price, size, side), BookSlice 在访问时重建.
+    NOTICE: 在 Book.add_slice 的语义下, 上一时刻的价格档位在当前时刻被置零, 并在下一时刻被移除,
+            因此每个切片只由上一时刻与当前时刻新增的价格档位决定, 每个时刻的增量本身即是完整的快照.
+    NOTICE: 要求按时间顺序添加切片
+    NOTICE: 给定 digits = (价格小数位数, 数量小数位数) 时为定点模式, price/size 以 int64 单位存储,
+            只在 asdict/iterdicts 中转换为十进制字符串; 重建的 BookSlice 仍然是浮点数
+    '''
+    def __init__(self, pair: str, digits: Optional[Tuple[int, int]] = None) -> None:
+        self.pair: str = pair
+        self.digits: Optional[Tuple[int, int]] = digits
+        dtype = np.float64 if digits is None else np.int64
+        self._ts = Column(np.int64)
+        self._offsets = Column(np.int64) # 第 i 个时刻的档位位于 [offsets[i], offsets[i+1])
+        self._offsets.append(0)
+        self._price = Column(dtype)
+        self._size = Column(dtype)
+        self._side = Column(np.int8)
+
+    @classmethod
+    def from_columns(cls, pair: str, columns: Dict[str, np.ndarray], digits: Optional[Tuple[int, int]] = None) -> 'DeltaBook':
+        '''
+        由 columns() 格式的数组构建订单簿, 数组不会被复制(可以是只读的内存映射数组)
+        '''
+        book = cls.__new__(cls)
+        book.pair = pair
+        book.digits = digits
+        book._ts = Column.wrap(columns['ts'])
+        book._offsets = Column.wrap(columns['offsets'])
+        book._price = Column.wrap(columns['price'])
+        book._size = Column.wrap(columns['size'])
+        book._side = Column.wrap(columns['side'])
+        return book
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        return {
+            'ts': self._ts.values,
+            'offsets': self._offsets.values,
+            'price': self._price.values,
+            'size': self._size.values,
+            'side': self._side.values,
+        }
+
+    def add_slice(self, timestamp: int, asks: List[Tuple[float, float]], bids: List[Tuple[float, float]]) -> None:
+        if len(self._ts) > 0 and timestamp < self._ts.values[-1]:
+            raise ValueError(f"Timestamp {timestamp} is earlier than the last slice")
+        for ask in asks:
+            assert ask[0] >= 0, "Price must be not negative"
+            assert ask[1] > 0, "Size must be not negative"
+        for bid in bids:
+            assert bid[0] >= 0, "Price must be not negative"
+            assert bid[1] > 0, "Size must be not negative"
+        self._ts.append(timestamp)
+        self._price.extend([x[0] for x in asks] + [x[0] for x in bids])
+        self._size.extend([x[1] for x in asks] + [x[1] for x in bids])
+        self._side.extend([ASK]*len(asks) + [BID]*len(bids))
+        self._offsets.append(len(self._price))
+
+    def extend(self, other: Book) -> None:
+        # 直接拼接 other 导出的列, 上一分片的最后一个切片在 other 的第一个切片中自然被置零
+        if other.digits != self.digits:
+            raise ValueError(f"Cannot extend a book with digits {self.digits} by one with digits {other.digits}")
+        columns = other.columns()
+        if len(columns['ts']) == 0:
+            return
+        if len(self._ts) > 0 and columns['ts'][0] < self._ts.values[-1]:
+            raise ValueError(f"Timestamp {columns['ts'][0]} is earlier than the last slice")
+        self._ts.extend(columns['ts'])
+        self._offsets.extend(columns['offsets'][1:] + len(self._price))
+        self._price.extend(columns['price'])
+        self._size.extend(columns['size'])
+        self._side.extend(columns['side'])
+
+    def tail(self) -> 'DeltaBook':
+        columns = self.columns()
+        if len(columns['ts']) == 0:
+            return DeltaBook(self.pair, self.digits)
+        start, end = columns['offsets'][-2], columns['offsets'][-1]
+        return DeltaBook.from_columns(self.pair, {
+            'ts': columns['ts'][-1:].copy(),
+            'offsets': np.array([0, end - start], dtype=np.int64),
+            'price': columns['price'][start:end].copy(),
+            'size': columns['size'][start:end].copy(),
+            'side': columns['side'][start:end].copy(),
+        }, self.digits)
+
+    def _rows(self, index: int, side: int) -> np.ndarray:
+        '''
+        第 index 个时刻新增的某一方向的价格档位, 保持添加时的顺序
+        '''
+        offsets = self._offsets.values
+        start, end = offsets[index], offsets[index+1]
+        mask = self._side.values[start:end] == side
+        levels = np.empty(int(mask.sum()), dtype=LevelDtype if self.digits is None else FixedLevelDtype)
+        levels['price'] = self._price.values[start:end][mask]
+        levels['size'] = self._size.values[start:end][mask]
+        return levels
+
+    def _levels(self, index: int, side: int) -> np.ndarray:
+        '''
+        重建第 index 个切片中某一方向的价格档位, 置零的档位 size 为 0
+        '''
+        levels = self._rows(index, side)
+        if index == 0:
+            return _merge_levels(levels[:0], levels, side)
+        prev = self._rows(index-1, side).copy()
+        prev['size'] = 0
+        # 与 Book.add_slice 一致: 上一时刻的档位置零后在前, 稳定排序使价格相同时置零的档位排在前面
+        return _merge_levels(levels[:0], np.concatenate((prev, levels)), side)
+
+    def _float_levels(self, index: int, side: int) -> np.ndarray:
+        levels = self._levels(index, side)
+        if self.digits is None:
+            return levels
+        result = np.empty(len(levels), dtype=LevelDtype)
+        result['price'] = from_units(levels['price'], self.digits[0])
+        result['size'] = from_units(levels['size'], self.digits[1])
+        return result
+
+    def _slice(self, index: int) -> BookSlice:
+        return BookSlice.from_levels(self._float_levels(index, ASK), self._float_levels(index, BID))
+
+    def _slice_dict(self, index: int) -> Dict[str, List[str]]:
+        if self.digits is None:
+            return self._slice(index).asdict()
+        price_digits, size_digits = self.digits
+        return {
+            name: [f"{format_units(p, price_digits)}:{format_units(s, size_digits)}" 
+                   for p, s in self._levels(index, side).tolist()]
+            for name, side in (("asks", ASK), ("bids", BID))
+        }
+
+    @property
+    def slices(self) -> List[Tuple[int, BookSlice]]:
+        '''
+        NOTICE: 会重建全部切片, 仅用于兼容
+        '''
+        return list(self)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Tuple[int, BookSlice], List[Tuple[int, BookSlice]]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Book index out of range")
+        return (int(self._ts.values[index]), self._slice(index))
+
+    def at(self, timestamp: int) -> BookSlice:
+        return self._slice(locate_timestamp(self._ts.values, timestamp))
+
+    def at_many(self, timestamps: Iterable[int]) -> List[BookSlice]:
+        return [self._slice(i) for i in locate_timestamps(self._ts.values, timestamps)]
+
+    def levelsAt(self, timestamp: int, side: int) -> np.ndarray:
+        # 定点模式下为整数单位
+        return self._levels(locate_timestamp(self._ts.values, timestamp), side)
+
+    def window(self, t0: int, t1: int) -> Iterator[Tuple[int, BookSlice]]:
+        for i in timestamp_window(self._ts.values, t0, t1):
+            yield (int(self._ts.values[i]), self._slice(i))
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    def __iter__(self) -> Iterator[Tuple[int, BookSlice]]:
+        for i in range(len(self)):
+            yield (int(self._ts.values[i]), self._slice(i))
+
+    def iterdicts(self) -> Iterator[Tuple[int, Dict[str, List[str]]]]:
+        for i in range(len(self)):
+            yield (int(self._ts.values[i]), self._slice_dict(i))
+
+    def asdict(self):
+        return {
+            "pair": self.pair,
+            "slices": dict(self.iterdicts())
+        }
+
+
+class LazyBook(DeltaBook):
+    '''
+    按需生成切片的订单簿
+    只保存随机数种子, 交易对的精度信息和指令索引(每个指令时刻的指令档位及当时的 ask/bid),
+    每个时刻新增的价格档位在访问时才生成. 随机数来自以 (seed, pair, ts) 为密钥的 Philox 计数器随机数生成器,
+    因此任意切片都可以独立且确定地重新生成, 随机访问和流式写出时每个切片只占用 O(1) 的内存.
+    NOTICE: 生成规则与 TestFactory.genBook 相同, 但每个时刻使用独立的随机数流,
+            因此与 'list'/'delta' 生成的订单簿不同
+    NOTICE: 不支持 add_slice, 使用 add_instruction 添加指令时刻; columns() 会生成全部切片
+    '''
+    def __init__(self,
+                pair: str,
+                seed: int,
+                tickSz: float,
+                lotDigits: int,
+                minSz: float,
+                depth: int = 20,
+                digits: Optional[Tuple[int, int]] = None,
+                levelSize: float = 1,
+                ) -> None:
+        self.pair: str = pair
+        self.digits: Optional[Tuple[int, int]] = digits
+        self.depth: int = depth # 订单簿深度
+        self.levelSize: float = levelSize # 每一档的平均委托量
+        self.tickSz: float = tickSz
+        self.lotDigits: int = lotDigits
+        self.minSz: float = minSz
+        self._key: int = derive_seed(seed, 'book', pair) # Philox 密钥的低 64 位, 高 64 位为时间戳
+        dtype = np.float64 if digits is None else np.int64
+        self._ts = Column(np.int64)
+        self._side = Column(np.int8) # 指令档位所在的方向
+        self._price = Column(dtype) # 指令档位
+        self._size = Column(dtype)
+        self._ask = Column(np.float64) # 该时刻的卖一价和买一价
+        self._bid = Column(np.float64)
+        self._cache: Dict[int, Tuple[np.ndarray, np.ndarray]] = {} # 最近生成的两个时刻, 重建切片时需要相邻的两个时刻
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def add_slice(self, timestamp: int, asks: List[Tuple[float, float]], bids: List[Tuple[float, float]]) -> None:
+        raise Exception('LazyBook does not support add_slice, use add_instruction instead')
+
+    def add_instruction(self, timestamp: int, side: int, price: float, size: float, ask: float, bid: float) -> None:
+        '''
+        添加一个指令时刻: 指令档位 (price, size) 位于 side 方向, ask/bid 为该时刻的卖一价和买一价
+        side 为 NOSIDE 时该时刻没有指令档位, 只有随机生成的档位
+        '''
+        if len(self._ts) > 0 and timestamp <= self._ts.values[-1]:
+            raise ValueError(f"Timestamp {timestamp} is not later than the last slice")
+        assert price >= 0, "Price must be not negative"
+        assert size > 0, "Size must be not negative"
+        self._ts.append(timestamp)
+        self._side.append(side)
+        self._price.append(price)
+        self._size.append(size)
+        self._ask.append(ask)
+        self._bid.append(bid)
+
+    def extend(self, other: Book) -> None:
+        '''
+        拼接同一测例中按时间分片生成的 LazyBook, 只需拼接指令索引
+        '''
+        if not isinstance(other, LazyBook) or \
+           (other._key, other.digits, other.depth, other.tickSz, other.lotDigits, other.minSz, other.levelSize) != \
+           (self._key, self.digits, self.depth, self.tickSz, self.lotDigits, self.minSz, self.levelSize):
+            raise ValueError("Only a LazyBook with the same seed and parameters can be appended to a LazyBook")
+        if len(other) == 0:
+            return
+        if len(self._ts) > 0 and other._ts.values[0] <= self._ts.values[-1]:
+            raise ValueError(f"Timestamp {other._ts.values[0]} is not later than the last slice")
+        for name in ('_ts', '_side', '_price', '_size', '_ask', '_bid'):
+            getattr(self, name).extend(getattr(other, name).values)
+
+    def tail(self) -> 'LazyBook':
+        # 切片由种子和指令索引决定, 只需保留最后一个时刻的索引
+        book = copy(self)
+        for name in ('_ts', '_side', '_price', '_size', '_ask', '_bid'):
+            column = Column(getattr(self, name).values.dtype)
+            column.extend(getattr(self, name).values[-1:])
+            setattr(book, name, column)
+        book._cache = {}
+        return book
+
+    def rng(self, timestamp: int) -> np.random.Generator:
+        '''
+        timestamp 时刻的随机数流
+        '''
+        return np.random.Generator(np.random.Philox(key=self._key + (int(timestamp) << 64)))
+
+    def _generate(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        生成第 index 个时刻新增的卖单和买单档位, 指令档位在前
+        '''
+        cached = self._cache.get(index)
+        if cached is not None:
+            return cached
+        depth = self.depth
+        rng = self.rng(self._ts.values[index])
+        ask_v = generate_random_seqs(rng, self.levelSize, self.levelSize/3, (1, depth), self.lotDigits, self.minSz)[0]
+        bid_v = generate_random_seqs(rng, self.levelSize, self.levelSize/3, (1, depth), self.lotDigits, self.minSz)[0]
+        ask, bid = self._ask.values[index:index+1], self._bid.values[index:index+1]
+        if self.digits is None:
+            ask_ps = generate_order_seqs(ask, depth, self.tickSz)[0]
+            bid_ps = generate_order_seqs(bid, depth, self.tickSz, False)[0]
+            dtype = LevelDtype
+        else: # 与 TestFactory.genBook 一样, 价格档位从取整后的 ask/bid 开始
+            tick = int(to_units(self.tickSz, self.digits[0]))
+            ask_ps = generate_order_seqs(to_units(ask, self.digits[0], tick), depth, tick)[0]
+            bid_ps = generate_order_seqs(to_units(bid, self.digits[0], tick), depth, tick, False)[0]
+            ask_v, bid_v = to_units(ask_v, self.lotDigits), to_units(bid_v, self.lotDigits)
+            dtype = FixedLevelDtype
+        sides = []
+        for side, ps, vs in ((ASK, ask_ps, ask_v), (BID, bid_ps, bid_v)):
+            has_inst = self._side.values[index] == side
+            levels = np.empty(depth, dtype=dtype)
+            if has_inst:
+                levels[0] = (self._price.values[index], self._size.values[index])
+            levels['price'][int(has_inst):] = ps[:depth-int(has_inst)]
+            levels['size'][int(has_inst):] = vs[:depth-int(has_inst)]
+            sides.append(levels)
+        if len(self._cache) >= 2:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[index] = (sides[0], sides[1])
+        return self._cache[index]
+
+    def _rows(self, index: int, side: int) -> np.ndarray:
+        return self._generate(index)[side]
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        '''
+        生成全部切片, 以 DeltaBook 的列格式导出
+        '''
+        book = DeltaBook(self.pair, self.digits)
+        for i in range(len(self)):
+            asks, bids = self._generate(i)
+            book.add_slice(int(self._ts.values[i]), asks.tolist(), bids.tolist())
+        return book.columns()
+
+
+BookStorages = {
+    'list': Book,
+    'delta': DeltaBook,
+}
+
+
+def _same_slices(a: List[BookSlice], b: List[BookSlice]) -> bool:
+    return len(a) == len(b) and all(np.array_equal(x.askLevels, y.askLevels) and np.array_equal(x.bidLevels, y.bidLevels)
+                                    for x, y in zip(a, b))
+
+def _lazy_book(digits: Optional[Tuple[int, int]] = None) -> LazyBook:
+    book = LazyBook('BTC-USDT', 7, 0.01, 4, 0.0001, depth=5, digits=digits)
+    rng = np.random.default_rng(0)
+    for i, ts in enumerate(range(1000, 31000, 1000)):
+        bid = round(100 + rng.normal(), 2)
+        side = [ASK, BID, NOSIDE][i % 3]
+        price = bid + 0.01 if side == ASK else bid
+        if digits is not None:
+            price = int(to_units(price, digits[0]))
+        book.add_instruction(ts, side, price, 3 if digits is None else 30000, bid + 0.01, bid)
+    return book
+
+def test_LazyBook():
+    import pickle
+    for digits in (None, (2, 4)):
+        book = _lazy_book(digits)
+        timestamps = [int(ts) for ts in book._ts.values]
+        # 按时间顺序一次性生成全部切片
+        eager = DeltaBook.from_columns(book.pair, book.columns(), digits)
+        expected = [book_slice for _, book_slice in eager]
+        assert _same_slices([_lazy_book(digits).at(ts) for ts in timestamps], expected)
+        # 乱序和重复访问, 以及时间戳位于两个切片之间
+        order = np.random.default_rng(1).permutation(len(timestamps)).tolist() * 2
+        shuffled = _lazy_book(digits)
+        assert _same_slices([shuffled.at(timestamps[i] + 500) for i in order], [expected[i] for i in order])
+        assert _same_slices(shuffled.at_many([timestamps[i] for i in order]), [expected[i] for i in order])
+        # pickle 往返后只保留种子和指令索引, 切片不变
+        restored = pickle.loads(pickle.dumps(shuffled))
+        assert restored._cache == {}
+        assert _same_slices([restored.at(ts) for ts in reversed(timestamps)], expected[::-1])
+        assert restored.asdict() == eager.asdict()
+
+def _random_updates(seed: int, n: int = 40) -> List[Tuple[int, List[Tuple[float, float]], List[Tuple[float, float]]]]:
+    # 价格取自很少的几个值, 使同一方向和相邻时刻出现重复价格
+    rng = np.random.default_rng(seed)
+    def levels() -> List[Tuple[float, float]]:
+        return [(float(rng.integers(95, 106)), float(rng.integers(1, 5))) for _ in range(rng.integers(1, 6))]
+    return [(1000 * (i + 1), levels(), levels()) for i in range(n)]
+
+def _baseline_slices(updates) -> List[Tuple[int, List[Tuple[float, float]], List[Tuple[float, float]]]]:
+    '''
+    最初的列表实现的 Book.add_slice: 上一切片移除置零的档位后全部置零, 再逐个追加新档位并稳定排序;
+    第一个切片直接使用传入的顺序, 不排序
+    '''
+    slices = []
+    for ts, asks, bids in updates:
+        if not slices:
+            slices.append((ts, list(asks), list(bids)))
+            continue
+        _, prev_asks, prev_bids = slices[-1]
+        new_asks, new_bids = [(p, 0) for p, s in prev_asks if s > 0], [(p, 0) for p, s in prev_bids if s > 0]
+        for ask in asks:
+            new_asks.append(ask)
+            new_asks.sort(key=lambda x: x[0])
+        for bid in bids:
+            new_bids.append(bid)
+            new_bids.sort(key=lambda x: x[0], reverse=True)
+        slices.append((ts, new_asks, new_bids))
+    return slices
+
+def test_DeltaBook():
+    for seed in range(5):
+        updates = _random_updates(seed)
+        book, delta = Book('BTC-USDT'), DeltaBook('BTC-USDT')
+        for ts, asks, bids in updates:
+            book.add_slice(ts, asks, bids)
+            delta.add_slice(ts, asks, bids)
+        assert book.asdict() == delta.asdict()
+        baseline = _baseline_slices(updates)
+        assert len(delta) == len(baseline)
+        for i, ((ts, book_slice), (ts0, asks, bids)) in enumerate(zip(delta, baseline)):
+            if i == 0:
+                # 有意的差异: 第一个切片同样按价格排序, 而最初的实现保持传入的顺序
+                asks, bids = sorted(asks, key=lambda x: x[0]), sorted(bids, key=lambda x: x[0], reverse=True)
+            assert ts == ts0
+            assert book_slice.askLevels.tolist() == asks and book_slice.bidLevels.tolist() == bids, (seed, i)
+    # TestFactory 以同一种子生成的订单簿与存储方式无关
+    from benchmark import fixture_factory
+    books = {}
+    for storage in BookStorages:
+        tf = fixture_factory(3)
+        tf.bookStorage = storage
+        books[storage] = tf.produce(2, 500, seed=3).books
+    assert {pair: book.asdict() for pair, book in books['list'].items()} == \
+           {pair: book.asdict() for pair, book in books['delta'].items()}
+
+def test_Book_at():
+    updates = _random_updates(0, 10) # 时间戳为 1000, 2000, ..., 10000
+    for bookType in (Book, DeltaBook):
+        book = bookType('BTC-USDT')
+        for ts, asks, bids in updates:
+            book.add_slice(ts, asks, bids)
+        slices = [book_slice for _, book_slice in book]
+        # 恰好命中, 位于两个切片之间, 晚于最后一个切片
+        assert _same_slices([book.at(ts) for ts, _, _ in updates], slices)
+        assert _same_slices([book.at(ts + 999) for ts, _, _ in updates], slices)
+        assert _same_slices([book.at(10**12)], slices[-1:])
+        assert _same_slices(book.at_many([1000, 1500, 9999, 10000, 10**12, 1000]), 
+                            [slices[0], slices[0], slices[8], slices[9], slices[9], slices[0]])
+        assert book.at_many([]) == []
+        # 早于第一个切片
+        for fn in (lambda: book.at(999), lambda: book.at_many([2000, 999]), lambda: book.levelsAt(0, ASK)):
+            try:
+                fn()
+                assert False, "ValueError expected"
+            except ValueError:
+                pass
+        # window 为左闭右开区间
+        assert [ts for ts, _ in book.window(2000, 5000)] == [2000, 3000, 4000]
+        assert [ts for ts, _ in book.window(1500, 5001)] == [2000, 3000, 4000, 5000]
+        assert [ts for ts, _ in book.window(0, 10**12)] == [ts for ts, _, _ in updates]
+        assert list(book.window(3000, 3000)) == [] and list(book.window(10001, 20000)) == []
+        assert _same_slices([x for _, x in book.window(3000, 4001)], slices[2:4])
+
+def test_merge_levels():
+    # 与原来逐个追加后整体稳定排序的实现比较, 包括重复价格和移除置零的档位
+    rng = np.random.default_rng(0)
+    def random_levels(n: int) -> List[Tuple[float, float]]:
+        return [(float(rng.integers(0, 8)), float(rng.integers(0, 3))) for _ in range(n)]
+    def resort(levels: List[Tuple[float, float]], items: List[Tuple[float, float]], side: int) -> List[Tuple[float, float]]:
+        levels = list(levels)
+        for item in items:
+            levels.append(item)
+            levels.sort(key=lambda x: x[0], reverse=side == BID)
+        return levels
+    for side in (ASK, BID):
+        for _ in range(200):
+            levels = resort([], random_levels(rng.integers(0, 10)), side)
+            items = random_levels(rng.integers(0, 10))
+            merged = _merge_levels(np.array(levels, dtype=LevelDtype), np.array(items, dtype=LevelDtype), side)
+            assert merged.tolist() == resort(levels, items, side)
+        book_slice, reference = BookSlice([], []), []
+        for _ in range(50):
+            items = [x for x in random_levels(rng.integers(0, 6)) if x[1] > 0]
+            book_slice.remove_zero_size()
+            book_slice.set_zero()
+            reference = [(p, 0.0) for p, s in reference if s > 0]
+            if side == ASK:
+                book_slice.add_many_asks(items)
+            else:
+                book_slice.add_many_bids(items)
+            reference = resort(reference, items, side)
+            assert (book_slice.askLevels if side == ASK else book_slice.bidLevels).tolist() == reference
@@ -1,8 +1,11 @@
 import json
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, Optional
 from Book import Book
 from instruction import Instruction
 from Balance import BalancesHistory
+from writer import write_testcase
+from columnar import write_columnar
+from chunked import write_chunked, DefaultChunkPeriod
 
 class TestCase:
     
@@ -10,22 +13,66 @@ class TestCase:
                 bt_period: Tuple[int, int],
                 books: Dict[str, Book],
                 insts: List[Instruction],
-                referredBalance: BalancesHistory
+                referredBalance: BalancesHistory,
+                seed: Optional[int] = None,
+                manifest: Optional[Dict[str, Any]] = None,
                 ) -> None:
         self.bt_period = bt_period
         self.books = books
         self.insts = insts
         self.referredBalance = referredBalance
+        self.seed = seed # 生成该测例时使用的随机数种子
+        self.manifest = manifest # 各个阶段和交易对的种子及参数, 见 TestFactory.caseManifest 和 replay.CaseReplay
     
     
     def to_files(self, path) -> None:
         with open(path, 'w') as f:
             json.dump(self.asdict(), f, indent=4)
     
+    def to_dir(self, path) -> None:
+        '''
+        以流的形式将测例写入目录 path 下的 market.txt, instruction.txt 和 reference.txt
+        '''
+        write_testcase(path, self.bt_period, self.books, self.insts, self.referredBalance, self.seed, manifest=self.manifest)
+    
+    def to_columnar(self, path) -> None:
+        '''
+        以二进制列式格式将测例写入目录 path, 可由 columnar.ColumnarReader 以内存映射的方式读取
+        '''
+        write_columnar(path, self.bt_period, self.books, self.insts, self.referredBalance, self.seed, self.manifest)
+    
+    def to_chunked(self, path, chunkPeriod: int = DefaultChunkPeriod, codec: str = 'zlib') -> None:
+        '''
+        将测例写入单个分块压缩的文件 path, 每 chunkPeriod 毫秒为一个 chunk, 可由 chunked.ChunkedReader 按时间范围读取
+        '''
+        write_chunked(path, self.bt_period, self.books, self.insts, self.referredBalance, self.seed, chunkPeriod, codec, 
+                      self.manifest)
+    
+    def save(self, path, fmt: str = 'json') -> None:
+        '''
+        按 fmt 指定的格式保存测例
+        json: 单个 JSON 文件, 见 to_files
+        txt: market.txt/instruction.txt/reference.txt, 见 to_dir
+        npy: 二进制列式格式, 见 to_columnar
+        chunk: 分块压缩的单个文件, 见 to_chunked
+        '''
+        if fmt == 'json':
+            self.to_files(path)
+        elif fmt == 'txt':
+            self.to_dir(path)
+        elif fmt == 'npy':
+            self.to_columnar(path)
+        elif fmt == 'chunk':
+            self.to_chunked(path)
+        else:
+            raise ValueError(f"Unknown format {fmt}")
+    
     def asdict(self) -> Dict[str, Any]:
         return {
+            'seed': self.seed,
             'bt_period': self.bt_period, 
             'books': {k: v.asdict() for k, v in self.books.items()},
             'insts': [x.asdict() for x in self.insts],
-            'referredBalance': self.referredBalance.asdict()
+            'referredBalance': self.referredBalance.asdict(),
+            'manifest': self.manifest,
         }
@@ -0,0 +1,210 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from testfactory import TestFactory
+from Book import BookStorages
+from utils.helper import derive_seed
+from utils.instruments import load_instruments, InstrumentRegistry
+from utils.marketdata import SnapshotProvider
+
+'''
+TestFactory 生成流程的基准测试
+使用 resource 下的产品信息和固定的合成价格, 不访问网络.
+例:
+    python benchmark.py --quick
+    python benchmark.py --history bench_history.json --baseline bench_baseline.json --threshold 0.2
+    python benchmark.py --save-baseline bench_baseline.json
+'''
+
+DefaultPoints = [100, 1000, 10000, 86400]
+DefaultPairs = [1, 10, 50]
+QuickPoints = [100, 1000]
+QuickPairs = [1, 10]
+DefaultRepeat = 5 # 每个阶段的重复次数
+DefaultMinDelta = 1e-3 # 耗时增长小于该值(单位: 秒)时不视为性能回退
+
+def fixture_prices(registry: InstrumentRegistry) -> Dict[str, float]:
+    '''
+    固定的合成价格, 在 0.01 到 10000 之间, 只由 instId 决定
+    '''
+    return {inst.instId: round(10 ** ((derive_seed(0, inst.instId) % 600) / 100 - 2), 4) for inst in registry}
+
+def fixture_instruments() -> List[Dict]:
+    '''
+    只保留以 USDT 计价的交易对, 保证 genBalance 能为每个币种找到价格
+    '''
+    return [x for x in load_instruments('SPOT') if x['quoteCcy'] == 'USDT']
+
+def fixture_factory(seed: int = 0) -> TestFactory:
+    instruments = fixture_instruments()
+    prices = SnapshotProvider({'SPOT': fixture_prices(InstrumentRegistry(instruments))})
+    return TestFactory(instruments=instruments, marketData=prices, seed=seed)
+
+def measure(fn: Callable[[], Any], memory: bool = True, repeat: int = DefaultRepeat) -> Tuple[Any, Dict[str, float]]:
+    '''
+    计时执行 fn repeat 次, wall 为最短耗时, wall_median 为中位数; memory 为 True 时再用 tracemalloc 执行一次以记录内存峰值
+    NOTICE: 单次计时受调度和缓存的影响很大, 亚毫秒级的阶段尤其如此, 因此以最短耗时作为比较的依据
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        walls = []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            result = fn()
+            walls.append(time.perf_counter() - start)
+        stats = {'wall': min(walls), 'wall_median': statistics.median(walls)}
+        if memory:
+            tracemalloc.start()
+            fn()
+            stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return result, stats
+
+def bench_case(points: int, num_pairs: int, memory: bool = True, repeat: int = DefaultRepeat) -> Dict[str, Dict[str, float]]:
+    '''
+    对一组 (points, num_pairs) 依次测量各个阶段
+    '''
+    results: Dict[str, Dict[str, float]] = {}
+    tf = fixture_factory()
+    lastPrices = tf.marketData.get_lastPrice('SPOT')
+    bt_period = tf.genBackTestPeriod(point=points)
+    pairs = tf.genPairs(num_pairs, ['USDT-', 'USDC-'], lastPrices)
+    insts = tf.genInsts(bt_period, pairs)
+    total_pairs = sorted(set(inst.pair for inst in insts))
+    p0s = {pair: lastPrices[pair] for pair in total_pairs}
+
+    askbids, results['genAskBids'] = measure(lambda: tf.genAskBidsBatch(total_pairs, p0s, bt_period), memory, repeat)
+    results['genAskBids']['points_per_sec'] = len(total_pairs) * (points + 1) / results['genAskBids']['wall']
+
+    insts, results['fillInsts'] = measure(lambda: tf.fillInsts(askbids, insts, lastPrices), memory, repeat)
+    results['fillInsts']['insts_per_sec'] = len(insts) / results['fillInsts']['wall']
+
+    groups = tf.groupInsts(insts)
+    books, results['genBook'] = measure(lambda: {pair: tf.genBook(bt_period, groups[pair], askbids[pair], pair) 
+                                                 for pair in total_pairs}, memory)
+    n_slices = sum(len(book) for book in books.values())
+    results['genBook']['slices_per_sec'] = n_slices / results['genBook']['wall']
+
+    for storage, bookType in BookStorages.items():
+        source = [(ts, book_slice) for ts, book_slice in books[total_pairs[0]]]
+        def add_slices():
+            book = bookType(total_pairs[0])
+            for ts, book_slice in source:
+                book.add_slice(ts, [(x.price, x.size) for x in book_slice.asks if x.size > 0], 
+                                   [(x.price, x.size) for x in book_slice.bids if x.size > 0])
+            return book
+        _, stats = measure(add_slices, memory, repeat)
+        stats['slices_per_sec'] = len(source) / stats['wall']
+        results[f'Book.add_slice[{storage}]'] = stats
+
+    balance = tf.genBalance(pairs, lastPrices)
+    referredBalance, results['calBalanceHist'] = measure(lambda: tf.calBalanceHist(insts, balance), memory, repeat)
+    results['calBalanceHist']['insts_per_sec'] = len(insts) / results['calBalanceHist']['wall']
+
+    from TestCase import TestCase
+    tc = TestCase(bt_period, books, insts, referredBalance, tf.caseSeed)
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in ['json', 'txt', 'npy', 'chunk']:
+            path = os.path.join(tmp, f'case-{fmt}')
+            _, stats = measure(lambda: tc.save(path, fmt), memory, repeat)
+            stats['slices_per_sec'] = n_slices / stats['wall']
+            results[f'TestCase.save[{fmt}]'] = stats
+
+    produced, results['produce'] = measure(lambda: fixture_factory().produce(num_pairs, points, lastPrices), memory, repeat)
+    results['produce']['slices_per_sec'] = sum(len(book) for book in produced.books.values()) / results['produce']['wall']
+    return results
+
+def run(points: List[int], pairs: List[int], memory: bool = True, repeat: int = DefaultRepeat) -> Dict[str, Dict[str, float]]:
+    results: Dict[str, Dict[str, float]] = {}
+    for p in points:
+        for n in pairs:
+            for stage, stats in bench_case(p, n, memory, repeat).items():
+                results[f'{stage}/points={p}/pairs={n}'] = stats
+                print(f'{stage:<28} points={p:<6} pairs={n:<3} ' + 
+                      ' '.join(f'{k}={v:.4g}' for k, v in stats.items()), flush=True)
+    return results
+
+def compare(results: Dict[str, Dict[str, float]], 
+            baseline: Dict[str, Dict[str, float]], 
+            threshold: float, 
+            minDelta: float = DefaultMinDelta,
+            ) -> List[str]:
+    '''
+    返回相对 baseline 的耗时增长超过 threshold, 且绝对增长超过 minDelta 秒的测量项
+    '''
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['wall']
+        if stats['wall'] > before * (1 + threshold) and stats['wall'] - before > minDelta:
+            regressions.append(f"{name}: {baseline[name]['wall']:.4g}s -> {stats['wall']:.4g}s")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the TestFactory pipeline')
+    parser.add_argument('--quick', action='store_true', help=f'only run points={QuickPoints}, pairs={QuickPairs}')
+    parser.add_argument('--points', type=int, nargs='+', default=None)
+    parser.add_argument('--pairs', type=int, nargs='+', default=None)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--history', default='bench_history.json', help='JSON file the results are appended to')
+    parser.add_argument('--baseline', default=None, help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown against the baseline')
+    parser.add_argument('--repeat', type=int, default=DefaultRepeat, help='runs per stage; the fastest run is compared')
+    parser.add_argument('--min-delta', type=float, default=DefaultMinDelta, 
+                        help='ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--save-baseline', default=None, help='write the results as a new baseline')
+    args = parser.parse_args()
+
+    points = args.points or (QuickPoints if args.quick else DefaultPoints)
+    pairs = args.pairs or (QuickPairs if args.quick else DefaultPairs)
+    results = run(points, pairs, not args.no_memory, args.repeat)
+
+    history: List[Dict[str, Any]] = []
+    if os.path.exists(args.history):
+        with open(args.history, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+    history.append({'time': int(time.time()), 'python': sys.version.split()[0], 'results': results})
+    with open(args.history, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=4)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print('Regressions:')
+            for line in regressions:
+                print('  ' + line)
+            return 1
+    return 0
+
+def test_compare():
+    baseline = {'a': {'wall': 1e-4}, 'b': {'wall': 1.0}, 'c': {'wall': 1.0}}
+    results = {'a': {'wall': 5e-4}, 'b': {'wall': 1.5}, 'c': {'wall': 1.1}, 'd': {'wall': 9.0}}
+    # a: 相对增长 5 倍但绝对增长不足 1ms, 不计入; c: 未超过阈值; d: 无基线
+    assert compare(results, baseline, 0.2) == ['b: 1s -> 1.5s']
+    assert compare(results, baseline, 0.2, minDelta=0) == ['a: 0.0001s -> 0.0005s', 'b: 1s -> 1.5s']
+
+
+def test_measure():
+    calls = []
+    _, stats = measure(lambda: calls.append(1), memory=False, repeat=3)
+    assert len(calls) == 3
+    assert stats['wall'] <= stats['wall_median']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import pickle
+from typing import Any, Callable, Optional
+
+'''
+生成过程的检查点
+每个阶段的输出连同其输入的指纹保存在 <path>/<stage>.pkl 中; 重新运行时, 如果指纹一致则直接读取, 跳过该阶段.
+'''
+
+def fingerprint(*inputs: Any) -> str:
+    '''
+    计算输入的指纹, 输入应当由基本类型(及其容器)组成
+    '''
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+class CheckpointStore:
+    '''
+    以文件的形式保存各个阶段的输出
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, stage: str) -> str:
+        return os.path.join(self.path, f'{stage}.pkl')
+
+    def load(self, stage: str, key: str) -> Optional[Any]:
+        '''
+        读取 stage 的输出, 不存在或者指纹不一致时返回 None
+        '''
+        try:
+            with open(self._file(stage), 'rb') as f:
+                saved_key, obj = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return obj if saved_key == key else None
+
+    def save(self, stage: str, key: str, obj: Any) -> None:
+        tmpPath = self._file(stage) + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            pickle.dump((key, obj), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, self._file(stage)) # 被中断时不会留下不完整的检查点
+
+    def run(self, stage: str, key: str, fn: Callable[[], Any]) -> Any:
+        '''
+        指纹一致时读取已保存的输出, 否则执行 fn 并保存其输出
+        '''
+        obj = self.load(stage, key)
+        if obj is None:
+            obj = fn()
+            self.save(stage, key, obj)
+        return obj
+
+    def clear(self, keep: tuple = ()) -> None:
+        '''
+        删除除 keep 以外的全部检查点
+        '''
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl') and name[:-len('.pkl')] not in keep:
+                os.remove(os.path.join(self.path, name))
@@ -0,0 +1,246 @@
+import bisect
+import json
+import lzma
+import struct
+import zlib
+from itertools import groupby
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from Book import Book
+from instruction import Instruction
+from Balance import BalancesHistory
+from writer import iter_market, iter_instructions, iter_reference
+
+'''
+分块压缩的单文件测例格式
+文件结构:
+    MAGIC
+    chunk 0, chunk 1, ...       每个 chunk 是一段单独压缩的 JSON 行, 行格式与 market.txt/instruction.txt/reference.txt 相同
+    footer                      JSON: 元信息和索引, 见 write_chunked
+    footer 的长度(8 字节, 小端) + MAGIC
+三个数据流(market, insts, reference)分别按 chunkPeriod 毫秒的固定时间窗口切分, 索引记录每个 chunk 的
+时间范围和在文件中的偏移, 读取某个时间范围时只需解压与之重叠的 chunk.
+'''
+
+MAGIC = b'MTCHUNK1'
+FORMAT_VERSION = 1
+STREAMS = ['market', 'insts', 'reference']
+DefaultChunkPeriod = 60 * 1000 # 默认每个 chunk 覆盖 60 秒
+
+_TRAILER = struct.Struct('<Q')
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.compress(data, 9)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=6)
+    raise ValueError(f"Unknown codec {codec}")
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'lzma':
+        return lzma.decompress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+def _encode(rows: List[Dict[str, Any]]) -> bytes:
+    return ''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in rows).encode('utf-8')
+
+
+class ChunkWriter:
+    '''
+    将若干个按时间排序的数据流分块压缩后写入同一个文件, 每次只在内存中保留一个 chunk
+    '''
+    def __init__(self, path: str, start: int, chunkPeriod: int = DefaultChunkPeriod, codec: str = 'zlib') -> None:
+        assert chunkPeriod > 0, "Chunk period must be positive"
+        _compress(b'', codec) # 提前检查 codec
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start = start
+        self.chunkPeriod = chunkPeriod
+        self.codec = codec
+        self.index: Dict[str, List[List[int]]] = {} # stream -> [[首个时间戳, 最后的时间戳, 偏移, 长度, 行数], ...]
+
+    def write_stream(self, stream: str, rows: Iterable[Dict[str, Any]]) -> None:
+        '''
+        写入一个数据流, rows 必须按 'ts' 排序
+        '''
+        entries = self.index.setdefault(stream, [])
+        for _, chunk in groupby(rows, key=lambda row: (row['ts'] - self.start) // self.chunkPeriod):
+            chunk = list(chunk)
+            if entries and chunk[0]['ts'] < entries[-1][1]:
+                raise ValueError(f"Rows of stream {stream} are not sorted by timestamp")
+            data = _compress(_encode(chunk), self.codec)
+            entries.append([chunk[0]['ts'], chunk[-1]['ts'], self.file.tell(), len(data), len(chunk)])
+            self.file.write(data)
+
+    def close(self, header: Dict[str, Any]) -> None:
+        '''
+        写入 footer 并关闭文件
+        '''
+        footer = dict(header, version=FORMAT_VERSION, codec=self.codec, chunkPeriod=self.chunkPeriod, index=self.index)
+        data = json.dumps(footer, separators=(',', ':')).encode('utf-8')
+        self.file.write(data)
+        self.file.write(_TRAILER.pack(len(data)) + MAGIC)
+        self.file.close()
+
+
+def write_chunked(path: str,
+                  bt_period: Tuple[int, int],
+                  books: Dict[str, Book],
+                  insts: List[Instruction],
+                  referredBalance: BalancesHistory,
+                  seed: Any = None,
+                  chunkPeriod: int = DefaultChunkPeriod,
+                  codec: str = 'zlib',
+                  manifest: Optional[Dict[str, Any]] = None,
+                  ) -> None:
+    '''
+    将测例写入单个分块压缩的文件 path
+    footer 中的元信息与 writer.write_testcase 的文件头相同, 另有 version, codec, chunkPeriod, index 和 manifest
+    '''
+    writer = ChunkWriter(path, bt_period[0], chunkPeriod, codec)
+    try:
+        writer.write_stream('market', iter_market(books))
+        writer.write_stream('insts', iter_instructions(sorted(insts, key=lambda x: x.ts)))
+        writer.write_stream('reference', iter_reference(referredBalance))
+    except BaseException:
+        writer.file.close()
+        raise
+    writer.close({'seed': seed, 'bt_period': list(bt_period), 'pairs': sorted(books), 'manifest': manifest})
+
+
+class ChunkedReader:
+    '''
+    读取 write_chunked 写出的测例, 只解压与请求的时间范围重叠的 chunk
+    NOTICE: 最近解压的一个 chunk 会被缓存, 顺序读取相邻的时间范围时不会重复解压
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a chunked test case: {path}")
+        self.file.seek(-(_TRAILER.size + len(MAGIC)), 2)
+        trailer = self.file.read(_TRAILER.size + len(MAGIC))
+        if trailer[_TRAILER.size:] != MAGIC:
+            raise ValueError(f"Truncated chunked test case: {path}")
+        length, = _TRAILER.unpack(trailer[:_TRAILER.size])
+        self.file.seek(-(_TRAILER.size + len(MAGIC) + length), 2)
+        self.header: Dict[str, Any] = json.loads(self.file.read(length).decode('utf-8'))
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version {self.header['version']}")
+        self.seed: Optional[int] = self.header['seed']
+        self.bt_period: Tuple[int, int] = tuple(self.header['bt_period'])
+        self.codec: str = self.header['codec']
+        self.index: Dict[str, List[List[int]]] = self.header['index']
+        self._lastTs: Dict[str, List[int]] = {stream: [entry[1] for entry in entries] for stream, entries in self.index.items()}
+        self._cache: Tuple[Optional[Tuple[str, int]], List[Dict[str, Any]]] = (None, [])
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> 'ChunkedReader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def chunk(self, stream: str, i: int) -> List[Dict[str, Any]]:
+        '''
+        解压数据流 stream 的第 i 个 chunk
+        '''
+        if self._cache[0] == (stream, i):
+            return self._cache[1]
+        _, _, offset, length, _ = self.index[stream][i]
+        self.file.seek(offset)
+        data = _decompress(self.file.read(length), self.codec)
+        rows = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        self._cache = ((stream, i), rows)
+        return rows
+
+    def rows(self, stream: str, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        '''
+        按时间顺序读取数据流 stream 中时间戳位于 [start, end] 的行
+        '''
+        entries = self.index.get(stream, [])
+        i = 0 if start is None else bisect.bisect_left(self._lastTs[stream], start) # 第一个可能包含 start 的 chunk
+        for i in range(i, len(entries)):
+            if end is not None and entries[i][0] > end:
+                break
+            for row in self.chunk(stream, i):
+                if (start is None or row['ts'] >= start) and (end is None or row['ts'] <= end):
+                    yield row
+
+    def market(self, start: Optional[int] = None, end: Optional[int] = None, pair: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        '''
+        [start, end] 内的订单簿切片, 格式见 writer.iter_market
+        '''
+        for row in self.rows('market', start, end):
+            if pair is None or row['pair'] == pair:
+                yield row
+
+    def instructions(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        return self.rows('insts', start, end)
+
+    def iterdicts(self, start: Optional[int] = None, end: Optional[int] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        '''
+        [start, end] 内的参考余额, 与 BalancesHistory.iterdicts 相同
+        '''
+        for row in self.rows('reference', start, end):
+            yield (row['ts'], row['balance'])
+
+    def balanceAt(self, timestamp: int) -> Optional[Dict[str, Any]]:
+        '''
+        timestamp 时刻的参考余额, 即时间戳不晚于 timestamp 的最后一条记录; 早于第一条记录时返回 None
+        只需解压一个 chunk
+        '''
+        lastTs = self._lastTs.get('reference', [])
+        i = bisect.bisect_left(lastTs, timestamp)
+        entries = self.index.get('reference', [])
+        if i == len(entries) or entries[i][0] > timestamp: # timestamp 在两个 chunk 之间, 取前一个 chunk 的最后一条
+            i -= 1
+        if i < 0:
+            return None
+        result = None
+        for row in self.chunk('reference', i):
+            if row['ts'] > timestamp:
+                break
+            result = row['balance']
+        return result
+
+
+def test_ChunkedReader():
+    # 按时间范围读取的结果与内存中的测例相同, 包括恰好位于 chunk 边界的时间戳
+    import os
+    import tempfile
+    from benchmark import fixture_factory
+    chunkPeriod = 7000
+    for fixedPoint in (False, True):
+        tf = fixture_factory(3)
+        tf.fixedPoint = fixedPoint
+        tc = tf.produce(3, 2000, seed=8)
+        market = json.loads(json.dumps(list(iter_market(tc.books))))
+        reference = json.loads(json.dumps(list(iter_reference(tc.referredBalance))))
+        start, end = tc.bt_period
+        boundaries = list(range(start, end + chunkPeriod, chunkPeriod))
+        probes = sorted(set([row['ts'] + d for row in reference + market for d in (-1, 0, 1)] + 
+                            [t + d for t in boundaries for d in (-1, 0, 1)] + [-1, 0, end + 10**6]))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'case.mtc')
+            tc.to_chunked(path, chunkPeriod)
+            with ChunkedReader(path) as reader:
+                assert len(reader.index['market']) > 10
+                for t in probes:
+                    rows = [row['balance'] for row in reference if row['ts'] <= t]
+                    assert reader.balanceAt(t) == (rows[-1] if rows else None), (fixedPoint, t)
+                    if not fixedPoint and rows:
+                        assert reader.balanceAt(t) == tc.referredBalance.at(t).asdict()
+                for t0, t1 in zip(boundaries, boundaries[2:]):
+                    for lo, hi in ((t0, t1), (t0 - 1, t1 - 1), (t0 + 1, t1 + 1)):
+                        assert list(reader.rows('reference', lo, hi)) == [row for row in reference if lo <= row['ts'] <= hi]
+                        for pair in tc.books:
+                            rows = list(reader.market(lo, hi, pair))
+                            assert rows == [row for row in market if row['pair'] == pair and lo <= row['ts'] <= hi]
+                            if not fixedPoint:
+                                for row in rows:
+                                    assert tc.books[pair].at(row['ts']).asdict() == {'asks': row['asks'], 'bids': row['bids']}
+                assert list(reader.market()) == market
@@ -0,0 +1,186 @@
+import json
+import os
+from typing import Dict, List, Tuple, Iterator, Any, Optional
+import numpy as np
+from Book import Book, DeltaBook
+from instruction import Instruction, LIMITORDER, MARKETORDER, BUY, SELL
+from Balance import BalancesHistory, BalanceLedger
+
+'''
+二进制列式测例格式
+目录结构:
+    header.json                 元信息: seed, bt_period, 交易对, 币种等
+    books/<pair>/<column>.npy   每个时刻新增的价格档位, 见 Book.columns()
+    insts/<column>.npy          交易指令, 见 InstructionColumns
+    reference/<column>.npy      参考余额, 见 BalanceLedger.columns()
+读取时使用 np.load(mmap_mode='r'), 不复制数据, 多个进程可以共享同一份页缓存.
+'''
+
+FORMAT_VERSION = 1
+HEADER_FILE = 'header.json'
+ORDTYPES = [MARKETORDER, LIMITORDER]
+SIDES = [BUY, SELL]
+
+def _save_columns(path: str, columns: Dict[str, np.ndarray]) -> None:
+    os.makedirs(path, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(values))
+
+def _load_columns(path: str, names: List[str]) -> Dict[str, np.ndarray]:
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+
+def _digits(digits: Optional[List[int]]) -> Optional[Tuple[int, int]]:
+    return tuple(digits) if digits is not None else None
+
+BOOK_COLUMNS = ['ts', 'offsets', 'price', 'size', 'side']
+INST_COLUMNS = ['ts', 'ordType', 'side', 'pair', 'price', 'value']
+REFERENCE_COLUMNS = ['ts', 'offsets', 'cols', 'vals', 'checkpoints', 'born']
+
+
+class InstructionColumns:
+    '''
+    以列的形式存储的交易指令, 访问时才构建 Instruction
+    NOTICE: 定点模式下 price/value 为 int64 单位, digits[i] 为第 i 个交易对的 Instruction.digits
+    '''
+    def __init__(self, pairs: List[str], columns: Dict[str, np.ndarray], digits: Optional[List[Tuple[int, int]]] = None) -> None:
+        self.pairs = pairs
+        self.columns = columns
+        self.digits = digits
+
+    @classmethod
+    def encode(cls, insts: List[Instruction]) -> 'InstructionColumns':
+        pairs = sorted(set(inst.pair for inst in insts))
+        pair_ids = {pair: i for i, pair in enumerate(pairs)}
+        digits = {inst.pair: inst.digits for inst in insts}
+        fixed = any(x is not None for x in digits.values())
+        dtype = np.int64 if fixed else np.float64
+        columns = {
+            'ts': np.array([inst.ts for inst in insts], dtype=np.int64),
+            'ordType': np.array([ORDTYPES.index(inst.ordType) for inst in insts], dtype=np.int8),
+            'side': np.array([SIDES.index(inst.side) for inst in insts], dtype=np.int8),
+            'pair': np.array([pair_ids[inst.pair] for inst in insts], dtype=np.int32),
+            'price': np.array([inst.price for inst in insts], dtype=dtype),
+            'value': np.array([inst.value for inst in insts], dtype=dtype),
+        }
+        return cls(pairs, columns, [tuple(digits[pair]) for pair in pairs] if fixed else None)
+
+    def __len__(self) -> int:
+        return len(self.columns['ts'])
+
+    def __getitem__(self, index: int) -> Instruction:
+        if index < 0:
+            index += len(self)
+        columns = self.columns
+        inst = Instruction(ORDTYPES[columns['ordType'][index]], SIDES[columns['side'][index]], int(columns['ts'][index]))
+        inst.pair = self.pairs[columns['pair'][index]]
+        if self.digits is None:
+            inst.price = float(columns['price'][index])
+            inst.value = float(columns['value'][index])
+        else:
+            inst.price = int(columns['price'][index])
+            inst.value = int(columns['value'][index])
+            inst.digits = self.digits[columns['pair'][index]]
+        return inst
+
+    def __iter__(self) -> Iterator[Instruction]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_columnar(path: str,
+                   bt_period: Tuple[int, int],
+                   books: Dict[str, Book],
+                   insts: List[Instruction],
+                   referredBalance: BalancesHistory,
+                   seed: Any = None,
+                   manifest: Optional[Dict[str, Any]] = None,
+                   ) -> None:
+    '''
+    将测例以列式格式写入目录 path
+    '''
+    os.makedirs(path, exist_ok=True)
+    pairs = sorted(books)
+    for pair in pairs:
+        _save_columns(os.path.join(path, 'books', pair), books[pair].columns())
+    inst_columns = InstructionColumns.encode(insts)
+    _save_columns(os.path.join(path, 'insts'), inst_columns.columns)
+    ledger = BalanceLedger.from_history(referredBalance)
+    _save_columns(os.path.join(path, 'reference'), ledger.columns())
+    header = {
+        'version': FORMAT_VERSION,
+        'seed': seed,
+        'bt_period': list(bt_period),
+        'pairs': pairs,
+        'instPairs': inst_columns.pairs,
+        'currencies': ledger.currencies,
+        'checkpointInterval': ledger.checkpointInterval,
+        # 定点模式下各部分的小数位数, 非定点模式下为 None
+        'bookDigits': {pair: books[pair].digits for pair in pairs if books[pair].digits is not None} or None,
+        'instDigits': inst_columns.digits,
+        'digits': ledger.digits,
+        'manifest': manifest, # 见 TestFactory.caseManifest
+    }
+    with open(os.path.join(path, HEADER_FILE), 'w', encoding='utf-8') as f:
+        json.dump(header, f, indent=4)
+
+
+class ColumnarReader:
+    '''
+    以内存映射的方式读取列式测例, books/insts/referredBalance 均为不复制数据的视图
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE), 'r', encoding='utf-8') as f:
+            self.header: Dict[str, Any] = json.load(f)
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported format version {self.header['version']}")
+        self.seed: Optional[int] = self.header['seed']
+        self.bt_period: Tuple[int, int] = tuple(self.header['bt_period'])
+        bookDigits = self.header.get('bookDigits') or {}
+        self.books: Dict[str, DeltaBook] = {
+            pair: DeltaBook.from_columns(pair, _load_columns(os.path.join(path, 'books', pair), BOOK_COLUMNS),
+                                         _digits(bookDigits.get(pair)))
+            for pair in self.header['pairs']
+        }
+        instDigits = self.header.get('instDigits')
+        self.insts = InstructionColumns(self.header['instPairs'], _load_columns(os.path.join(path, 'insts'), INST_COLUMNS),
+                                        [_digits(x) for x in instDigits] if instDigits is not None else None)
+        self.referredBalance = BalanceLedger.from_columns(
+            self.header['currencies'],
+            self.header['checkpointInterval'],
+            _load_columns(os.path.join(path, 'reference'), REFERENCE_COLUMNS),
+            self.header.get('digits'),
+        )
+
+    def testcase(self):
+        '''
+        以 TestCase 的形式访问测例
+        '''
+        from TestCase import TestCase
+        return TestCase(self.bt_period, self.books, self.insts, self.referredBalance, self.seed, self.header.get('manifest'))
+
+
+def test_ColumnarReader():
+    # 写出后经内存映射读回的订单簿, 指令和参考余额与原测例相同
+    import tempfile
+    from benchmark import fixture_factory
+    for storage, fixedPoint in (('list', False), ('delta', True), ('lazy', False), ('lazy', True)):
+        tf = fixture_factory(4)
+        tf.bookStorage, tf.fixedPoint = storage, fixedPoint
+        tc = tf.produce(3, 1500, seed=6)
+        with tempfile.TemporaryDirectory() as d:
+            tc.to_columnar(d)
+            reader = ColumnarReader(d)
+            assert sorted(reader.books) == sorted(tc.books)
+            for pair, book in tc.books.items():
+                loaded = reader.books[pair]
+                assert len(loaded) == len(book) and loaded.asdict() == book.asdict()
+                for (ts1, x), (ts2, y) in zip(book, loaded):
+                    assert ts1 == ts2
+                    assert np.array_equal(x.askLevels, y.askLevels) and np.array_equal(x.bidLevels, y.bidLevels)
+            assert [x.asdict() for x in reader.insts] == [x.asdict() for x in tc.insts]
+            assert reader.referredBalance.asdict() == tc.referredBalance.asdict()
+            timestamps = [ts for ts, _ in tc.referredBalance.iterdicts()]
+            for t in timestamps + [ts + 1 for ts in timestamps]:
+                assert reader.referredBalance.at(t).asdict() == tc.referredBalance.at(t).asdict()
+            assert reader.testcase().asdict() == tc.asdict()
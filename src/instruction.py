@@ -1,4 +1,5 @@
-from typing import Dict
+from typing import Optional, Tuple
+from utils.fixedpoint import format_units
 
 LIMITORDER = 'LimitOrder'
 MARKETORDER = 'MarketOrder'
@@ -20,6 +21,7 @@ class Instruction:
         self.price: float = 0 # 对于MARKETORDER, 该值无意义
         self.value: float = 0 # 委托量
         self.pair: str = '' # 交易对
+        self.digits: Optional[Tuple[int, int]] = None # 定点模式下 price/value 为整数单位, digits 为 (价格, 数量) 的小数位数
 
     @property
     def baseCcy(self) -> str:
@@ -30,11 +32,14 @@ class Instruction:
         return self.pair.split('-')[1]
     
     def asdict(self):
+        price, value = self.price, self.value
+        if self.digits is not None: # 定点模式下输出十进制字符串
+            price, value = format_units(price, self.digits[0]), format_units(value, self.digits[1])
         return {
             'ordType': self.ordType,
             'side': self.side,
             'ts': self.ts,
-            'price': self.price,
-            'value': self.value,
+            'price': price,
+            'value': value,
             'pair': self.pair
         }
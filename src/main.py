@@ -0,0 +1,49 @@
+import argparse
+from testfactory import TestFactory
+from utils.marketdata import SnapshotProvider
+from metrics import Metrics, JsonLinesSink
+
+'''
+批量生成测例
+例: python main.py -n 1000 -w 8 --pairs 3 --points 3600 --seed 42 --dest ./cases
+'''
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate test cases for back-test frameworks')
+    parser.add_argument('-n', '--num', type=int, default=None, help='number of test cases, defaults to TestFactory.testNum')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--pairs', type=int, default=3, help='number of pairs in each test case')
+    parser.add_argument('--points', type=int, default=100, help='length of the back-test period in time steps (see --resolution)')
+    parser.add_argument('--seed', type=int, default=None, help='root seed; the seed of each test case is derived from it')
+    parser.add_argument('--dest', default='./', help='directory of the generated test cases')
+    parser.add_argument('--prices', default=None, help='price snapshot file (see utils/marketdata.py); fetched from OKX if omitted')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint directory; a rerun resumes unfinished test cases from it')
+    parser.add_argument('--metrics', default=None, help='JSON lines file for stage timings and counters')
+    parser.add_argument('--profile', nargs='*', default=[], 
+                        help='stages to run under cProfile/tracemalloc (insts, askbids, fill, book, ledger); requires --metrics')
+    parser.add_argument('--format', choices=['json', 'txt', 'npy', 'chunk'], default='json', help='output format, see TestCase.save')
+    parser.add_argument('--book', choices=['list', 'delta', 'lazy'], default='delta', 
+                        help='order book storage; lazy books keep only the instruction index and regenerate slices on demand')
+    parser.add_argument('--fixed-point', action='store_true', 
+                        help='store prices, sizes and balances as integer multiples of tick/lot sizes and write exact decimal strings')
+    parser.add_argument('--shards', type=int, default=None, 
+                        help='split each test case into this many time shards generated in parallel by --workers processes')
+    parser.add_argument('--fill', choices=['top', 'depth'], default='top', 
+                        help='top: every instruction is filled by one order book level; depth: limit orders walk the book and may fill partially')
+    parser.add_argument('--resolution', type=int, default=1000, 
+                        help='length of a time step in milliseconds; price volatility is scaled so that it is unchanged per second')
+    parser.add_argument('--stream-chunk', type=int, default=None, 
+                        help='generate each test case as a stream of segments of this many time steps, in bounded memory (txt/chunk formats)')
+    args = parser.parse_args()
+
+    marketData = SnapshotProvider.load(args.prices) if args.prices else None
+    metrics = Metrics(JsonLinesSink(args.metrics), args.profile) if args.metrics else None
+    tf = TestFactory(destPath=args.dest, seed=args.seed, marketData=marketData, metrics=metrics, 
+                     bookStorage=args.book, fixedPoint=args.fixed_point, fillMode=args.fill, resolution=args.resolution)
+    paths = tf.produce_many(args.num, args.pairs, args.points, args.workers, fmt=args.format, 
+                           checkpointDir=args.checkpoint, shards=args.shards, chunkPoints=args.stream_chunk)
+    print(f'root seed: {tf.seed}')
+    print(f'generated {len(paths)} test cases in {args.dest}')
+
+if __name__ == '__main__':
+    main()
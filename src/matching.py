@@ -0,0 +1,131 @@
+from typing import Dict, Optional, Tuple, Union
+import numpy as np
+from Book import Book, ASK, BID
+from instruction import Instruction, LIMITORDER, MARKETORDER, BUY
+
+'''
+参考撮合引擎
+根据生成的订单簿计算交易指令的成交数量和成交金额, 供 TestFactory.calBalanceHist 计算参考余额.
+NOTICE: 当前的MetaTest只支持'即时性'的交易指令(IOC): 不能立即成交的部分马上被撤销, 成交也不会改变订单簿
+'''
+
+Number = Union[int, float] # 定点模式下为整数单位
+
+def _scalar(value) -> Number:
+    return value.item() if isinstance(value, np.generic) else value
+
+class SideDepth:
+    '''
+    订单簿某一方向的价格档位(按价格从优到劣排序)及其累计数量和累计金额的前缀和
+    由已排序的档位构建的复杂度为 O(depth), 之后每次成交的复杂度为 O(log depth)
+    '''
+    __slots__ = ('side', 'price', 'cumSize', 'cumValue', '_key')
+
+    def __init__(self, levels: np.ndarray, side: int) -> None:
+        levels = levels[levels['size'] > 0] # 置零的档位不能成交
+        price, size = levels['price'], levels['size']
+        if price.dtype.kind == 'i' and len(levels) > 0 and int(price.max()) * int(size.sum()) >= 2**63:
+            # 整数单位的累计金额可能超出 int64, 改用 Python 整数
+            price, size = price.astype(object), size.astype(object)
+        self.side = side
+        self.price: np.ndarray = price
+        self.cumSize: np.ndarray = np.cumsum(size)
+        self.cumValue: np.ndarray = np.cumsum(price * size)
+        self._key: np.ndarray = self.price if side == ASK else -self.price # 升序的查找键
+
+    def available(self, limit: Optional[Number] = None) -> int:
+        '''
+        价格不劣于 limit 的档位数量, limit 为 None 时为全部档位
+        '''
+        if limit is None:
+            return len(self.price)
+        return int(np.searchsorted(self._key, limit if self.side == ASK else -limit, side='right'))
+
+    def fill(self, size: Number, limit: Optional[Number] = None) -> Tuple[Number, Number]:
+        '''
+        从最优价开始吃掉 size 数量的档位, 返回 (成交数量, 成交金额); 未成交的部分被撤销
+        '''
+        n = self.available(limit)
+        if n == 0 or size <= 0:
+            return (0, 0)
+        if size >= self.cumSize[n-1]: # 可成交的档位全部被吃掉
+            return (_scalar(self.cumSize[n-1]), _scalar(self.cumValue[n-1]))
+        k = int(np.searchsorted(self.cumSize[:n], size, side='left')) # 第一个累计数量不小于 size 的档位
+        if k == 0:
+            return (size, size * _scalar(self.price[0]))
+        before = _scalar(self.cumSize[k-1])
+        return (size, _scalar(self.cumValue[k-1]) + (size - before) * _scalar(self.price[k]))
+
+class MatchingEngine:
+    '''
+    以 books 中的订单簿为对手盘撮合交易指令
+    买单吃卖单, 卖单吃买单; 市价单不限价格, 限价单只吃价格不劣于 inst.price 的档位
+    NOTICE: 定点模式下 books 和 inst 均为整数单位, 成交金额的单位为 10**-(tickDigits+lotDigits)
+    NOTICE: 每条指令的开销为 Book.levelsAt 取出切片的档位(Book 为 O(log slices), DeltaBook 需要重建切片, 
+            O(depth log depth)), 加上构建 SideDepth 的 O(depth) 和成交的 O(log depth).
+            生成的指令时间戳严格递增, 且每个切片至多对应一条指令, 因此不缓存 SideDepth
+    '''
+    def __init__(self, books: Dict[str, Book]) -> None:
+        self.books = books
+
+    def depth(self, pair: str, timestamp: int, side: int) -> SideDepth:
+        return SideDepth(self.books[pair].levelsAt(timestamp, side), side)
+
+    def execute(self, inst: Instruction) -> Tuple[Number, Number]:
+        '''
+        返回 inst 的 (成交数量, 成交金额)
+        '''
+        side = ASK if inst.side == BUY else BID
+        if inst.ordType == MARKETORDER:
+            limit = None
+        elif inst.ordType == LIMITORDER:
+            limit = inst.price
+        else:
+            raise Exception('Unknown ordType: {}'.format(inst.ordType))
+        return self.depth(inst.pair, inst.ts, side).fill(inst.value, limit)
+
+class TopLevelMatcher:
+    '''
+    假定每个交易指令都被一档订单以 inst.price 完全成交, 不需要访问订单簿
+    NOTICE: 与 TestFactory.genBook 在 'top' 模式下生成的订单簿一致: 指令档位即为最优档位且数量足够
+    '''
+    def execute(self, inst: Instruction) -> Tuple[Number, Number]:
+        return (inst.value, inst.value * inst.price)
+
+
+def _inst(ordType: str, side: str, ts: int, value: Number, price: Number = 0) -> Instruction:
+    inst = Instruction(ordType, side, ts)
+    inst.pair, inst.value, inst.price = 'BTC-USDT', value, price
+    return inst
+
+def _book() -> Book:
+    book = Book('BTC-USDT')
+    book.add_slice(1000, [(101, 1), (102, 2), (103, 3)], [(99, 1), (98, 2), (97, 3)])
+    book.add_slice(2000, [(201, 1), (202, 2)], [(199, 1), (198, 2)])
+    return book
+
+def test_MatchingEngine():
+    from instruction import SELL
+    engine = MatchingEngine({'BTC-USDT': _book()})
+    # 部分吃掉第二档
+    assert engine.execute(_inst(MARKETORDER, BUY, 1000, 2)) == (2, 101 + 102)
+    assert engine.execute(_inst(MARKETORDER, SELL, 1500, 2.5)) == (2.5, 99 + 98 * 1.5)
+    # 限价单只吃价格不劣于限价的档位, 剩余部分被撤销(IOC)
+    assert engine.execute(_inst(LIMITORDER, BUY, 1000, 5, 102)) == (3, 101 + 102 * 2)
+    assert engine.execute(_inst(LIMITORDER, SELL, 1000, 5, 98)) == (3, 99 + 98 * 2)
+    # 限价劣于最优价时不成交
+    assert engine.execute(_inst(LIMITORDER, BUY, 1000, 1, 100)) == (0, 0)
+    # 市价单超过全部深度时只成交全部深度
+    assert engine.execute(_inst(MARKETORDER, BUY, 1999, 10)) == (6, 101 + 102 * 2 + 103 * 3)
+    # 成交不改变订单簿, 下一切片生效后使用新的档位
+    assert engine.execute(_inst(MARKETORDER, BUY, 1000, 2)) == (2, 101 + 102)
+    assert engine.execute(_inst(MARKETORDER, BUY, 2000, 2)) == (2, 201 + 202)
+    assert engine.execute(_inst(LIMITORDER, SELL, 2500, 4, 198)) == (3, 199 + 198 * 2)
+
+def test_SideDepth():
+    levels = _book().levelsAt(1000, ASK)
+    levels['size'][0] = 0 # 置零的档位不能成交
+    depth = SideDepth(levels, ASK)
+    assert depth.available() == 2 and depth.available(102) == 1 and depth.available(101) == 0
+    assert depth.fill(1) == (1, 102)
+    assert depth.fill(0) == (0, 0)
@@ -0,0 +1,175 @@
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterable, Optional
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+'''
+生成过程的指标: 各阶段耗时, 计数器和内存峰值
+默认使用 NullMetrics, 不产生任何开销; 需要时为 TestFactory 指定 Metrics 及其输出(sink).
+'''
+
+class MetricsSink:
+    '''
+    指标的输出
+    '''
+    def emit(self, record: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class JsonLinesSink(MetricsSink):
+    '''
+    以 JSON lines 的形式追加写入文件, 可以在多个进程之间共享同一个文件
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class CallbackSink(MetricsSink):
+    '''
+    将每条指标交给回调函数处理
+    NOTICE: produce_many 和 produce_sharded 会把 metrics 发送给工作进程, 此时回调必须可以被 pickle
+            (模块级的函数), lambda 和闭包会被 TestFactory.checkPicklable 拒绝
+    '''
+    def __init__(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        self.callback = callback
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        self.callback(record)
+
+
+def _maxrss_mb() -> Optional[float]:
+    '''
+    进程的内存峰值(单位: MB)
+    '''
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # macOS 下 ru_maxrss 的单位为字节
+        return maxrss / 2**20
+    return maxrss / 1024 # Linux 下 ru_maxrss 的单位为 KB
+
+
+class NullMetrics:
+    '''
+    不记录任何指标
+    '''
+    enabled = False
+
+    def stage(self, name: str, **fields) -> Any:
+        return nullcontext()
+
+    def count(self, name: str, n: int = 1) -> None:
+        pass
+
+    def event(self, name: str, **fields) -> None:
+        pass
+
+    def flush(self, **fields) -> None:
+        pass
+
+
+class Metrics(NullMetrics):
+    '''
+    记录各阶段耗时, 计数器和内存峰值并输出到 sink
+    profile: 需要剖析的阶段名称, 这些阶段会在 cProfile 和 tracemalloc 下执行, 
+             报告写入 profileDir 下的 <stage>.prof 和 <stage>.tracemalloc.txt
+    profileDir: 未指定时由 TestFactory 设为 destPath 下的 profile 目录
+    '''
+    enabled = True
+
+    def __init__(self, 
+                sink: MetricsSink, 
+                profile: Iterable[str] = (), 
+                profileDir: Optional[str] = None,
+                ) -> None:
+        self.sink = sink
+        self.profile = set(profile)
+        self.profileDir = profileDir
+        self.context: Dict[str, Any] = {} # 附加在每条指标上的字段, 如测例的种子
+        self.counters: Dict[str, int] = {}
+
+    def _emit(self, record: Dict[str, Any]) -> None:
+        record.update(self.context)
+        self.sink.emit(record)
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        '''
+        记录一个阶段的耗时和结束时的内存峰值
+        '''
+        profiler = None
+        if name in self.profile and self.profileDir is not None:
+            profiler = cProfile.Profile()
+            tracemalloc.start()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            record: Dict[str, Any] = {'type': 'stage', 'name': name, 'wall': wall, 'maxrss_mb': _maxrss_mb()}
+            record.update(fields)
+            if profiler is not None:
+                profiler.disable()
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                self._write_profile(name, fields, profiler, tracemalloc.take_snapshot())
+                tracemalloc.stop()
+            self._emit(record)
+
+    def _write_profile(self, name: str, fields: Dict[str, Any], profiler: cProfile.Profile, snapshot) -> None:
+        os.makedirs(self.profileDir, exist_ok=True)
+        stem = '-'.join([name] + [str(v) for v in fields.values()])
+        profiler.dump_stats(os.path.join(self.profileDir, f'{stem}.prof'))
+        with open(os.path.join(self.profileDir, f'{stem}.tracemalloc.txt'), 'w', encoding='utf-8') as f:
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(str(stat) + '\n')
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, name: str, **fields) -> None:
+        record: Dict[str, Any] = {'type': 'event', 'name': name}
+        record.update(fields)
+        self._emit(record)
+
+    def flush(self, **fields) -> None:
+        '''
+        输出并清空计数器
+        '''
+        record: Dict[str, Any] = {'type': 'counters', 'counters': self.counters, 'maxrss_mb': _maxrss_mb()}
+        record.update(fields)
+        self._emit(record)
+        self.counters = {}
+
+
+def test_maxrss_mb():
+    # ru_maxrss 的单位与平台有关
+    global resource
+    class FakeResource:
+        RUSAGE_SELF = 0
+        class getrusage:
+            ru_maxrss = 300 * 2**20
+            def __init__(self, who: int) -> None:
+                pass
+    saved, platform = resource, sys.platform
+    resource = FakeResource
+    try:
+        sys.platform = 'darwin'
+        assert _maxrss_mb() == 300
+        sys.platform = 'linux'
+        assert _maxrss_mb() == 300 * 1024
+    finally:
+        resource, sys.platform = saved, platform
@@ -0,0 +1,247 @@
+import json
+import os
+from copy import copy, deepcopy
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from AskBids import AskBids
+from Book import Book
+from Balance import Balance, BalancesHistory
+from TestCase import TestCase
+from checkpoint import CheckpointStore, fingerprint
+from instruction import Instruction
+from testfactory import TestFactory, ManifestVersion
+
+'''
+按清单重新生成测例
+TestCase.manifest 记录了生成测例时每个阶段和交易对所用的种子及参数, CaseReplay 可以只重新生成某个交易对的价格序列,
+订单簿或填充后的指令, 或者某个阶段, 结果与原测例逐位相同. 各个交易对的随机数流互相独立, 因此只需生成所请求的交易对.
+例:
+    replay = CaseReplay(TestFactory(), load_manifest('./cases/testcase-3.json'), checkpointDir='./replay-3')
+    book = replay.book('BTC-USDT')
+'''
+
+Stages = ['insts', 'askbids', 'fill', 'book', 'ledger']
+
+def load_manifest(path: str) -> Dict[str, Any]:
+    '''
+    从任意格式(见 TestCase.save)的测例文件中读取清单
+    '''
+    from verify import detect_format
+    fmt = detect_format(path)
+    if fmt == 'json':
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f).get('manifest')
+    elif fmt == 'txt':
+        from writer import MARKET_FILE
+        with open(os.path.join(path, MARKET_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.loads(f.readline()).get('manifest')
+    elif fmt == 'npy':
+        from columnar import ColumnarReader
+        manifest = ColumnarReader(path).header.get('manifest')
+    else:
+        from chunked import ChunkedReader
+        with ChunkedReader(path) as reader:
+            manifest = reader.header.get('manifest')
+    if manifest is None:
+        raise ValueError(f"Test case {path} has no manifest")
+    return manifest
+
+
+class CaseReplay:
+    '''
+    按清单重新生成测例的各个部分
+    每个结果都以 (阶段, 分片, 交易对) 为单位缓存在内存中; 给定 checkpointDir 时同时保存为检查点,
+    重新运行时直接读取. regenerate 强制重新计算某个阶段, 其依赖仍然从缓存中读取.
+    NOTICE: factory 只提供产品信息, 其余参数均以清单为准; 产品信息与生成测例时不同会抛出 ValueError
+    '''
+    def __init__(self, factory: TestFactory, manifest: Dict[str, Any], checkpointDir: Optional[str] = None) -> None:
+        if manifest.get('version') != ManifestVersion:
+            raise ValueError(f"Unsupported manifest version {manifest.get('version')}")
+        params = manifest['params']
+        if params['instruments'] != factory.registry.fingerprint:
+            raise ValueError("The instrument metadata differs from the one used to generate the test case")
+        self.manifest = manifest
+        self.factory = copy(factory)
+        for name in ('secPerInst', 'bookStorage', 'fixedPoint', 'fillMode', 'limitRate'):
+            setattr(self.factory, name, params[name])
+        self.factory.resolution = params.get('resolution', 1000) # 早期的清单没有 resolution, 时间粒度均为 1 秒
+        self.factory.caseSeed = manifest['seed']
+        self.factory.refPrices = manifest['prices']
+        self.bt_period: Tuple[int, int] = tuple(manifest['bt_period'])
+        self.segments: List[Dict[str, Any]] = manifest['segments']
+        self.store = CheckpointStore(checkpointDir) if checkpointDir is not None else None
+        self._key = fingerprint(manifest)
+        self._cache: Dict[str, Any] = {}
+        for j in range(len(self.segments)): # 种子的导出规则改变时, 结果不可能逐位相同
+            seeds = self._segment(j)['seeds']
+            if seeds['insts'] != self.factory.stageSeed('insts') or \
+               any(seed != self.factory.stageSeed(stage, pair) for stage in ('askbids', 'fill', 'book')
+                   for pair, seed in seeds[stage].items()):
+                raise ValueError("The manifest seeds do not match the seed derivation of this TestFactory")
+
+    def _segment(self, j: int) -> Dict[str, Any]:
+        segment = self.segments[j]
+        self.factory.shard = segment['shard']
+        return segment
+
+    def _run(self, name: str, fn: Callable[[], Any], force: bool = False) -> Any:
+        '''
+        先查内存, 再查检查点, 都没有时执行 fn; force 为 True 时总是执行 fn 并覆盖缓存
+        '''
+        if not force and name in self._cache:
+            return self._cache[name]
+        if self.store is None:
+            obj = fn()
+        elif force:
+            obj = fn()
+            self.store.save(name, self._key, obj)
+        else:
+            obj = self.store.run(name, self._key, fn)
+        self._cache[name] = obj
+        return obj
+
+    def _check_pair(self, pair: str) -> None:
+        if pair not in self.segments[0]['p0s']:
+            raise ValueError(f"Pair {pair} has no price path in this test case")
+
+    def _rawInsts(self, j: int, force: bool = False) -> List[Instruction]:
+        '''
+        第 j 个分片中尚未填充的指令(全部交易对)
+        '''
+        def gen():
+            segment = self._segment(j)
+            return self.factory.genInsts((segment['period'][0], segment['end']), self.manifest['pairs'])
+        return self._run(f'insts-{j}', gen, force)
+
+    def _askbids(self, j: int, pair: str, force: bool = False) -> AskBids:
+        def gen():
+            segment = self._segment(j)
+            p1s = {pair: segment['p1s'][pair]} if segment['p1s'] is not None else None
+            return self.factory.genAskBidsBatch([pair], {pair: segment['p0s'][pair]}, tuple(segment['period']), p1s=p1s)[pair]
+        return self._run(f'askbids-{j}-{pair}', gen, force)
+
+    def _insts(self, j: int, pair: str, force: bool = False) -> List[Instruction]:
+        '''
+        第 j 个分片中 pair 的填充后的指令, 按时间排序
+        '''
+        def gen():
+            insts = [deepcopy(inst) for inst in self._rawInsts(j) if inst.pair == pair] # fillInsts 会修改指令
+            askbids = self._askbids(j, pair)
+            self._segment(j)
+            return self.factory.fillInsts({pair: askbids}, insts, self.manifest['prices'])
+        return self._run(f'fill-{j}-{pair}', gen, force)
+
+    def _book(self, j: int, pair: str, force: bool = False) -> Book:
+        def gen():
+            insts, askbids = self._insts(j, pair), self._askbids(j, pair)
+            segment = self._segment(j)
+            return self.factory.genBook(tuple(segment['period']), insts, askbids, pair)
+        return self._run(f'book-{j}-{pair}', gen, force)
+
+    @property
+    def pairs(self) -> List[str]:
+        '''
+        有交易指令的交易对, 即测例的 books 中的交易对
+        '''
+        return sorted(set(inst.pair for j in range(len(self.segments)) for inst in self._rawInsts(j)))
+
+    def askbids(self, pair: str) -> AskBids:
+        '''
+        pair 在整个回测区间内的价格序列
+        '''
+        self._check_pair(pair)
+        parts = [self._askbids(j, pair) for j in range(len(self.segments))]
+        if len(parts) == 1:
+            return parts[0]
+        return AskBids(np.concatenate([x.timestamps for x in parts]),
+                       np.concatenate([x.asks for x in parts]), np.concatenate([x.bids for x in parts]))
+
+    def insts(self, pair: Optional[str] = None) -> List[Instruction]:
+        '''
+        填充后的指令, pair 为 None 时为全部交易对的指令, 顺序与原测例相同
+        '''
+        pairs = self.pairs if pair is None else [pair]
+        for x in pairs:
+            self._check_pair(x)
+        insts = [inst for j in range(len(self.segments)) for x in pairs for inst in self._insts(j, x)]
+        return sorted(insts, key=lambda inst: inst.ts)
+
+    def book(self, pair: str) -> Book:
+        '''
+        pair 的订单簿, 分片生成的测例按时间顺序拼接
+        '''
+        self._check_pair(pair)
+        book = deepcopy(self._book(0, pair)) # 不修改缓存中的订单簿
+        for j in range(1, len(self.segments)):
+            book.extend(self._book(j, pair))
+        return book
+
+    def ledger(self, force: bool = False) -> BalancesHistory:
+        '''
+        参考余额, 依赖全部交易对的指令('depth' 模式下还依赖订单簿)
+        '''
+        def gen():
+            insts = self.insts()
+            books = {pair: self.book(pair) for pair in self.pairs} if self.factory.fillMode == 'depth' else None
+            self.factory.shard = None
+            return self.factory.calBalanceHist(insts, Balance.from_items(self.manifest['balance'].items()), books)
+        return self._run('ledger', gen, force)
+
+    def regenerate(self, stage: str, pair: Optional[str] = None) -> Any:
+        '''
+        强制重新生成 stage 阶段(见 Stages)中 pair 的结果, pair 为 None 时为全部交易对; 依赖的阶段从缓存中读取.
+        返回值与对应的访问方法相同; 'ledger' 阶段与交易对无关
+        NOTICE: 只重新生成该阶段本身; 结果是确定的, 因此已缓存的后续阶段仍然有效
+        '''
+        if stage not in Stages:
+            raise ValueError(f"Unknown stage {stage}")
+        if stage == 'ledger':
+            return self.ledger(force=True)
+        if stage == 'insts':
+            for j in range(len(self.segments)):
+                self._rawInsts(j, force=True)
+            return self.insts(pair)
+        pairs = self.pairs if pair is None else [pair]
+        for x in pairs:
+            self._check_pair(x)
+            for j in range(len(self.segments)):
+                {'askbids': self._askbids, 'fill': self._insts, 'book': self._book}[stage](j, x, force=True)
+        if stage == 'askbids':
+            return {x: self.askbids(x) for x in pairs} if pair is None else self.askbids(pair)
+        if stage == 'fill':
+            return self.insts(pair)
+        return {x: self.book(x) for x in pairs} if pair is None else self.book(pair)
+
+    def testcase(self) -> TestCase:
+        '''
+        重新组装整个测例
+        '''
+        books = {pair: self.book(pair) for pair in self.pairs}
+        return TestCase(self.bt_period, books, self.insts(), self.ledger(), self.manifest['seed'], self.manifest)
+
+
+def test_CaseReplay():
+    # 按清单重新生成的测例与原测例逐位相同; 清单在各种格式的文件中往返后不变
+    import tempfile
+    from benchmark import fixture_factory
+    def dumps(tc: TestCase) -> str:
+        return json.dumps(tc.asdict())
+    for storage, fixedPoint, fillMode, shards in [('delta', False, 'top', None), ('list', True, 'depth', None), 
+                                                 ('lazy', False, 'depth', 3), ('delta', True, 'top', 2)]:
+        tf = fixture_factory(5)
+        tf.bookStorage, tf.fixedPoint, tf.fillMode = storage, fixedPoint, fillMode
+        if shards is None:
+            tc = tf.produce(3, 1500, seed=77)
+        else:
+            tc = tf.produce_sharded(3, 1500, shards, workers=1, seed=77)
+        replay = CaseReplay(fixture_factory(), tc.manifest)
+        assert dumps(replay.testcase()) == dumps(tc), (storage, fixedPoint, fillMode, shards)
+        pair = sorted(tc.books)[0]
+        assert json.dumps(replay.regenerate('book', pair).asdict()) == json.dumps(tc.books[pair].asdict())
+        with tempfile.TemporaryDirectory() as d:
+            for fmt, name in [('npy', 'case-npy'), ('json', 'case.json'), ('chunk', 'case.mtc')]:
+                path = os.path.join(d, name)
+                tc.save(path, fmt)
+                manifest = load_manifest(path)
+                assert manifest == json.loads(json.dumps(tc.manifest)), fmt
+                assert dumps(CaseReplay(fixture_factory(), manifest).testcase()) == dumps(tc), fmt
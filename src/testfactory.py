@@ -1,19 +1,41 @@
-from copy import deepcopy
-from typing import List, Dict, Optional, Set, Tuple
+from copy import copy
+from itertools import islice
+from typing import List, Dict, Optional, Set, Tuple, Callable, Iterable
 from TestCase import TestCase
-from utils.instruments import defaultInstruments
+from writer import TextStreamWriter, iter_market, iter_instructions, iter_reference
+from chunked import ChunkWriter
+from checkpoint import CheckpointStore, fingerprint
+from metrics import NullMetrics
+from matching import MatchingEngine, TopLevelMatcher
+from AskBids import AskBids
+from utils.instruments import InstrumentRegistry, load_instruments, get_default_registry
+from utils.marketdata import MarketDataProvider, CachedProvider, LiveProvider
 from utils.helper import *
+from utils.fixedpoint import to_units, rescale, decimal_digits
 from instruction import *
 from Book import *
 from Balance import *
+import math
+import os
+import pickle
 import sys
 import random
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 DefaultSuccessRate = 0.001
 DefaultValuePerCcy = 1000
-
-# TODO: 封装以下类型
-TypeAskBids = List[Tuple[int, Tuple[float, float]]]
+Commission = { # 手续费
+    MARKETORDER: {
+        'MAKER': 0.0008,
+        'TAKER': 0.0010,
+    }
+}
+CommissionDigits = 4 # 定点模式下手续费率的小数位数
+FillModes = ['top', 'depth'] # 见 TestFactory.fillMode
+DepthLevelValue = 5 # 'depth' 模式下订单簿每一档的平均价值(单位: USDT), 约为平均委托量的一半
+MaxPriceChange = 0.03 # 价格序列每一时刻的最大变化百分比
+ManifestVersion = 1 # TestCase.manifest 的格式版本, 见 TestFactory.caseManifest
 
 class TestFactory:
     '''
@@ -29,21 +51,60 @@ class TestFactory:
                 minPairs = 0,
                 successRate = DefaultSuccessRate,
                 destPath = './',
-                instruments : List[Dict] = defaultInstruments,
+                instruments : Optional[List[Dict]] = None,
                 valuePerCcy : float = DefaultValuePerCcy,
+                bookStorage : str = 'delta',
+                seed : Optional[int] = None,
+                marketData : Optional[MarketDataProvider] = None,
+                metrics : Optional[NullMetrics] = None,
+                fixedPoint : bool = False,
+                fillMode : str = 'top',
+                limitRate : float = 0.5,
+                resolution : int = 1000,
                 ) -> None:
-        self.testNum : int = testNum # 生成的metatest的数量
+        self.testNum : int = testNum # produce_many 默认生成的metatest的数量
         self.maxSec : int = maxSec # 最长回测时长(单位: 秒), 默认最长一天
         self.minSec : int = minSec # 最短回测时长(单位: 秒), 默认最短一小时
-        self.secPerInst : int = secPerInst # 平均发出一次指令的时间间隔(单位: 秒)
+        self.secPerInst : int = secPerInst # 平均发出一次指令的时间间隔(单位: 时间步, 默认的时间步为 1 秒)
         self.maxPairs = maxPairs # 回测涉及到的交易对的最大数量
         self.minPairs = minPairs # 回测涉及到的交易对的最小数量
         self.successRate = successRate # 交易指令成功的概率
         self.destPath = destPath # 测例存放的路径
-        self.instruments = instruments # 产品信息
+        if instruments is None: # 使用默认的产品信息, 在第一次使用时才加载
+            self.instruments = load_instruments('SPOT') # 产品信息
+            self.registry = get_default_registry('SPOT') # 以 instId 为索引的产品信息
+        else:
+            self.instruments = instruments
+            self.registry = InstrumentRegistry(instruments)
         self.valuePerCcy = valuePerCcy # Balance中每个币种初始额度(单位: USDT)
+        self.bookStorage = bookStorage # 订单簿的存储方式, 见 Book.BookStorages; 'lazy' 为按需生成的 Book.LazyBook
+        # 定点模式: 价格/数量/余额以 int64 单位存储, 只在序列化时转换为十进制字符串, 见 utils.fixedpoint
+        assert not fixedPoint or bookStorage in ('delta', 'lazy'), "Fixed-point mode requires the delta or lazy book storage"
+        self.fixedPoint : bool = fixedPoint
+        # 成交模式: 'top' 时每个交易指令都被订单簿中对应的一档订单完全成交;
+        # 'depth' 时生成限价单, 订单簿中没有指令档位, 交易指令由 matching.MatchingEngine 逐档撮合
+        assert fillMode in FillModes, f"Unknown fill mode {fillMode}"
+        self.fillMode : str = fillMode
+        self.limitRate : float = limitRate # 'depth' 模式下限价单的比例
+        # 时间粒度(单位: 毫秒), 即价格序列相邻两个时刻的间隔, 最小为 1 毫秒
+        assert isinstance(resolution, int) and resolution >= 1, f"Invalid time resolution {resolution}"
+        self.resolution : int = resolution
+        if marketData is None:
+            marketData = CachedProvider(LiveProvider())
+        self.marketData = marketData # 行情数据来源, 只在生成测例前获取一次价格快照
+        self.metrics = metrics if metrics is not None else NullMetrics() # 各阶段的指标, 见 metrics.Metrics
+        if self.metrics.enabled and self.metrics.profile and self.metrics.profileDir is None:
+            # 未指定剖析报告的位置时写在 destPath 下; produce_many 的进程池中每个测例写在测例旁边(见 _produceCase)
+            self.metrics.profileDir = os.path.join(destPath, 'profile')
+        if seed is None:
+            seed = np.random.SeedSequence().entropy % 2**64
+        self.seed : int = seed # 根随机数种子, 各个测例的种子由其导出
+        self.caseSeed : int = seed # 当前测例的随机数种子, 各个步骤的随机数流由其导出
+        self.shard : Optional[int] = None # 按时间分片生成时当前分片的编号, 见 produce_sharded
+        self.refPrices : Optional[Dict[str, float]] = None # 当前测例各交易对的参考价格
+        self._produced : int = 0 # 已经生成的测例数量
     
-    def genBalance(self, pairs: List[str]) -> Balance:
+    def genBalance(self, pairs: List[str], lastPrices: Optional[Dict[str, float]] = None) -> Balance:
         '''
         根据valuePerCcy生成策略的初始账户余额
         NOTICE: 目前只支持SPOT; 后续应该考虑随机化生成
@@ -56,7 +117,8 @@ class TestFactory:
             totalCcy.add(ccy1)
             totalCcy.add(ccy2)
         
-        lastPrices = get_lastPrice('SPOT')
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT')
         for ccy in totalCcy:
             # TODO: 这里的逻辑需要优化
             if ccy in ['USDT', 'USDC']:
@@ -64,50 +126,53 @@ class TestFactory:
                 continue
 
             pair = '-'.join([ccy, 'USDT'])
-            instrument = self.getInstrument(pair)
+            instrument = self.registry[pair]
             price = lastPrices[pair]
-            value = round(self.valuePerCcy/price, get_significant_digits(instrument['lotSz']))
+            value = round(self.valuePerCcy/price, instrument.lotDigits)
             balance[ccy] = value
         return balance
     
     def genBackTestPeriod(self, point: int = 5000) -> Tuple[int, int]:
         '''
-        随机生成一个回测的开始和结束时间, 时间粒度为 1 sec.
+        随机生成一个回测的开始和结束时间, 时间粒度为 resolution 毫秒, 共 point 个时间步
         使用Unix毫秒级时间戳表示
         '''
         start = 1684154233000 # 由于在回测中, 时间段所在的位置并没有什么影响, 故而可以固定为一个值
         # length = random.randint(self.minSec, self.maxSec) # 随机决定回测的时间长度
         length = point
-        end = start + length*1000
+        end = start + length*self.resolution
         return (start, end)
     
     def genInsts(self, time_period : Tuple[int, int], pairs: List[str]) -> List[Instruction]:
         '''
         随机生成一次回测中策略发出的交易指令
         NOTICE: 只填充 ordType 和 side 字段
-        NOTICE: 目前只支持 MarketOrder 类型的交易指令
+        NOTICE: 只有 'depth' 模式下才会生成 LimitOrder, 其比例为 limitRate
         '''
 
+        rand = self.stageRandom('insts')
         # 确定交易指令的发出时刻和数量
         ts = []
         t = time_period[0]
         while t < time_period[1]:
             ts.append(t)
-            t = t + 1000*generate_random_valueInt(self.secPerInst, 0.5) # 随机生成间隔, 基准为secPerInst, 最大偏离50%
+            t = t + self.resolution*generate_random_valueInt(self.secPerInst, 0.5, rand) # 随机生成间隔, 基准为secPerInst, 最大偏离50%
         
         # 生成交易指令
         result = []
         for i in ts:
-            # ordType = LimitOrder if random.randint(0,1) else MarketOrder
-            ordType = MARKETORDER # 暂时只支持市价单
-            side = BUY if random.randint(0,1) else SELL
+            ordType = MARKETORDER
+            if self.fillMode == 'depth' and rand.random() < self.limitRate:
+                ordType = LIMITORDER
+            side = BUY if rand.randint(0,1) else SELL
             inst = Instruction(ordType, side, i)
 
             # 随机决定该指令的交易对
             # totalPairs = self.getTotalPairs(filters=['USDT-', 'USDC-'])
-            inst.pair = random.choice(pairs)
+            inst.pair = rand.choice(pairs)
             result.append(inst)
         
+        self.metrics.count('insts', len(result))
         return result
     
     def genAskBids(self, 
@@ -115,41 +180,68 @@ class TestFactory:
                     p0: float, 
                     time_period : Tuple[int, int], 
                     sigma: float = 1.0
-                    ) -> TypeAskBids:
+                    ) -> AskBids:
         '''
         随机生成AskBid序列
         NOTICE: 生成的AskBid序列的一阶差分符合正态分布
         '''
-        # 获取下单精度
-        tickSz = self.getTickSz(pair)
+        return self.genAskBidsBatch([pair], {pair: p0}, time_period, sigma)[pair]
+    
+    def genAskBidsBatch(self, 
+                        pairs: List[str], 
+                        p0s: Dict[str, float], 
+                        time_period : Tuple[int, int], 
+                        sigma: float = 1.0,
+                        p1s: Optional[Dict[str, float]] = None,
+                        ) -> Dict[str, AskBids]:
+        '''
+        一次性为所有交易对随机生成AskBid序列
+        NOTICE: 每一时刻的变化百分比符合正态分布并被限制在 [-3%, 3%], 价格序列由其累乘得到
+        NOTICE: sigma 和 [-3%, 3%] 是 1 秒的时间粒度下的值, 其它粒度下按 sqrt(resolution/1000) 缩放(见 stepVolatility),
+                使每秒的波动大致不变
+        p1s: 给定时价格序列在 time_period[1] 的下一时刻恰好到达 p1s[pair], 用于衔接相邻的时间分片;
+             对数收益率被均匀修正, 因此变化百分比可能略微超出 [-3%, 3%]
+        '''
+        time_range = (time_period[1]-time_period[0])//self.resolution + 1
+        timestamps = time_period[0] + self.resolution*np.arange(time_range, dtype=np.int64)
+        sigma, limit = self.stepVolatility(sigma)
+        instruments = [self.registry[pair] for pair in pairs]
         
         # 生成基准价格
-        time_range = int((time_period[1]-time_period[0])/1000) + 1
-        prices = [(time_period[0], p0)]
-        for i in range(1, time_range):
-            delta_percent = random.normalvariate(0, sigma) # 变化百分比, 符合正态分布
-            delta_percent = max(delta_percent, -0.03) # 限制变化范围
-            delta_percent = min(delta_percent, 0.03)
-            
-            delta = prices[-1][1] * delta_percent # 变化绝对值
-            next_price = prices[-1][1] + delta
-            prices.append((time_period[0]+1000*i, next_price))
+        factors = np.empty((len(pairs), time_range))
+        factors[:, 0] = [p0s[pair] for pair in pairs]
+        gaps = np.empty((len(pairs), time_range))
+        for i, pair in enumerate(pairs): # 每个交易对使用独立的随机数流
+            rng = self.stageRng('askbids', pair)
+            if p1s is None: # 变化百分比, 符合正态分布并限制变化范围
+                factors[i, 1:] = 1 + np.clip(rng.normal(0, sigma, time_range-1), -limit, limit)
+            else: # 多生成一步到达下一时刻, 再修正对数收益率使其总和恰好为 log(p1/p0)
+                returns = np.log1p(np.clip(rng.normal(0, sigma, time_range), -limit, limit))
+                returns += (np.log(p1s[pair] / p0s[pair]) - returns.sum()) / time_range
+                factors[i, 1:] = np.exp(returns[:-1])
+            gaps[i] = rng.uniform(0, 0.01, time_range)
+        prices = np.cumprod(factors, axis=1)
         
         # 生成 ask 和 bid
-        askbids = []
-        for p in prices:
-            # FIXME: 这里生成的ask和bid间的价差通常只差一个tickSz
-            gap_t = round(random.uniform(0, 0.01) * p[1], get_significant_digits(tickSz))
-            price_gap = max(tickSz, gap_t) # 生成ask和bid间的价差
-            bid = p[1]
-            ask = p[1] + price_gap
-            askbids.append((p[0], (ask, bid)))
+        # FIXME: 这里生成的ask和bid间的价差通常只差一个tickSz
+        scale = np.array([10.0**x.tickDigits for x in instruments])[:, None]
+        gap_t = np.rint(gaps * prices * scale) / scale
+        price_gap = np.maximum(np.array([x.tickSz for x in instruments])[:, None], gap_t) # 生成ask和bid间的价差
+        asks = prices + price_gap
         
-        return askbids
+        return {pair: AskBids(timestamps, asks[i], prices[i]) for i, pair in enumerate(pairs)}
     
+    def stepVolatility(self, sigma: float) -> Tuple[float, float]:
+        '''
+        每个时间步的变化百分比的标准差和上限: 按 1 秒给出的 sigma 和 MaxPriceChange 乘以 sqrt(resolution/1000)
+        '''
+        scale = math.sqrt(self.resolution / 1000)
+        return sigma * scale, MaxPriceChange * scale
+
     def fillInsts(self, 
-                totalAskBids: Dict[str, TypeAskBids], 
-                insts: List[Instruction]
+                totalAskBids: Dict[str, AskBids], 
+                insts: List[Instruction],
+                lastPrices: Optional[Dict[str, float]] = None,
                 ) -> List[Instruction]:
         '''
         填充交易指令的剩余部分
@@ -160,232 +252,937 @@ class TestFactory:
         NOTICE: 前的MetaTest假设交易的成交不会对订单簿产生影响(当然这只在交易量非常小的情况下近似成立).
                 此外, 不同的时刻的订单簿都是相互独立的, 彼此间没有连续性可言(这当然是不成立的, 
                 但用于测试回测系统的正确性应该是足够了)
+        NOTICE: 按交易对分组批量填充; lastPrices 为参考价格快照, 缺省时才会请求最新价格
         '''
-        prices = get_lastPrice('SPOT') # 目前只支持 SPOT
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT') # 目前只支持 SPOT
+        groups: Dict[str, List[Instruction]] = {}
         for inst in insts:
-            askbids = totalAskBids[inst.pair] # 选择指定的askbids
-            # FIXME: Remove the following assertion
-            assert len(list(filter(lambda x: x[0] == inst.ts, askbids))) == 1
-            askbid = list(filter(lambda x: x[0] == inst.ts, askbids))[0]
-
+            groups.setdefault(inst.pair, []).append(inst)
+        
+        for pair, group in groups.items():
+            askbids = totalAskBids[pair] # 选择指定的askbids
+            index = askbids.indices([inst.ts for inst in group])
+            is_buy = np.array([inst.side == BUY for inst in group])
             # FIXME: 实际上, 对于市价单, 价格应该是没有意义的
-            if inst.side == BUY:
-                inst.price = askbid[1][0]
-            else:
-                inst.price = askbid[1][1]
+            prices = np.where(is_buy, askbids.asks[index], askbids.bids[index])
             
             # 随机生成委托量, 基准值为 10 USDT
-            instrument = self.getInstrument(pair=inst.pair)
-            raw_value = max(random.normalvariate(10, 5), 1) / prices[inst.pair]
-            raw_value = round(raw_value, get_significant_digits(instrument['lotSz']))
-            value = max(float(instrument['minSz']), raw_value)
-            inst.value = value
+            instrument = self.registry[pair]
+            rng = self.stageRng('fill', pair)
+            raw_values = np.maximum(rng.normal(10, 5, len(group)), 1) / lastPrices[pair]
+            if self.fillMode == 'depth': # 限价单的价格偏离对手价 -2 ~ 4 个 tickSz, 偏离为负时不能成交
+                is_limit = np.array([inst.ordType == LIMITORDER for inst in group])
+                ticks = np.where(is_limit, rng.integers(-2, 5, len(group)), 0) * np.where(is_buy, 1, -1)
+            if self.fixedPoint: # 价格和委托量分别取整为 tickSz 和 lotSz 的整数倍
+                prices = to_units(prices, instrument.tickDigits, instrument.tickUnits)
+                if self.fillMode == 'depth':
+                    prices = np.maximum(instrument.tickUnits, prices + ticks * instrument.tickUnits)
+                values = np.maximum(instrument.minUnits, to_units(raw_values, instrument.lotDigits, instrument.lotUnits))
+            else:
+                raw_values = np.round(raw_values, instrument.lotDigits)
+                values = np.maximum(instrument.minSz, raw_values)
+                if self.fillMode == 'depth':
+                    prices = np.maximum(instrument.tickSz, prices + ticks * instrument.tickSz)
+            digits = (instrument.tickDigits, instrument.lotDigits) if self.fixedPoint else None
+            for inst, price, value in zip(group, prices.tolist(), values.tolist()):
+                inst.price = price
+                inst.value = value
+                inst.digits = digits
             
         return insts
 
     def calBalanceHist(self, 
                         insts: List[Instruction],
                         original_balance: Balance,
+                        books: Optional[Dict[str, Book]] = None,
+                        balanceHist: Optional[BalanceLedger] = None,
                         ) -> BalancesHistory:
         '''
         计算不同时刻下的Balance的值
-        NOTICE: 当前只支持OKX的市价单手续费
+        NOTICE: 结果记录在 BalanceLedger 中, 每笔成交只记录被修改的两个币种
+        NOTICE: 给定 books 时由 matching.MatchingEngine 在订单簿上逐档撮合, 可能部分成交, 未成交的部分被撤销;
+                否则假定交易指令被一档订单以 inst.price 完全成交(见 matching.TopLevelMatcher)
+        NOTICE: 当前只支持OKX的 taker 手续费, 限价单都是 IOC 的, 因此同样是 taker
+        NOTICE: 买卖两个方向都按实际成交的数量和金额检查余额, 余额不足时整个指令被拒绝
         NOTICE: 当前只支持 SPOT
+        balanceHist: 继续记录在已有的账本之后(见 BalanceLedger.tail), 此时忽略 original_balance
         '''
-        commission = { # 手续费
-            MARKETORDER: {
-                'MAKER': 0.0008,
-                'TAKER': 0.0010,
-            }
-        }
-        balanceHist = BalancesHistory()
-        balanceHist.append(0, original_balance)
+        matcher = MatchingEngine(books) if books is not None else TopLevelMatcher()
+        if self.fixedPoint:
+            return self.calBalanceHistFixed(insts, original_balance, matcher, balanceHist)
+        commission = Commission
+        if balanceHist is None:
+            balanceHist = BalanceLedger(original_balance, 0)
         traded_num = 0
+        cancelled_num = 0
         for inst in insts:
-            # FIXME: Remove the following assertion
-            assert inst.ordType == MARKETORDER
-            nextBalance = deepcopy(balanceHist[-1][1])            
             baseCcy = inst.baseCcy
             quoteCcy = inst.quoteCcy
             if inst.side == BUY: # get baseCcy
+                size, amount = matcher.execute(inst)
+                if size == 0: # 没有可以成交的档位, 指令被撤销
+                    cancelled_num += 1
+                    continue
                 
                 # Check if the balance is enough
-                traded_quoteCcy = nextBalance[quoteCcy] - (inst.value*inst.price)
+                traded_quoteCcy = balanceHist.value(quoteCcy) - amount
                 if traded_quoteCcy < 0:
                     continue
                 else:
                     traded_num += 1
-                get_amount = inst.value * (1-commission[MARKETORDER]['TAKER'])
-                nextBalance[baseCcy] = nextBalance[baseCcy] + get_amount
-                print(f'nextBalance[baseCcy]: {nextBalance[baseCcy]}, inst.value: {inst.value}')
-                nextBalance[baseCcy] = round(nextBalance[baseCcy], \
-                                            get_significant_digits(self.getLotSz(inst.pair)))
-                nextBalance[quoteCcy] = traded_quoteCcy # FIXME: 也许需要进行舍入?
+                get_amount = size * (1-commission[MARKETORDER]['TAKER'])
+                next_baseCcy = round(balanceHist.value(baseCcy) + get_amount, \
+                                     self.registry[inst.pair].lotDigits)
+                next_quoteCcy = traded_quoteCcy # FIXME: 也许需要进行舍入?
 
             elif inst.side == SELL: # get quoteCcy
+                size, amount = matcher.execute(inst)
+                if size == 0: # 没有可以成交的档位, 指令被撤销
+                    cancelled_num += 1
+                    continue
                 
                 # Check if the balance is enough
-                traded_baseCcy = nextBalance[baseCcy] - inst.value
-                if traded_baseCcy < 0:
+                next_baseCcy = balanceHist.value(baseCcy) - size
+                if next_baseCcy < 0:
                     continue
-                else:
-                    traded_num += 1
-                nextBalance[baseCcy] = traded_baseCcy
-                print(f'{inst.price}: {inst.value}')
-                get_amount = inst.value * inst.price * (1-commission[MARKETORDER]['TAKER'])
-                nextBalance[quoteCcy] = nextBalance[quoteCcy] + get_amount # FIXME: 也许需要进行舍入?
+                traded_num += 1
+                get_amount = amount * (1-commission[MARKETORDER]['TAKER'])
+                next_quoteCcy = balanceHist.value(quoteCcy) + get_amount # FIXME: 也许需要进行舍入?
             else:
                 raise Exception('Unknown side: {}'.format(inst.side))
 
-            balanceHist.append(inst.ts, nextBalance)
+            balanceHist.trade(inst.ts, baseCcy, next_baseCcy, quoteCcy, next_quoteCcy)
         
-        print('Trading rate: {}'.format(traded_num/len(insts)))
+        self.metrics.count('trades_executed', traded_num)
+        self.metrics.count('trades_cancelled', cancelled_num)
+        self.metrics.count('trades_rejected', len(insts) - traded_num - cancelled_num)
         return balanceHist
 
+    def getCcyDigits(self, pairs: Iterable[str], original_balance: Balance) -> Dict[str, int]:
+        '''
+        定点模式下各币种余额的小数位数
+        NOTICE: baseCcy 至少为 lotSz 的小数位数, quoteCcy 至少为 tickSz 与 lotSz 的小数位数之和,
+                因此成交金额(价格 x 数量)不需要舍入
+        '''
+        digits = {ccy: decimal_digits(value) for ccy, value in original_balance.items()}
+        for pair in sorted(set(pairs)):
+            instrument = self.registry[pair]
+            digits[instrument.baseCcy] = max(digits.get(instrument.baseCcy, 0), instrument.lotDigits)
+            digits[instrument.quoteCcy] = max(digits.get(instrument.quoteCcy, 0), instrument.tickDigits + instrument.lotDigits)
+        return digits
+
+    def calBalanceHistFixed(self, 
+                            insts: List[Instruction],
+                            original_balance: Balance,
+                            matcher: Optional[TopLevelMatcher] = None,
+                            balanceHist: Optional[BalanceLedger] = None,
+                            ) -> BalancesHistory:
+        '''
+        calBalanceHist 的定点版本, 余额以整数单位计算
+        NOTICE: 扣除手续费后的数量和金额按币种的小数位数做银行家舍入, 其余运算都是精确的
+        '''
+        if matcher is None:
+            matcher = TopLevelMatcher()
+        keep = 10**CommissionDigits - round(Commission[MARKETORDER]['TAKER'] * 10**CommissionDigits) # 扣除手续费后保留的比例
+        if balanceHist is None:
+            digits = self.getCcyDigits(set(inst.pair for inst in insts), original_balance)
+            balanceHist = BalanceLedger(original_balance, 0, digits=digits)
+        else:
+            digits = balanceHist.digits
+        traded_num = 0
+        cancelled_num = 0
+        for inst in insts:
+            baseCcy = inst.baseCcy
+            quoteCcy = inst.quoteCcy
+            tickDigits, lotDigits = inst.digits
+            if inst.side == BUY: # get baseCcy
+                size, amount = matcher.execute(inst)
+                if size == 0:
+                    cancelled_num += 1
+                    continue
+                cost = rescale(amount, lotDigits + tickDigits, digits[quoteCcy])
+                next_quoteCcy = balanceHist.value(quoteCcy) - cost
+                if next_quoteCcy < 0:
+                    continue
+                get_amount = rescale(size * keep, lotDigits + CommissionDigits, digits[baseCcy])
+                next_baseCcy = balanceHist.value(baseCcy) + get_amount
+            elif inst.side == SELL: # get quoteCcy
+                size, amount = matcher.execute(inst)
+                if size == 0:
+                    cancelled_num += 1
+                    continue
+                next_baseCcy = balanceHist.value(baseCcy) - rescale(size, lotDigits, digits[baseCcy])
+                if next_baseCcy < 0:
+                    continue
+                get_amount = rescale(amount * keep, lotDigits + tickDigits + CommissionDigits, digits[quoteCcy])
+                next_quoteCcy = balanceHist.value(quoteCcy) + get_amount
+            else:
+                raise Exception('Unknown side: {}'.format(inst.side))
+            traded_num += 1
+            balanceHist.trade(inst.ts, baseCcy, next_baseCcy, quoteCcy, next_quoteCcy)
+        
+        self.metrics.count('trades_executed', traded_num)
+        self.metrics.count('trades_cancelled', cancelled_num)
+        self.metrics.count('trades_rejected', len(insts) - traded_num - cancelled_num)
+        return balanceHist
+
+    def groupInsts(self, insts: List[Instruction]) -> Dict[str, List[Instruction]]:
+        '''
+        将交易指令按交易对分组, 组内按时间排序
+        '''
+        groups: Dict[str, List[Instruction]] = {}
+        for inst in sorted(insts, key=lambda x: x.ts):
+            groups.setdefault(inst.pair, []).append(inst)
+        return groups
+
     def genBook(self, 
                 time_period: Tuple[int, int],
                 insts: List[Instruction],
-                askbids: TypeAskBids,
+                askbids: AskBids,
                 pair: str,
                 ) -> Book:
         '''
         随机生成订单簿
-        NOTICE: 当前只假定一个交易指令可以被一档订单消耗完成
+        NOTICE: 'top' 模式下假定一个交易指令可以被一档订单消耗完成, 指令档位即为最优档位;
+                'depth' 模式下没有指令档位, 每一档的平均价值为 DepthLevelValue, 交易指令需要逐档撮合
         NOTICE: 假定订单簿深度为 20
+        NOTICE: 只在该交易对有交易指令的时刻生成切片, insts 可以是全体指令, 也可以是 groupInsts 的分组结果
+        NOTICE: bookStorage 为 'lazy' 时只记录指令索引, 切片在访问时才生成, 见 genLazyBook
         '''
         Depth = 20 # 订单簿深度
-        time_range = int((time_period[1]-time_period[0])/1000) + 1
-        books = Book(pair)
-        for t in range(time_range):
-            askbid = askbids[t][1] # 卖一价; 买一价
-            assert askbids[t][0] == 1000*t + time_period[0]
-            # FIXME: Remove the following assertion
-            filtered_insts = list(filter(lambda x: x.ts == askbids[t][0], insts))
-            assert len(filtered_insts) <= 1
-            if len(filtered_insts) == 1:
-                inst = filtered_insts[0]
-            else:
-                continue
+        if self.bookStorage == 'lazy':
+            return self.genLazyBook(time_period, insts, askbids, pair, Depth)
+        instrument = self.registry[pair]
+        insts = sorted([x for x in insts if x.pair == pair], key=lambda x: x.ts)
+        if self.fixedPoint:
+            books = DeltaBook(pair, (instrument.tickDigits, instrument.lotDigits))
+        else:
+            books = BookStorages[self.bookStorage](pair)
+        if len(insts) == 0:
+            return books
+        timestamps = np.array([x.ts for x in insts], dtype=np.int64)
+        # FIXME: Remove the following assertion
+        assert (np.diff(timestamps) > 0).all()
+        assert timestamps[0] >= time_period[0] and timestamps[-1] <= time_period[1]
+        index = askbids.indices(timestamps)
+        
+        # 一次性生成所有时刻的价格档位和委托量, 每一行对应一个时刻
+        rng = self.stageRng('book', pair)
+        levelSize = self.depthLevelSize(pair, askbids, index)
+        ask_v = generate_random_seqs(rng, levelSize, levelSize/3, (len(insts), Depth), instrument.lotDigits, instrument.minSz)
+        bid_v = generate_random_seqs(rng, levelSize, levelSize/3, (len(insts), Depth), instrument.lotDigits, instrument.minSz)
+        if self.fixedPoint: # 与 fillInsts 一样, 价格档位从取整后的 ask/bid 开始
+            tick = instrument.tickUnits
+            ask_ps = generate_order_seqs(to_units(askbids.asks[index], instrument.tickDigits, tick), Depth, tick).tolist()
+            bid_ps = generate_order_seqs(to_units(askbids.bids[index], instrument.tickDigits, tick), Depth, tick, False).tolist()
+            ask_v = to_units(ask_v, instrument.lotDigits).tolist()
+            bid_v = to_units(bid_v, instrument.lotDigits).tolist()
+        else:
+            ask_ps = generate_order_seqs(askbids.asks[index], Depth, instrument.tickSz).tolist()
+            bid_ps = generate_order_seqs(askbids.bids[index], Depth, instrument.tickSz, False).tolist()
+            ask_v = ask_v.tolist()
+            bid_v = bid_v.tolist()
+        for i, inst in enumerate(insts):
             asks = []
             bids = []
-            if inst.pair != pair:
-                continue
-            
-            if inst.side == BUY:
-                asks.append((inst.price, inst.value))
-            else:
-                bids.append((inst.price, inst.value))
-            ask_ps = generate_order_seq(askbid[0], 1, Depth-len(asks), self.getTickSz(pair))
-            bid_ps = generate_order_seq(askbid[1], 1, Depth-len(bids), self.getTickSz(pair), False)
-            ask_v = generate_random_seq(1, 1/3, Depth-len(asks), self.getLotSz(pair), self.getMinSz(pair))
-            bid_v = generate_random_seq(1, 1/3, Depth-len(bids), self.getLotSz(pair), self.getMinSz(pair))
-            for i in range(Depth-len(asks)):
-                asks.append((ask_ps[i], ask_v[i]))
-            for i in range(Depth-len(bids)):
-                bids.append((bid_ps[i], bid_v[i]))
+            if self.fillMode == 'top': # 指令档位
+                if inst.side == BUY:
+                    asks.append((inst.price, inst.value))
+                else:
+                    bids.append((inst.price, inst.value))
+            n_asks = Depth-len(asks)
+            n_bids = Depth-len(bids)
+            asks.extend(zip(ask_ps[i][:n_asks], ask_v[i][:n_asks]))
+            bids.extend(zip(bid_ps[i][:n_bids], bid_v[i][:n_bids]))
             
             # TODO: Clear all the price-levels with zero volume in the last order book.
             
-            books.add_slice(1000*t + time_period[0], asks, bids)
+            books.add_slice(inst.ts, asks, bids)
 
+        self.metrics.count('slices', len(insts))
+        self.metrics.count('levels', 2*Depth*len(insts))
         return books
 
+    def depthLevelSize(self, pair: str, askbids: AskBids, index: np.ndarray) -> float:
+        '''
+        订单簿每一档的平均委托量: 'top' 模式下为 1, 'depth' 模式下为价值 DepthLevelValue 对应的数量
+        NOTICE: 价值按 refPrices 折算, 与 fillInsts 中的委托量一致; 没有参考价格时按第一个指令时刻的买一价折算
+        '''
+        if self.fillMode != 'depth':
+            return 1
+        if self.refPrices is not None and pair in self.refPrices:
+            return DepthLevelValue / self.refPrices[pair]
+        if len(index) == 0:
+            return 1
+        return DepthLevelValue / float(askbids.bids[index[0]])
+
+    def genLazyBook(self, 
+                    time_period: Tuple[int, int],
+                    insts: List[Instruction],
+                    askbids: AskBids,
+                    pair: str,
+                    depth: int = 20,
+                    ) -> LazyBook:
+        '''
+        生成按需重建切片的订单簿, 只记录每个指令时刻的指令档位和 ask/bid
+        NOTICE: 各个时刻的随机数流由 (caseSeed, pair, ts) 决定, 与 genBook 生成的订单簿不同
+        NOTICE: 'depth' 模式下没有指令档位, 见 genBook
+        '''
+        instrument = self.registry[pair]
+        insts = sorted([x for x in insts if x.pair == pair], key=lambda x: x.ts)
+        digits = (instrument.tickDigits, instrument.lotDigits) if self.fixedPoint else None
+        index = askbids.indices([x.ts for x in insts])
+        book = LazyBook(pair, self.caseSeed, instrument.tickSz, instrument.lotDigits, instrument.minSz, depth, digits, 
+                        self.depthLevelSize(pair, askbids, index))
+        if len(insts) == 0:
+            return book
+        assert insts[0].ts >= time_period[0] and insts[-1].ts <= time_period[1]
+        for inst, ask, bid in zip(insts, askbids.asks[index].tolist(), askbids.bids[index].tolist()):
+            side = ASK if inst.side == BUY else BID
+            if self.fillMode == 'depth':
+                side = NOSIDE
+            book.add_instruction(inst.ts, side, inst.price, inst.value, ask, bid)
+
+        self.metrics.count('slices', len(insts))
+        self.metrics.count('levels', 2*depth*len(insts))
+        return book
+
     def getTotalPairs(self, filters: List[str] = []) -> List[str]:
         '''
         获取全体交易对
+        NOTICE: 结果由 registry 缓存, 调用方不应修改返回的列表
         '''
-        totalPairs = [i['instId'] for i in self.instruments] # 全体交易对
-        all_filters = self.defaultPairsFilters + filters
-        if all_filters != []:
-            result = []
-            for pair in totalPairs:
-                for filter in all_filters:
-                    if filter not in pair: # TODO: 修改过滤的逻辑
-                        result.append(pair)
-                        break
-            return result
-        else:
-            return totalPairs
+        return self.registry.filterPairs(self.defaultPairsFilters + filters)
     
     def getTotalCcy(self) -> Set[str]:
         '''
         获取全体币种
         '''
-        result = set()
-        totalPairs = self.getTotalPairs()
-        for pair in totalPairs:
-            baseCcy, quoteCcy = pair.split('-')[:2]
-            result.add(baseCcy)
-            result.add(quoteCcy)
-        
-        return result
+        return self.registry.currencies(self.defaultPairsFilters)
     
     def getLotSz(self, pair: str) -> float:
         '''
         获取下单数量精度
         '''
-        instrument = self.getInstrument(pair)
-        return float(instrument['lotSz'])
+        return self.registry[pair].lotSz
 
     def getTickSz(self, pair: str) -> float:
         '''
         获取下单价格精度
         '''
-        instrument = self.getInstrument(pair)
-        return float(instrument['tickSz'])
+        return self.registry[pair].tickSz
     
     def getMinSz(self, pair: str) -> float:
         '''
         获取最小下单数量
         '''
-        instrument = self.getInstrument(pair)
-        return float(instrument['minSz'])
+        return self.registry[pair].minSz
     
     def getInstrument(self, pair: str) -> Dict:
         '''
         获取指定交易对的信息
         '''
-        filtered_instruments = list(filter(lambda x: x['instId']==pair, self.instruments))
-        if len(filtered_instruments) == 0:
-            raise Exception('No such instrument: {}'.format(pair))
-        return filtered_instruments[0]
+        return self.registry[pair].raw
 
-    def produce(self, num_pairs: int = 3, points: int = 100) -> TestCase:
-        '''produce a test case'''
+    def produce(self, 
+                num_pairs: int = 3, 
+                points: int = 100, 
+                lastPrices: Optional[Dict[str, float]] = None,
+                seed: Optional[int] = None,
+                checkpointDir: Optional[str] = None,
+                ) -> TestCase:
+        '''
+        produce a test case
+        lastPrices: 参考价格快照, 缺省时请求一次最新价格并在各个步骤间共享
+        seed: 该测例的随机数种子, 缺省时由根种子和已生成的测例数量导出
+        checkpointDir: 检查点目录. 给定时每个阶段(指令, 价格序列, 填充后的指令, 每个交易对的订单簿, 参考余额)
+                       的输出都会被保存; 重新运行时跳过输入未发生变化的阶段
+        '''
+        if seed is None:
+            seed = self.getCaseSeed(self._produced)
+        self._produced += 1
+        self.caseSeed = seed
+        store = CheckpointStore(checkpointDir) if checkpointDir is not None else None
+        self.metrics.context = {'seed': seed}
+        def stage(name: str, key: str, fn: Callable, pair: Optional[str] = None):
+            fields = {} if pair is None else {'pair': pair}
+            with self.metrics.stage(name, **fields):
+                if store is None:
+                    return fn()
+                return store.run(name if pair is None else f'{name}-{pair}', key, fn)
+        
         bt_period = self.genBackTestPeriod(point=points)
-        pairs = self.genPairs(num_pairs, ['USDT-', 'USDC-'])
-        insts = self.genInsts(bt_period, pairs)
-        total_pairs = set([inst.pair for inst in insts])
-        lastPrices = get_lastPrice('SPOT') # FIXME: 仅支持 SPOT
+        filters = ['USDT-', 'USDC-']
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT') # FIXME: 仅支持 SPOT
+        # genPairs 只从有价格的交易对中选择, 因此有价格的交易对集合也是指令阶段的输入
+        key = fingerprint(seed, bt_period, num_pairs, filters, self.secPerInst, self.registry.fingerprint, self.fixedPoint, 
+                          self.fillMode, self.limitRate, self.resolution, sorted(lastPrices))
+        def genPairsAndInsts():
+            pairs = self.genPairs(num_pairs, filters, lastPrices)
+            return pairs, self.genInsts(bt_period, pairs)
+        pairs, insts = stage('insts', key, genPairsAndInsts)
+        total_pairs = sorted(set([inst.pair for inst in insts]))
         p0s = {pair: lastPrices[pair] for pair in total_pairs}
-        askbids = {pair: self.genAskBids(pair, p0s[pair], bt_period) for pair in total_pairs}
-        insts = self.fillInsts(askbids, insts)
+        self.refPrices = p0s
+        key = fingerprint(key, p0s)
+        askbids = stage('askbids', key, lambda: self.genAskBidsBatch(total_pairs, p0s, bt_period))
+        insts = stage('fill', key, lambda: self.fillInsts(askbids, insts, lastPrices))
         books: Dict[str, Book] = {}
         # generate books
-        print('Total pairs:', len(total_pairs))
+        groups = self.groupInsts(insts)
         for index, pair in enumerate(total_pairs):
-            book = self.genBook(bt_period, insts, askbids[pair], pair)
+            book = stage('book', fingerprint(key, pair, self.bookStorage), 
+                         lambda: self.genBook(bt_period, groups[pair], askbids[pair], pair), pair)
             books[pair] = book
-            print(f'finish generating book for {pair} -> {index+1}/{len(total_pairs)}')
+            self.metrics.event('progress', stage='book', done=index+1, total=len(total_pairs))
         
-        original_balance = self.genBalance(pairs)
-        referredBalances = self.calBalanceHist(insts, original_balance)
+        original_balance = self.genBalance(pairs, lastPrices)
+        referredBalances = stage('ledger', fingerprint(key, original_balance.asdict()), 
+                                 lambda: self.calBalanceHist(insts, original_balance, books if self.fillMode == 'depth' else None))
+        self.metrics.flush()
 
-        return TestCase(bt_period, books, insts, referredBalances)
+        segments = [{'shard': None, 'period': bt_period, 'end': bt_period[1], 'p0s': p0s, 'p1s': None}]
+        manifest = self.caseManifest(num_pairs, points, bt_period, pairs, p0s, original_balance, segments)
+        return TestCase(bt_period, books, insts, referredBalances, seed, manifest)
 
+    def shardBounds(self, time_period: Tuple[int, int], shards: int) -> List[int]:
+        '''
+        将回测区间按时间步均匀切分为 shards 个连续的分片, 返回各分片的起始时间戳, 最后附加回测的结束时间戳
+        第 j 个分片的指令位于 [bounds[j], bounds[j+1]), 最后一个分片的价格序列包含结束时刻
+        '''
+        points = (time_period[1] - time_period[0]) // self.resolution
+        assert 1 <= shards <= points, f"Cannot split {points} points into {shards} shards"
+        return [time_period[0] + self.resolution*(j*points//shards) for j in range(shards)] + [time_period[1]]
 
-    def genPairs(self, num: Optional[int] = None, filters: List[str] = []) -> List[str]:
+    def genShardStarts(self, 
+                        pairs: List[str], 
+                        p0s: Dict[str, float], 
+                        bounds: List[int], 
+                        sigma: float = 1.0,
+                        ) -> Dict[str, List[float]]:
+        '''
+        预先确定各个分片起始时刻的价格, 第 0 个分片从 p0s 开始
+        NOTICE: 相邻两个分片起点间的对数收益率是 n 个独立的单步对数收益率之和(n 为分片的长度),
+                按中心极限定理直接从正态分布中抽取, 均值和方差与 genAskBidsBatch 的单步变化一致.
+                因此只需 O(分片数量) 的计算, 各个分片的价格序列再由 genAskBidsBatch 的 p1s 参数衔接
+        '''
+        mean, var = clipped_log_moments(*self.stepVolatility(sigma))
+        steps = np.diff(np.array(bounds[:-1], dtype=np.int64)) // self.resolution
+        result = {}
+        for pair in pairs:
+            rng = self.stageRng('shards', pair)
+            returns = rng.normal(steps * mean, np.sqrt(steps * var))
+            result[pair] = (p0s[pair] * np.exp(np.concatenate(([0.0], np.cumsum(returns))))).tolist()
+        return result
+
+    def shardSegments(self, 
+                    num_pairs: int, 
+                    points: int, 
+                    shards: int, 
+                    lastPrices: Dict[str, float],
+                    seed: Optional[int] = None,
+                    ) -> Tuple[Tuple[int, int], List[str], Dict[str, float], List[Dict]]:
+        '''
+        produce_sharded 和 produce_stream 的准备工作: 确定测例的种子, 回测区间, 交易对和各个分片
+        返回 (回测区间, 交易对, 参考价格, 分片), 分片的格式见 caseManifest
+        '''
+        if seed is None:
+            seed = self.getCaseSeed(self._produced)
+        self._produced += 1
+        self.caseSeed = seed
+        self.metrics.context = {'seed': seed}
+        
+        bt_period = self.genBackTestPeriod(point=points)
+        pairs = self.genPairs(num_pairs, ['USDT-', 'USDC-'], lastPrices)
+        p0s = {pair: lastPrices[pair] for pair in pairs}
+        self.refPrices = p0s
+        bounds = self.shardBounds(bt_period, shards)
+        with self.metrics.stage('shards'):
+            starts = self.genShardStarts(pairs, p0s, bounds)
+        segments = []
+        for j in range(shards):
+            last = j == shards - 1
+            segments.append({
+                'shard': j,
+                'period': (bounds[j], bounds[j+1] if last else bounds[j+1] - self.resolution), # 价格序列的时间范围
+                'end': bounds[j+1],
+                'p0s': {pair: starts[pair][j] for pair in pairs},
+                'p1s': None if last else {pair: starts[pair][j+1] for pair in pairs},
+            })
+        return bt_period, pairs, p0s, segments
+
+    def produce_sharded(self, 
+                        num_pairs: int = 3, 
+                        points: int = 100, 
+                        shards: int = 4,
+                        workers: Optional[int] = None,
+                        lastPrices: Optional[Dict[str, float]] = None,
+                        seed: Optional[int] = None,
+                        ) -> TestCase:
+        '''
+        按时间分片并行生成一个测例, 用于单个很长的测例
+        回测区间被切分为 shards 个分片(见 shardBounds), 各分片的指令, 价格序列和订单簿在进程池中生成(见 _produceShard).
+        各分片的起始价格由 genShardStarts 预先确定, 因此分片之间互不依赖. 
+        各分片的订单簿按时间顺序拼接(见 Book.extend), 参考余额依赖之前的全部成交, 最后在主进程中顺序计算.
+        NOTICE: 结果只由 seed 和 shards 决定, 与 workers 无关; 每个分片使用独立的随机数流, 因此与 produce 的结果不同
+        NOTICE: 不支持检查点
+        '''
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT') # FIXME: 仅支持 SPOT
+        bt_period, pairs, p0s, segments = self.shardSegments(num_pairs, points, shards, lastPrices, seed)
+        self.checkPicklable()
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_produceShard, self, self.caseSeed, pairs, segment, lastPrices) for segment in segments]
+            for j, future in enumerate(futures):
+                results.append(future.result())
+                self.metrics.event('progress', stage='shard', done=j+1, total=shards)
+        
+        insts = [inst for shard_insts, _ in results for inst in shard_insts]
+        total_pairs = sorted(set([inst.pair for inst in insts]))
+        books: Dict[str, Book] = {}
+        with self.metrics.stage('stitch'):
+            for pair in total_pairs:
+                books[pair] = results[0][1][pair]
+                for _, shard_books in results[1:]:
+                    books[pair].extend(shard_books[pair])
+        
+        original_balance = self.genBalance(pairs, lastPrices)
+        with self.metrics.stage('ledger'):
+            referredBalances = self.calBalanceHist(insts, original_balance, books if self.fillMode == 'depth' else None)
+        self.metrics.flush()
+
+        manifest = self.caseManifest(num_pairs, points, bt_period, pairs, p0s, original_balance, segments)
+        return TestCase(bt_period, books, insts, referredBalances, self.caseSeed, manifest)
+
+    def produce_stream(self, 
+                        path: str,
+                        num_pairs: int = 3, 
+                        points: int = 100, 
+                        chunkPoints: int = 3600,
+                        fmt: str = 'chunk',
+                        lastPrices: Optional[Dict[str, float]] = None,
+                        seed: Optional[int] = None,
+                        ) -> str:
+        '''
+        以有限的内存流式生成一个测例并写入 path
+        回测区间被切分为每段约 chunkPoints 个时间步的分片(即 produce_sharded 的分片), 逐段生成价格序列, 指令和订单簿,
+        计算该段的参考余额后立即写出. 段与段之间只保留各个订单簿的最后一个切片(见 Book.tail)
+        和最新的余额(见 BalanceLedger.tail), 因此内存占用只与 chunkPoints 有关, 与回测区间的长度无关.
+        NOTICE: 写出的内容与分片数量相同的 produce_sharded 逐位相同, 清单同样可以用于 replay.CaseReplay;
+                唯一的区别是 'txt' 格式的文件头中的 pairs 为全部交易对(写出文件头时还不知道哪些交易对有指令),
+                定点模式下各币种的小数位数同样由全部交易对决定(某个交易对没有任何指令时才会不同)
+        NOTICE: 只支持可以流式写出的 'txt' 和 'chunk' 格式
+        '''
+        if fmt not in ('txt', 'chunk'):
+            raise ValueError(f"Format {fmt} cannot be written as a stream")
+        shards = max(1, -(-points // chunkPoints))
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT') # FIXME: 仅支持 SPOT
+        bt_period, pairs, p0s, segments = self.shardSegments(num_pairs, points, shards, lastPrices, seed)
+        original_balance = self.genBalance(pairs, lastPrices)
+        manifest = self.caseManifest(num_pairs, points, bt_period, pairs, p0s, original_balance, segments)
+        header = {'seed': self.caseSeed, 'bt_period': list(bt_period), 'pairs': sorted(pairs), 'manifest': manifest}
+        if fmt == 'txt':
+            writer = TextStreamWriter(path, header)
+        else:
+            writer = ChunkWriter(path, bt_period[0])
+        
+        digits = self.getCcyDigits(pairs, original_balance) if self.fixedPoint else None
+        ledger = BalanceLedger(original_balance, 0, digits=digits)
+        tails: Dict[str, Book] = {} # 各个交易对已写出的最后一个切片
+        worker = copy(self) # _produceShard 会修改 factory 的状态
+        try:
+            for j, segment in enumerate(segments):
+                insts, books = _produceShard(worker, self.caseSeed, pairs, segment, lastPrices)
+                skip = {}
+                for pair in sorted(books):
+                    if len(books[pair]) == 0:
+                        del books[pair]
+                    elif pair in tails: # 接在上一段的最后一个切片之后, 与 produce_sharded 拼接的订单簿相同
+                        tails[pair].extend(books[pair])
+                        books[pair], skip[pair] = tails[pair], 1
+                with self.metrics.stage('ledger', shard=j):
+                    ledger = self.calBalanceHist(insts, original_balance, books if self.fillMode == 'depth' else None, ledger)
+                with self.metrics.stage('write', shard=j):
+                    writer.write_stream('market', iter_market(books, skip))
+                    writer.write_stream('insts', iter_instructions(insts))
+                    writer.write_stream('reference', islice(iter_reference(ledger), 0 if j == 0 else 1, None)) # 第一行是上一段的最后一行
+                tails.update({pair: book.tail() for pair, book in books.items()})
+                ledger = ledger.tail()
+                self.metrics.event('progress', stage='stream', done=j+1, total=shards)
+        except BaseException:
+            if fmt == 'chunk': # 不写出 footer, 未完成的文件无法被 ChunkedReader 读取
+                writer.file.close()
+            else:
+                writer.close()
+            raise
+        writer.close(dict(header, pairs=sorted(tails)))
+        self.metrics.flush()
+        return path
+
+    def produce_many(self, 
+                    n: Optional[int] = None, 
+                    num_pairs: int = 3, 
+                    points: int = 100, 
+                    workers: Optional[int] = None,
+                    lastPrices: Optional[Dict[str, float]] = None,
+                    fmt: str = 'json',
+                    checkpointDir: Optional[str] = None,
+                    shards: Optional[int] = None,
+                    chunkPoints: Optional[int] = None,
+                    ) -> List[str]:
+        '''
+        使用进程池批量生成 n 个测例, 并以 fmt 格式(见 TestCase.save)写入 destPath
+        第 i 个测例的种子为 getCaseSeed(i), 因此任何一个测例都可以单独复现
+        checkpointDir: 检查点目录, 第 i 个测例的检查点位于其子目录 case-<i> 中;
+                       重新运行时跳过已经完成的测例, 未完成的测例从最后完成的阶段继续
+        shards: 给定时逐个生成测例, 每个测例按时间分为 shards 个分片并行生成(见 produce_sharded)
+        chunkPoints: 给定时逐个流式生成测例, 每段 chunkPoints 个时间步(见 produce_stream), 只支持 'txt' 和 'chunk' 格式
+        返回各个测例的文件路径
+        '''
+        if n is None:
+            n = self.testNum
+        if lastPrices is None:
+            lastPrices = self.marketData.get_lastPrice('SPOT') # 所有测例共享同一份价格快照
+        os.makedirs(self.destPath, exist_ok=True)
+        paths: List[str] = [''] * n
+        suffix = {'json': '.json', 'chunk': '.mtc'}.get(fmt, '')
+        if chunkPoints is not None:
+            assert checkpointDir is None and shards is None, "Streaming supports neither checkpoints nor time shards"
+            for i in range(n):
+                paths[i] = self.produce_stream(os.path.join(self.destPath, f'testcase-{i}{suffix}'), num_pairs, points,
+                                               chunkPoints, fmt, lastPrices, self.getCaseSeed(i))
+            return paths
+        if shards is not None:
+            assert checkpointDir is None, "Checkpoints are not supported with time shards"
+            for i in range(n):
+                paths[i] = os.path.join(self.destPath, f'testcase-{i}{suffix}')
+                self.produce_sharded(num_pairs, points, shards, workers, lastPrices, self.getCaseSeed(i)).save(paths[i], fmt)
+            return paths
+        self.checkPicklable()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_produceCase, self, self.getCaseSeed(i), num_pairs, points, lastPrices,
+                                       os.path.join(self.destPath, f'testcase-{i}{suffix}'), fmt,
+                                       os.path.join(checkpointDir, f'case-{i}') if checkpointDir else None): i
+                       for i in range(n)}
+            for future in as_completed(futures): # 每个测例在工作进程中生成后立即写入文件
+                paths[futures[future]] = future.result()
+        return paths
+
+    def checkPicklable(self) -> None:
+        '''
+        在进入进程池之前检查 metrics 能否发送给工作进程, 例如 CallbackSink 的回调不能是 lambda 或闭包
+        '''
+        try:
+            pickle.dumps(self.metrics)
+        except Exception as e:
+            raise ValueError(f"The metrics cannot be sent to worker processes ({e}); "
+                             "use a JsonLinesSink or a module-level callback function") from e
+
+    def getCaseSeed(self, index: int) -> int:
+        '''
+        获取第 index 个测例的随机数种子
+        '''
+        return derive_seed(self.seed, 'case', index)
+
+    def stageSeed(self, *keys) -> int:
+        '''
+        当前测例中由 keys 标识的步骤的随机数种子
+        '''
+        if self.shard is not None: # 各个分片使用独立的随机数流
+            keys = keys + ('shard', self.shard)
+        return derive_seed(self.caseSeed, *keys)
+
+    def stageRng(self, *keys) -> np.random.Generator:
+        '''
+        获取当前测例中由 keys 标识的步骤的随机数流
+        '''
+        return np.random.default_rng(self.stageSeed(*keys))
+
+    def stageRandom(self, *keys) -> random.Random:
+        '''
+        stageRng 的 random.Random 版本
+        '''
+        return random.Random(self.stageSeed(*keys))
+
+    def caseManifest(self, 
+                    num_pairs: int, 
+                    points: int, 
+                    bt_period: Tuple[int, int], 
+                    pairs: List[str], 
+                    prices: Dict[str, float], 
+                    balance: Balance, 
+                    segments: List[Dict],
+                    ) -> Dict:
+        '''
+        当前测例的清单: 重新生成任意阶段或交易对所需的全部种子和参数, 见 replay.CaseReplay
+        segments: 各个时间分片(不分片时只有一个), 每个分片为
+                  {'shard': 分片编号或 None, 'period': 价格序列的时间范围, 'end': 指令的结束时刻(不包含),
+                   'p0s': 各交易对价格序列的起始价格, 'p1s': 衔接下一分片的价格或 None}
+        NOTICE: 只包含 JSON 类型, 写入测例文件后可以原样读回
+        '''
+        shard = self.shard
+        manifest = {
+            'version': ManifestVersion,
+            'seed': self.caseSeed,
+            'num_pairs': num_pairs,
+            'points': points,
+            'bt_period': list(bt_period),
+            'pairs': list(pairs), # genPairs 的结果, 其顺序决定了各个指令的交易对
+            'prices': dict(prices), # 参考价格
+            'balance': balance.asdict(), # 初始余额
+            'params': {
+                'secPerInst': self.secPerInst,
+                'bookStorage': self.bookStorage,
+                'fixedPoint': self.fixedPoint,
+                'fillMode': self.fillMode,
+                'limitRate': self.limitRate,
+                'resolution': self.resolution,
+                'instruments': self.registry.fingerprint,
+            },
+            'segments': [],
+        }
+        for segment in segments:
+            self.shard = segment['shard']
+            seeds = {'insts': self.stageSeed('insts')}
+            for stage in ('askbids', 'fill', 'book'):
+                seeds[stage] = {pair: self.stageSeed(stage, pair) for pair in segment['p0s']}
+            manifest['segments'].append(dict(segment, period=list(segment['period']), seeds=seeds))
+        self.shard = shard
+        return manifest
+
+
+    def genPairs(self, num: Optional[int] = None, filters: List[str] = [], lastPrices: Optional[Dict[str, float]] = None) -> List[str]:
         '''
         随机生成回测涉及的交易对
+        lastPrices: 给定时只选择交易对本身和两个币种的 <ccy>-USDT(genBalance 用于估值)都在价格快照中的交易对,
+                    产品信息比价格快照旧时其中可能有已下线的交易对
         '''
+        rand = self.stageRandom('pairs')
         totalPairs = self.getTotalPairs(filters)
+        if lastPrices is not None:
+            def isPriced(pair: str) -> bool:
+                return pair in lastPrices and all(ccy in ['USDT', 'USDC'] or f'{ccy}-USDT' in lastPrices 
+                                                  for ccy in pair.split('-')[:2])
+            priced = [pair for pair in totalPairs if isPriced(pair)]
+            if len(priced) < len(totalPairs):
+                totalPairs = priced
         if num is None:
-            k = random.randint(self.minPairs, self.maxPairs)
+            k = rand.randint(self.minPairs, self.maxPairs)
         else:
             k = num
-        result = random.sample(totalPairs, k)
+        if k > len(totalPairs):
+            raise ValueError(f"Cannot choose {k} pairs from the {len(totalPairs)} pairs that have both instrument data and a price")
+        result = rand.sample(totalPairs, k)
+        return result
+    
+
+def _produceShard(factory: TestFactory, 
+                  seed: int, 
+                  pairs: List[str], 
+                  segment: Dict,
+                  lastPrices: Dict[str, float],
+                  ) -> Tuple[List[Instruction], Dict[str, Book]]:
+    '''
+    在工作进程中生成测例的一个时间分片, 见 TestFactory.produce_sharded
+    segment: 分片的编号, 时间范围和起止价格, 格式见 TestFactory.caseManifest
+    返回该分片填充后的指令和各个交易对的订单簿
+    '''
+    shard, period = segment['shard'], tuple(segment['period'])
+    factory.caseSeed = seed
+    factory.shard = shard
+    factory.refPrices = {pair: lastPrices[pair] for pair in pairs}
+    factory.metrics.context = {'seed': seed, 'shard': shard}
+    with factory.metrics.stage('insts'):
+        insts = factory.genInsts((period[0], segment['end']), pairs)
+    with factory.metrics.stage('askbids'):
+        askbids = factory.genAskBidsBatch(pairs, segment['p0s'], period, p1s=segment['p1s'])
+    with factory.metrics.stage('fill'):
+        insts = factory.fillInsts(askbids, insts, lastPrices)
+    groups = factory.groupInsts(insts)
+    books = {}
+    for pair in pairs:
+        with factory.metrics.stage('book', pair=pair):
+            books[pair] = factory.genBook(period, groups.get(pair, []), askbids[pair], pair)
+    factory.metrics.flush()
+    return insts, books
+
+def _produceCase(factory: TestFactory, 
+                seed: int, 
+                num_pairs: int, 
+                points: int, 
+                lastPrices: Dict[str, float], 
+                path: str,
+                fmt: str = 'json',
+                checkpointDir: Optional[str] = None,
+                ) -> str:
+    '''
+    在工作进程中生成一个测例并写入文件
+    '''
+    if factory.metrics.enabled and factory.metrics.profile:
+        factory.metrics.profileDir = path + '.profile' # 剖析报告写在测例旁边
+    if checkpointDir is None:
+        factory.produce(num_pairs, points, lastPrices, seed).save(path, fmt)
+        return path
+    store = CheckpointStore(checkpointDir)
+    key = fingerprint(seed, num_pairs, points, lastPrices, path, fmt, factory.bookStorage, factory.registry.fingerprint,
+                      factory.fixedPoint, factory.fillMode, factory.limitRate, factory.resolution)
+    if store.load('done', key) is not None and os.path.exists(path):
+        return path
+    factory.produce(num_pairs, points, lastPrices, seed, checkpointDir).save(path, fmt)
+    store.save('done', key, True)
+    store.clear(keep=('done',)) # 测例已经写出, 中间结果不再需要
+    return path
+
+def test_calBalanceHistFixed():
+    # 同一组指令分别用定点和浮点计算参考余额; LUNC-USDT 的 lotSz 为 "1", 余额应为整数
+    from benchmark import fixture_factory
+    from utils.fixedpoint import from_units
+    pairs = ['LUNC-USDT', 'BTC-USDT', 'ETH-USDT']
+    tf = fixture_factory(7)
+    tf.fixedPoint = True
+    lastPrices = tf.marketData.get_lastPrice('SPOT')
+    bt_period = tf.genBackTestPeriod(3000)
+    askbids = tf.genAskBidsBatch(pairs, {pair: lastPrices[pair] for pair in pairs}, bt_period)
+    insts = tf.fillInsts(askbids, tf.genInsts(bt_period, pairs), lastPrices)
+    assert 'LUNC-USDT' in set(inst.pair for inst in insts)
+    balance = tf.genBalance(pairs, lastPrices)
+    fixed = tf.calBalanceHist(insts, balance)
+    assert fixed.digits['LUNC'] == 0 and fixed.digits['BTC'] == tf.registry['BTC-USDT'].lotDigits
+    floats = []
+    for inst in insts:
+        inst = copy(inst)
+        inst.price, inst.value = from_units(inst.price, inst.digits[0]), from_units(inst.value, inst.digits[1])
+        inst.digits = None
+        floats.append(inst)
+    reference = fixture_factory(7).calBalanceHist(floats, balance)
+    assert len(reference) == len(fixed)
+    for i, ((ts1, b1), (ts2, b2)) in enumerate(zip(reference, fixed)):
+        assert ts1 == ts2 and b1.keys() == b2.keys()
+        for ccy in b1:
+            # 每笔成交的每个币种最多相差半个单位的舍入
+            assert abs(b1[ccy] - b2[ccy]) * 10**fixed.digits[ccy] <= 0.5*i + 1e-6, (i, ccy, b1[ccy], b2[ccy])
+        assert b2['LUNC'] == int(b2['LUNC'])
+
+def test_produceCheckpoint():
+    # 从检查点恢复的测例与重新生成的一致; 价格快照中有价格的交易对变化时指令阶段失效
+    import tempfile
+    from benchmark import fixture_factory
+    def produce(checkpointDir: str, lastPrices: Dict[str, float]) -> Tuple[Dict, int]:
+        tf = fixture_factory(11)
+        calls = []
+        genInsts = tf.genInsts
+        tf.genInsts = lambda *args: calls.append(1) or genInsts(*args)
+        return tf.produce(2, 200, lastPrices, seed=5, checkpointDir=checkpointDir).asdict(), len(calls)
+    lastPrices = fixture_factory(11).marketData.get_lastPrice('SPOT')
+    with tempfile.TemporaryDirectory() as d:
+        fresh, calls = produce(d, lastPrices)
+        assert calls == 1
+        resumed, calls = produce(d, lastPrices)
+        assert calls == 0 and resumed == fresh
+        unused = sorted(set(lastPrices) - set(inst['pair'] for inst in fresh['insts']))[0]
+        fewer = {pair: price for pair, price in lastPrices.items() if pair != unused}
+        _, calls = produce(d, fewer)
+        assert calls == 1
+    with tempfile.TemporaryDirectory() as d:
+        assert produce(d, lastPrices)[0] == fresh
+
+def test_produce_sharded():
+    # 各分片的价格序列首尾相接; 结果与 workers 无关
+    from benchmark import fixture_factory
+    tf = fixture_factory(3)
+    lastPrices = tf.marketData.get_lastPrice('SPOT')
+    _, pairs, p0s, segments = tf.shardSegments(2, 2000, 5, lastPrices, seed=9)
+    _, limit = tf.stepVolatility(1.0)
+    paths = []
+    for segment in segments:
+        tf.shard = segment['shard']
+        askbids = tf.genAskBidsBatch(pairs, segment['p0s'], tuple(segment['period']), p1s=segment['p1s'])
+        for pair in pairs:
+            assert askbids[pair].bids[0] == segment['p0s'][pair]
+        paths.append(askbids)
+    tf.shard = None
+    assert paths[0][pairs[0]].bids[0] == p0s[pairs[0]]
+    for pair in pairs:
+        ts = np.concatenate([x[pair].timestamps for x in paths])
+        assert (np.diff(ts) == tf.resolution).all() # 时间戳连续, 没有重叠或缺口
+        returns = np.diff(np.log(np.concatenate([x[pair].bids for x in paths])))
+        assert np.abs(returns).max() < 2 * np.log1p(limit) # 分片衔接处没有跳变
+    one = fixture_factory(3).produce_sharded(2, 2000, 5, workers=1, lastPrices=lastPrices, seed=9)
+    many = fixture_factory(3).produce_sharded(2, 2000, 5, workers=3, lastPrices=lastPrices, seed=9)
+    assert one.asdict() == many.asdict()
+
+def test_produce_stream():
+    # 流式写出的内容与分片数量相同的 produce_sharded 相同; 不同时间粒度下每秒的波动大致不变
+    import tempfile
+    from benchmark import fixture_factory
+    from chunked import ChunkedReader
+    def rows(path: str) -> List[List]:
+        with ChunkedReader(path) as reader:
+            return [list(reader.rows(section)) for section in ('market', 'insts', 'reference')]
+    for resolution in (1000, 250):
+        def factory() -> TestFactory:
+            tf = fixture_factory(3)
+            tf.resolution = resolution
+            return tf
+        with tempfile.TemporaryDirectory() as d:
+            sharded, streamed = os.path.join(d, 'sharded.mtc'), os.path.join(d, 'streamed.mtc')
+            tc = factory().produce_sharded(2, 2000, 3, workers=1, seed=9)
+            tc.save(sharded, 'chunk')
+            factory().produce_stream(streamed, 2, 2000, 700, 'chunk', seed=9)
+            assert rows(streamed) == rows(sharded)
+            assert tc.bt_period[1] - tc.bt_period[0] == 2000 * resolution
+            assert all((inst.ts - tc.bt_period[0]) % resolution == 0 for inst in tc.insts)
+    
+    seconds = 20000
+    volatility = []
+    for resolution in (1000, 100):
+        tf = fixture_factory(3)
+        tf.resolution, tf.caseSeed = resolution, 9
+        bt_period = tf.genBackTestPeriod(seconds * 1000 // resolution)
+        bids = tf.genAskBidsBatch(['BTC-USDT'], {'BTC-USDT': 1.0}, bt_period)['BTC-USDT'].bids
+        volatility.append(np.diff(np.log(bids[::1000 // resolution])).std()) # 每秒的对数收益率
+    assert 0.9 < volatility[1] / volatility[0] < 1.1
+
+def test_produce_many():
+    # 同一根种子生成的测例逐字节相同, 与 workers 和完成顺序无关; 各个步骤的种子互不相同
+    import tempfile
+    from benchmark import fixture_factory
+    def read(paths: List[str]) -> List[bytes]:
+        result = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                result.append(f.read())
         return result
+    lastPrices = fixture_factory(1).marketData.get_lastPrice('SPOT')
+    outputs = []
+    with tempfile.TemporaryDirectory() as d:
+        for workers in (1, 3):
+            tf = fixture_factory(1)
+            tf.destPath = os.path.join(d, f'workers-{workers}')
+            outputs.append(read(tf.produce_many(5, 2, 300, workers, lastPrices)))
+        # 在主进程中按相反的顺序单独生成各个测例
+        tf = fixture_factory(1)
+        paths = []
+        for i in reversed(range(5)):
+            paths.insert(0, os.path.join(d, f'single-{i}.json'))
+            tf.produce(2, 300, lastPrices, tf.getCaseSeed(i)).save(paths[0], 'json')
+        outputs.append(read(paths))
+    assert outputs[0] == outputs[1] == outputs[2]
+    assert len(set(outputs[0])) == 5
     
+    tf = fixture_factory(1)
+    assert len(set(tf.getCaseSeed(i) for i in range(100))) == 100
+    tf.caseSeed = tf.getCaseSeed(0)
+    keys = [('pairs',), ('insts',)] + [(stage, pair) for stage in ('askbids', 'fill', 'book') for pair in ('BTC-USDT', 'ETH-USDT')]
+    seeds = [tf.stageSeed(*key) for key in keys]
+    tf.shard = 1
+    seeds += [tf.stageSeed(*key) for key in keys]
+    assert len(set(seeds)) == len(seeds)
+
 
 if __name__ == '__main__':
     tf = TestFactory()
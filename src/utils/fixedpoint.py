@@ -0,0 +1,52 @@
+from decimal import Decimal
+from typing import Union
+import numpy as np
+
+'''
+定点数工具
+数值以 int64(或 Python int) 的"单位"表示, 单位为 10**-digits; 价格的 digits 为 tickSz 的小数位数,
+数量的 digits 为 lotSz 的小数位数. 只在序列化时才转换为十进制字符串, 因此不会引入浮点误差.
+'''
+
+def to_units(values: Union[float, np.ndarray], digits: int, step: int = 1) -> np.ndarray:
+    '''
+    将浮点数(数组)四舍五入为 step 个单位的整数倍, 单位为 10**-digits, 返回 int64 数组
+    '''
+    return np.rint(np.asarray(values, dtype=np.float64) * 10**digits / step).astype(np.int64) * step
+
+def from_units(units: Union[int, np.ndarray], digits: int) -> Union[float, np.ndarray]:
+    '''
+    to_units 的逆运算, 仅用于需要浮点数的接口
+    '''
+    return units / 10**digits
+
+def rescale(units: int, fromDigits: int, toDigits: int) -> int:
+    '''
+    将以 10**-fromDigits 为单位的整数转换为以 10**-toDigits 为单位, 需要舍入时使用银行家舍入
+    '''
+    if toDigits >= fromDigits:
+        return units * 10**(toDigits - fromDigits)
+    divisor = 10**(fromDigits - toDigits)
+    q, r = divmod(units, divisor)
+    if 2*r > divisor or (2*r == divisor and q % 2 == 1):
+        q += 1
+    return q
+
+def format_units(units: int, digits: int) -> str:
+    '''
+    将整数单位格式化为十进制字符串, 去掉小数部分末尾的零, 例如 (12340, 3) -> "12.34", (0, 3) -> "0"
+    '''
+    units = int(units)
+    if digits <= 0:
+        return str(units * 10**-digits)
+    sign = '-' if units < 0 else ''
+    text = str(abs(units)).rjust(digits + 1, '0')
+    integer, fraction = text[:-digits], text[-digits:].rstrip('0')
+    return f"{sign}{integer}.{fraction}" if fraction else f"{sign}{integer}"
+
+def decimal_digits(value: float) -> int:
+    '''
+    浮点数的最短十进制表示的小数位数, 例如 0.0012 -> 4, 1000.0 -> 0
+    '''
+    exponent = Decimal(repr(float(value))).normalize().as_tuple().exponent
+    return max(0, -exponent)
@@ -1,7 +1,10 @@
-import requests
 import json
 import random
-from typing import List, Union, Dict, Callable
+import math
+import hashlib
+from bisect import bisect_left, bisect_right
+from typing import List, Union, Dict, Callable, Sequence, Iterable, Tuple
+import numpy as np
 
 proxies = {
     'http': 'http://127.0.0.1:7890',
@@ -38,6 +41,7 @@ def get_tickers(instType: str) -> List:
     FUTURES: 交割合约
     OPTION: 期权
     '''
+    import requests # 只在需要访问网络时才导入
     params = {
         'instType': instType,
     }
@@ -45,6 +49,7 @@ def get_tickers(instType: str) -> List:
     return json.loads(response.text)['data']
 
 def get_instruments(instType: str) -> Dict:
+    import requests
     params = {
         'instType': instType,
     }
@@ -63,12 +68,12 @@ def get_lastPrice(instType: str) -> Dict[str, float]:
     return result
 
 
-def generate_random_valueInt(v0, deviation) -> int:
+def generate_random_valueInt(v0, deviation, rand: random.Random = random) -> int:
     '''
     result = v0*(1+x), x in [-deviation, deviation].
     '''
     delta = v0 * deviation
-    x = random.uniform(-delta, delta) # 均匀分布
+    x = rand.uniform(-delta, delta) # 均匀分布
     return int(v0 + x)
 
 def generate_order_seq(a0, step, count, minPs, is_increasing: bool = True) -> List[float]:
@@ -109,6 +114,50 @@ def generate_random_seq(
         seq.append(v)
     return seq
 
+def generate_order_seqs(a0: np.ndarray, count: int, minPs: float, is_increasing: bool = True) -> np.ndarray:
+    '''
+    generate_order_seq 的批量版本, 返回 (len(a0), count) 的数组, 每一行对应一个首项
+    '''
+    steps = np.full((len(a0), count + 1), minPs if is_increasing else -1 * minPs)
+    steps[:, 0] = a0
+    # 与逐项累加的结果一致: 一旦被 minPs 截断, 之后的项都只会是 minPs
+    return np.maximum(minPs, np.cumsum(steps, axis=1))[:, 1:]
+
+def generate_random_seqs(
+                        rng: np.random.Generator,
+                        mu: float, 
+                        sigma: float, 
+                        shape: Tuple[int, int], 
+                        lotDigits: int,
+                        minSz: float,
+                        ) -> np.ndarray:
+    '''
+    generate_random_seq 的批量版本, lotDigits 为下单数量精度的小数位数
+    '''
+    return np.maximum(minSz, np.round(rng.normal(mu, sigma, shape), lotDigits))
+
+def clipped_log_moments(sigma: float, limit: float, nodes: int = 64) -> Tuple[float, float]:
+    '''
+    log(1 + clip(X, -limit, limit)) 的均值和方差, X ~ N(0, sigma)
+    截断的部分是位于 ±limit 的两个点质量, 其余部分用 Gauss-Legendre 求积计算
+    '''
+    a = limit / sigma
+    tail = 0.5 * math.erfc(a / math.sqrt(2)) # P(X > limit)
+    x, w = np.polynomial.legendre.leggauss(nodes)
+    z = a * x
+    w = a * w * np.exp(-z**2 / 2) / math.sqrt(2 * math.pi)
+    y = np.log1p(sigma * z)
+    edges = np.log1p(np.array([-limit, limit]))
+    mean = float(np.dot(w, y) + tail * edges.sum())
+    return mean, float(np.dot(w, (y - mean)**2) + tail * ((edges - mean)**2).sum())
+
+def derive_seed(seed: int, *keys) -> int:
+    '''
+    由 seed 和 keys 确定性地导出一个 64 位的随机数种子, 与进程和 PYTHONHASHSEED 无关
+    '''
+    digest = hashlib.blake2b(repr((seed,) + keys).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
 def valid_Ccy(ccy: str) -> bool:
     '''
     检查币种是否合法
@@ -124,4 +173,81 @@ def validate_currency(method: Callable) -> Callable:
     def wrapper(self, key: str, *args, **kwargs):
         assert valid_Ccy(key), f"Invalid currency {key}"
         return method(self, key, *args, **kwargs)
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def locate_timestamp(timestamps: Sequence[int], timestamp: int) -> int:
+    '''
+    在升序的时间戳序列中查找 timestamp 时刻生效的元素, 即最后一个不晚于 timestamp 的元素的下标
+    '''
+    if isinstance(timestamps, np.ndarray):
+        index = int(np.searchsorted(timestamps, timestamp, side='right')) - 1
+    else:
+        index = bisect_right(timestamps, timestamp) - 1
+    if index < 0:
+        raise ValueError(f"Timestamp {timestamp} is out of range")
+    return index
+
+def locate_timestamps(timestamps: Sequence[int], targets: Iterable[int]) -> List[int]:
+    '''
+    locate_timestamp 的批量版本
+    '''
+    if not isinstance(targets, np.ndarray):
+        targets = np.fromiter(targets, dtype=np.int64)
+    indices = np.searchsorted(np.asarray(timestamps, dtype=np.int64), targets, side='right') - 1
+    if len(indices) > 0 and indices.min() < 0:
+        raise ValueError(f"Timestamp {int(targets[indices.argmin()])} is out of range")
+    return indices.tolist()
+
+def timestamp_window(timestamps: Sequence[int], t0: int, t1: int) -> range:
+    '''
+    升序的时间戳序列中, 时间戳位于 [t0, t1) 的元素的下标范围
+    '''
+    if isinstance(timestamps, np.ndarray):
+        start, end = np.searchsorted(timestamps, [t0, t1], side='left').tolist()
+        return range(start, end)
+    return range(bisect_left(timestamps, t0), bisect_left(timestamps, t1))
+
+
+class Column:
+    '''
+    按需倍增容量的一维 NumPy 数组
+    '''
+    def __init__(self, dtype, capacity: int = 1024) -> None:
+        self._data = np.empty(capacity, dtype=dtype)
+        self._len = 0
+
+    @classmethod
+    def wrap(cls, data: np.ndarray) -> 'Column':
+        '''
+        直接使用已有的数组(例如只读的内存映射数组), 不进行复制
+        '''
+        column = cls.__new__(cls)
+        column._data = data
+        column._len = len(data)
+        return column
+
+    def _reserve(self, n: int) -> None:
+        if self._len + n > len(self._data):
+            capacity = max(2*len(self._data), self._len + n)
+            data = np.empty(capacity, dtype=self._data.dtype)
+            data[:self._len] = self._data[:self._len]
+            self._data = data
+
+    def append(self, value) -> None:
+        self._reserve(1)
+        self._data[self._len] = value
+        self._len += 1
+
+    def extend(self, values) -> None:
+        n = len(values)
+        self._reserve(n)
+        self._data[self._len:self._len+n] = values
+        self._len += n
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[:self._len]
+
+    def __len__(self) -> int:
+        return self._len
@@ -1,20 +1,40 @@
-from typing import List
+from functools import lru_cache
+from typing import List, Dict, Tuple, Set, Iterator, Optional
+import hashlib
 import json
+import os
+import pickle
 import sys
 
 from utils.helper import get_instruments
+from utils.fixedpoint import to_units, decimal_digits
 
 '''
 命令行参数: 原始数据的路径, 目标文件的路径
 该脚本主要用于将原始的GET /api/v5/public/instruments?instId=SPOT数据提取特定的字段到指定的文件
+命令行参数: refresh [产品类型]
+从 OKX 重新获取产品信息, 更新 resource 下的 JSON 文件和缓存
+NOTICE: 需要在 src 目录下以模块的形式运行, 例如 python -m utils.instruments refresh
 '''
 
+ResourcePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'resource')
+
 def extract(filePath: str, toPath = None) -> List[dict]:
     # Read json file
     with open(filePath, 'r', encoding='utf-8') as f:
         json_data = f.read()
     data_dict = json.loads(json_data)
-    instruments = data_dict['data']
+    result = extract_fields(data_dict['data'])
+    if toPath != None:
+        final_data = {'instruments': result}
+        with open(toPath, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(final_data, indent=4))
+    return result
+
+def extract_fields(instruments: List[dict]) -> List[dict]:
+    '''
+    从原始的产品信息中提取特定的字段
+    '''
     result : List[dict] = []
     for i in instruments:
         d = {}
@@ -27,17 +47,185 @@ def extract(filePath: str, toPath = None) -> List[dict]:
         d['minSz'] = i['minSz']
         d['state'] = i['state']
         result.append(d)
-    if toPath != None:
-        final_data = {'instruments': result}
-        with open(toPath, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(final_data, indent=4))
     return result
 
-# defaultInstruments = extract(r'D:\Project\metabacktest\tmp\raw-okx-instruments-SPOT.json')
-defaultInstruments = get_instruments('SPOT')['data']
+def _write_cache(cachePath: str, instruments: List[dict]) -> None:
+    tmpPath = cachePath + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        pickle.dump(instruments, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, cachePath) # 多个进程同时写入时不会读到不完整的缓存
+
+def refresh_instruments(instType: str = 'SPOT') -> List[dict]:
+    '''
+    从 OKX 重新获取产品信息, 更新 resource/okex-<instType>.json 及其缓存
+    '''
+    result = extract_fields(get_instruments(instType)['data'])
+    jsonPath = os.path.join(ResourcePath, f'okex-{instType}.json')
+    with open(jsonPath, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'instruments': result}, indent=4))
+    _write_cache(os.path.join(ResourcePath, f'okex-{instType}.pickle'), result)
+    load_instruments.cache_clear()
+    get_default_registry.cache_clear()
+    return result
+
+@lru_cache(maxsize=None)
+def load_instruments(instType: str = 'SPOT') -> List[dict]:
+    '''
+    加载产品信息, 只在第一次调用时读取
+    优先读取 resource/okex-<instType>.pickle 缓存; 缓存不存在或比 JSON 文件旧时由 JSON 文件重新生成;
+    两者都不存在时从 OKX 获取(见 refresh_instruments)
+    '''
+    jsonPath = os.path.join(ResourcePath, f'okex-{instType}.json')
+    cachePath = os.path.join(ResourcePath, f'okex-{instType}.pickle')
+    if os.path.exists(cachePath) and \
+        (not os.path.exists(jsonPath) or os.path.getmtime(cachePath) >= os.path.getmtime(jsonPath)):
+        with open(cachePath, 'rb') as f:
+            return pickle.load(f)
+    if not os.path.exists(jsonPath):
+        return refresh_instruments(instType)
+    with open(jsonPath, 'r', encoding='utf-8') as f:
+        result = json.load(f)['instruments']
+    try:
+        _write_cache(cachePath, result)
+    except OSError: # resource 目录不可写时直接使用 JSON 文件
+        pass
+    return result
+
+class Instrument:
+    '''
+    单个交易对的产品信息
+    NOTICE: tickSz/lotSz/minSz 及其小数位数在构建时即解析完成, 避免在热点循环中反复解析字符串
+    '''
+    __slots__ = ('raw', 'instId', 'baseCcy', 'quoteCcy',
+                 'tickSz', 'lotSz', 'minSz',
+                 'tickDigits', 'lotDigits', 'minDigits',
+                 'tickUnits', 'lotUnits', 'minUnits')
+
+    def __init__(self, raw: Dict) -> None:
+        self.raw: Dict = raw # 原始的产品信息
+        self.instId: str = raw['instId']
+        self.baseCcy: str = raw['baseCcy']
+        self.quoteCcy: str = raw['quoteCcy']
+        self.tickSz: float = float(raw['tickSz']) # 下单价格精度
+        self.lotSz: float = float(raw['lotSz']) # 下单数量精度
+        self.minSz: float = float(raw['minSz']) # 最小下单数量
+        # 小数位数, 整数的精度(如 "1", "10")为 0 位
+        self.tickDigits: int = decimal_digits(self.tickSz)
+        self.lotDigits: int = decimal_digits(self.lotSz)
+        self.minDigits: int = decimal_digits(self.minSz)
+        # 定点模式下的精度: 价格以 10**-tickDigits, 数量以 10**-lotDigits 为单位
+        self.tickUnits: int = int(to_units(self.tickSz, self.tickDigits))
+        self.lotUnits: int = int(to_units(self.lotSz, self.lotDigits))
+        self.minUnits: int = int(to_units(self.minSz, self.lotDigits))
+
+
+class InstrumentRegistry:
+    '''
+    以 instId 为索引的产品信息表, 只在构建时扫描一次产品列表
+    '''
+    def __init__(self, instruments: List[Dict]) -> None:
+        self.pairs: List[str] = [] # 全体交易对, 保持原始顺序
+        self._byId: Dict[str, Instrument] = {}
+        self._filteredPairs: Dict[Tuple[str, ...], List[str]] = {}
+        self._filteredCcy: Dict[Tuple[str, ...], Set[str]] = {}
+        self._fingerprint: Optional[str] = None
+        for raw in instruments:
+            if raw['instId'] in self._byId: # 与原先的线性查找一致, 重复的 instId 以第一个为准
+                continue
+            inst = Instrument(raw)
+            self._byId[inst.instId] = inst
+            self.pairs.append(inst.instId)
+
+    @property
+    def fingerprint(self) -> str:
+        '''
+        产品信息的指纹, 用于判断检查点是否仍然有效
+        '''
+        if self._fingerprint is None:
+            fields = [(x.instId, x.baseCcy, x.quoteCcy, x.raw['tickSz'], x.raw['lotSz'], x.raw['minSz']) for x in self]
+            self._fingerprint = hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()
+        return self._fingerprint
+
+    def __getitem__(self, pair: str) -> Instrument:
+        try:
+            return self._byId[pair]
+        except KeyError:
+            raise Exception('No such instrument: {}'.format(pair))
+
+    def __contains__(self, pair: str) -> bool:
+        return pair in self._byId
+
+    def __len__(self) -> int:
+        return len(self._byId)
+
+    def __iter__(self) -> Iterator[Instrument]:
+        return iter(self._byId.values())
+
+    def filterPairs(self, filters: List[str]) -> List[str]:
+        '''
+        按照 filters 过滤全体交易对, 结果按 filters 缓存
+        NOTICE: 返回的是缓存的列表, 调用方不应修改它
+        '''
+        key = tuple(filters)
+        result = self._filteredPairs.get(key)
+        if result is None:
+            if len(key) > 0:
+                result = []
+                for pair in self.pairs:
+                    for filter in key:
+                        if filter not in pair: # TODO: 修改过滤的逻辑
+                            result.append(pair)
+                            break
+            else:
+                result = self.pairs
+            self._filteredPairs[key] = result
+        return result
+
+    def currencies(self, filters: List[str]) -> Set[str]:
+        '''
+        获取过滤后的交易对所涉及的全体币种, 结果按 filters 缓存
+        '''
+        key = tuple(filters)
+        result = self._filteredCcy.get(key)
+        if result is None:
+            result = set()
+            for pair in self.filterPairs(filters):
+                baseCcy, quoteCcy = pair.split('-')[:2]
+                result.add(baseCcy)
+                result.add(quoteCcy)
+            self._filteredCcy[key] = result
+        return result
+
+@lru_cache(maxsize=None)
+def get_default_registry(instType: str = 'SPOT') -> InstrumentRegistry:
+    '''
+    默认产品信息的 InstrumentRegistry, 每个进程只构建一次
+    '''
+    return InstrumentRegistry(load_instruments(instType))
+
+def __getattr__(name: str):
+    # defaultInstruments 在第一次访问时才加载, 导入本模块不会访问网络
+    if name == 'defaultInstruments':
+        return load_instruments('SPOT')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def test_Instrument():
+    def make(tickSz: str, lotSz: str) -> Instrument:
+        return Instrument({'instId': 'A-USDT', 'baseCcy': 'A', 'quoteCcy': 'USDT', 
+                           'tickSz': tickSz, 'lotSz': lotSz, 'minSz': lotSz})
+    for size, digits in (('1', 0), ('10', 0), ('0.001', 3), ('1e-08', 8), ('0.10', 1)):
+        inst = make(size, size)
+        assert (inst.tickDigits, inst.lotDigits, inst.minDigits) == (digits, digits, digits), size
+    inst = make('10', '0.001')
+    assert (inst.tickUnits, inst.lotUnits, inst.minUnits) == (10, 1, 1)
+    inst = make('1e-08', '1')
+    assert (inst.tickUnits, inst.lotUnits) == (1, 1)
+
 
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 2 and sys.argv[1] == 'refresh':
+        refresh_instruments(sys.argv[2] if len(sys.argv) >= 3 else 'SPOT')
+    elif len(sys.argv) == 3:
         extract(sys.argv[1], sys.argv[2])
 
         
\ No newline at end of file
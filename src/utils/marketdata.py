@@ -0,0 +1,217 @@
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from utils.helper import proxies
+
+'''
+行情数据来源
+命令行参数: 快照文件的路径 [产品类型], 从 OKX 获取最新行情并保存为快照文件
+'''
+
+class MarketDataProvider:
+    '''
+    行情数据来源的基类
+    '''
+    def get_lastPrice(self, instType: str) -> Dict[str, float]:
+        '''
+        获取最新的成交价格
+        '''
+        raise NotImplementedError
+
+
+class SnapshotProvider(MarketDataProvider):
+    '''
+    基于本地快照的行情数据, 不访问网络
+    '''
+    def __init__(self, snapshots: Dict[str, Dict[str, float]]) -> None:
+        self.snapshots = snapshots # 产品类型 -> {instId: 最新成交价}
+
+    @classmethod
+    def load(cls, path: str, instType: str = 'SPOT') -> 'SnapshotProvider':
+        '''
+        从 JSON 文件加载快照, 支持以下格式:
+        {"tickers": [{"instId": ..., "last": ...}, ...]}, 即 save 的输出
+        {"code": "0", "data": [{"instId": ..., "last": ...}, ...]}, 即 GET /api/v5/market/tickers 的原始数据
+        {instId: last, ...}
+        '''
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if 'tickers' in data:
+            instType = data.get('instType', instType)
+            tickers = data['tickers']
+        elif 'data' in data:
+            tickers = data['data']
+        else:
+            return cls({instType: {k: float(v) for k, v in data.items()}})
+        return cls({instType: {x['instId']: float(x['last']) for x in tickers}})
+
+    def save(self, path: str, instType: str = 'SPOT') -> None:
+        final_data = {
+            'instType': instType,
+            'tickers': [{'instId': k, 'last': str(v)} for k, v in self.snapshots[instType].items()],
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(final_data, indent=4))
+
+    def get_lastPrice(self, instType: str) -> Dict[str, float]:
+        if instType not in self.snapshots:
+            raise Exception('No snapshot for instType: {}'.format(instType))
+        return self.snapshots[instType]
+
+
+class CachedProvider(MarketDataProvider):
+    '''
+    带有过期时间的内存缓存, 在一批测例之间共享
+    ttl: 缓存的有效时间(单位: 秒); maxEntries: 最多缓存的产品类型数量, 超出时淘汰最久未使用的
+    '''
+    def __init__(self, backend: MarketDataProvider, ttl: float = 60.0, maxEntries: int = 8) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._cache: 'OrderedDict[str, Tuple[float, Dict[str, float]]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_lastPrice(self, instType: str) -> Dict[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(instType)
+            if entry is not None and now - entry[0] < self.ttl:
+                self._cache.move_to_end(instType)
+                return entry[1]
+        prices = self.backend.get_lastPrice(instType)
+        with self._lock:
+            self._cache[instType] = (now, prices)
+            self._cache.move_to_end(instType)
+            while len(self._cache) > self.maxEntries:
+                self._cache.popitem(last=False)
+        return prices
+
+    def invalidate(self, instType: Optional[str] = None) -> None:
+        with self._lock:
+            if instType is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(instType, None)
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class LiveProvider(MarketDataProvider):
+    '''
+    从 OKX (或兼容的服务, 如 StandInServer) 获取行情, 复用连接池中的连接
+    '''
+    def __init__(self, 
+                baseUrl: str = 'https://www.okx.com', 
+                proxies: Optional[Dict[str, str]] = proxies, 
+                timeout: float = 10.0,
+                poolSize: int = 4,
+                ) -> None:
+        self.baseUrl = baseUrl.rstrip('/')
+        self.proxies = proxies
+        self.timeout = timeout
+        self.poolSize = poolSize
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.poolSize, pool_maxsize=self.poolSize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if self.proxies:
+                session.proxies.update(self.proxies)
+            self._session = session
+        return self._session
+
+    def get_lastPrice(self, instType: str) -> Dict[str, float]:
+        response = self.session.get(self.baseUrl + '/api/v5/market/tickers', 
+                                    params={'instType': instType}, timeout=self.timeout)
+        response.raise_for_status()
+        return {x['instId']: float(x['last']) for x in response.json()['data']}
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_session'] = None # 连接不跨进程共享
+        return state
+
+
+class StandInServer:
+    '''
+    本地的行情服务, 以 OKX 的格式提供快照中的数据, 用于在测试中代替真实的服务
+    with StandInServer(snapshot) as server:
+        provider = LiveProvider(server.url, proxies=None)
+    '''
+    def __init__(self, snapshot: SnapshotProvider, host: str = '127.0.0.1', port: int = 0) -> None:
+        snapshots = snapshot.snapshots
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                instType = parse_qs(url.query).get('instType', ['SPOT'])[0]
+                if url.path != '/api/v5/market/tickers' or instType not in snapshots:
+                    self.send_error(404)
+                    return
+                data = [{'instType': instType, 'instId': k, 'last': str(v)} for k, v in snapshots[instType].items()]
+                body = json.dumps({'code': '0', 'msg': '', 'data': data}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'StandInServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'StandInServer':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+def test_LiveProvider():
+    snapshot = SnapshotProvider({'SPOT': {'BTC-USDT': 30000.0, 'ETH-USDT': 2000.5}})
+    with StandInServer(snapshot) as server:
+        provider = CachedProvider(LiveProvider(server.url, proxies=None))
+        assert provider.get_lastPrice('SPOT') == {'BTC-USDT': 30000.0, 'ETH-USDT': 2000.5}
+    # 服务关闭后仍然命中缓存
+    assert provider.get_lastPrice('SPOT')['BTC-USDT'] == 30000.0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        instType = sys.argv[2] if len(sys.argv) >= 3 else 'SPOT'
+        SnapshotProvider({instType: LiveProvider().get_lastPrice(instType)}).save(sys.argv[1], instType)
@@ -0,0 +1,353 @@
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from columnar import ColumnarReader, HEADER_FILE
+from chunked import ChunkedReader
+from writer import REFERENCE_FILE
+
+'''
+验证回测系统
+对一批测例依次运行回测系统(通过 BacktesterAdapter 适配), 并将其输出的余额序列与测例的 referredBalance 比较.
+例: python verify.py --command "cbacktest {path}" -w 8 --summary summary.json ./cases
+'''
+
+DefaultTolerance = 1e-8 # 默认的绝对误差
+
+BalanceRow = Tuple[int, Dict[str, Any]] # (ts, {ccy: value}), value 可以是数值或十进制字符串(定点模式)
+
+def detect_format(path: str) -> str:
+    '''
+    根据路径判断测例的格式, 见 TestCase.save
+    '''
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, HEADER_FILE)):
+            return 'npy'
+        if os.path.exists(os.path.join(path, REFERENCE_FILE)):
+            return 'txt'
+    elif path.endswith('.json'):
+        return 'json'
+    elif path.endswith('.mtc'):
+        return 'chunk'
+    raise ValueError(f"Unknown test case format: {path}")
+
+def find_cases(paths: Iterable[str]) -> List[str]:
+    '''
+    展开测例路径: 不是测例的目录被视为测例集合, 其中名为 testcase-* 的条目为测例
+    '''
+    result = []
+    for path in paths:
+        try:
+            detect_format(path)
+            result.append(path)
+        except ValueError:
+            if not os.path.isdir(path):
+                raise
+            result.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.startswith('testcase-') and not name.endswith('.profile'))
+    return result
+
+def load_reference(path: str, fmt: Optional[str] = None) -> Iterator[BalanceRow]:
+    '''
+    按时间顺序读取测例的参考余额
+    '''
+    fmt = fmt or detect_format(path)
+    if fmt == 'json':
+        with open(path, 'r', encoding='utf-8') as f:
+            referredBalance = json.load(f)['referredBalance']
+        for ts, balance in referredBalance.items():
+            yield (int(ts), balance)
+    elif fmt == 'txt':
+        yield from read_balance_lines(os.path.join(path, REFERENCE_FILE))
+    elif fmt == 'npy':
+        yield from ColumnarReader(path).referredBalance.iterdicts()
+    elif fmt == 'chunk':
+        with ChunkedReader(path) as reader:
+            yield from reader.iterdicts()
+    else:
+        raise ValueError(f"Unknown format {fmt}")
+
+def read_balance_lines(path: str) -> Iterator[BalanceRow]:
+    '''
+    读取 reference.txt 格式的余额序列, 没有 balance 字段的行(例如文件头)被忽略
+    '''
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from parse_balance_lines(f)
+
+def parse_balance_lines(lines: Iterable[str]) -> Iterator[BalanceRow]:
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if 'balance' in row:
+            yield (int(row['ts']), row['balance'])
+
+
+class BacktesterAdapter:
+    '''
+    回测系统的适配器
+    run 对 path 处的测例运行回测系统, 按时间顺序返回其输出的余额序列; 返回值可以是惰性的迭代器,
+    出现差异后不会再被读取
+    NOTICE: 适配器会被发送到工作进程中, 因此必须可以被 pickle
+    '''
+    def run(self, path: str, fmt: str) -> Iterable[BalanceRow]:
+        raise NotImplementedError
+
+class ReferenceAdapter(BacktesterAdapter):
+    '''
+    直接返回测例的参考余额, 用于检查测例和验证流程本身
+    '''
+    def run(self, path: str, fmt: str) -> Iterable[BalanceRow]:
+        return load_reference(path, fmt)
+
+class CommandAdapter(BacktesterAdapter):
+    '''
+    以子进程的形式运行回测系统
+    command 中的 {path} 和 {format} 被替换为测例的路径和格式; 回测系统应当向标准输出逐行写出
+    reference.txt 格式的余额 {"ts": ..., "balance": {ccy: value, ...}}
+    '''
+    def __init__(self, command: List[str], timeout: Optional[float] = None) -> None:
+        self.command = command
+        self.timeout = timeout # 单个测例的最长运行时间(单位: 秒)
+
+    def run(self, path: str, fmt: str) -> Iterator[BalanceRow]:
+        args = [arg.format(path=path, format=fmt) for arg in self.command]
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, text=True)
+        expired = threading.Event()
+        def expire() -> None:
+            expired.set()
+            proc.kill() # 标准输出随之关闭, 阻塞的读取立即返回
+        # 无论回测系统是否有输出, 到期后都由计时器线程结束子进程
+        timer = threading.Timer(self.timeout, expire) if self.timeout is not None else None
+        if timer is not None:
+            timer.start()
+        try:
+            for row in parse_balance_lines(proc.stdout):
+                if expired.is_set():
+                    break
+                yield row
+            returncode = proc.wait()
+            if expired.is_set():
+                raise TimeoutError(f"Back-test of {path} timed out after {self.timeout} seconds")
+            if returncode != 0:
+                raise Exception('Back-test of {} exited with code {}'.format(path, returncode))
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if proc.poll() is None: # 提前结束时不再等待回测系统
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+
+
+class Divergence:
+    '''
+    两个余额序列的第一个差异
+    '''
+    def __init__(self, ts: int, ccy: str, expected: Optional[float], actual: Optional[float]) -> None:
+        self.ts = ts
+        self.ccy = ccy
+        self.expected = expected # None 表示缺失
+        self.actual = actual
+
+    def __str__(self) -> str:
+        return f"{self.ccy} at {self.ts}: expected {self.expected}, got {self.actual}"
+
+    def asdict(self) -> Dict[str, Any]:
+        return {'ts': self.ts, 'ccy': self.ccy, 'expected': self.expected, 'actual': self.actual}
+
+def _latest(rows: Iterable[BalanceRow]) -> Iterator[BalanceRow]:
+    '''
+    同一时刻的多行只保留最后一行, 并检查时间顺序
+    '''
+    last = None
+    for row in rows:
+        if last is not None:
+            if row[0] < last[0]:
+                raise ValueError(f"Timestamp {row[0]} is out of order")
+            if row[0] > last[0]:
+                yield last
+        last = row
+    if last is not None:
+        yield last
+
+def _diff(ts: int,
+          expected: Dict[str, Any],
+          actual: Dict[str, Any],
+          tolerances: Dict[str, float],
+          defaultTolerance: float,
+          ) -> Optional[Divergence]:
+    for ccy in sorted(expected.keys() | actual.keys()):
+        e, a = expected.get(ccy), actual.get(ccy)
+        e = float(e) if e is not None else None
+        a = float(a) if a is not None else None
+        if abs((e or 0.0) - (a or 0.0)) > tolerances.get(ccy, defaultTolerance):
+            return Divergence(ts, ccy, e, a)
+    return None
+
+def compare_balances(expected: Iterable[BalanceRow],
+                     actual: Iterable[BalanceRow],
+                     tolerances: Optional[Dict[str, float]] = None,
+                     defaultTolerance: float = DefaultTolerance,
+                     ) -> Tuple[int, Optional[Divergence]]:
+    '''
+    按时间戳归并比较两个按时间排序的余额序列, 在第一个差异处停止
+    在两个序列的时间戳的并集上, 依次比较各自最后一个不晚于该时刻的余额; 缺失的币种视为 0
+    NOTICE: 从两个序列都有余额的时刻开始比较, 回测系统可以晚于参考余额(时刻 0)输出初始余额
+    返回 (比较的时刻数量, 第一个差异或 None)
+    '''
+    tolerances = tolerances or {}
+    expected_rows, actual_rows = _latest(expected), _latest(actual)
+    e, a = next(expected_rows, None), next(actual_rows, None)
+    expected_state: Optional[Dict[str, Any]] = None
+    actual_state: Optional[Dict[str, Any]] = None
+    compared = 0
+    while e is not None or a is not None:
+        ts = min(row[0] for row in (e, a) if row is not None)
+        if e is not None and e[0] == ts:
+            expected_state, e = e[1], next(expected_rows, None)
+        if a is not None and a[0] == ts:
+            actual_state, a = a[1], next(actual_rows, None)
+        if expected_state is None or actual_state is None:
+            continue
+        compared += 1
+        divergence = _diff(ts, expected_state, actual_state, tolerances, defaultTolerance)
+        if divergence is not None:
+            return compared, divergence
+    return compared, None
+
+def verify_case(adapter: BacktesterAdapter,
+                path: str,
+                tolerances: Optional[Dict[str, float]] = None,
+                defaultTolerance: float = DefaultTolerance,
+                ) -> Dict[str, Any]:
+    '''
+    验证一个测例, 返回其结果; 回测系统的异常被记录在结果中而不会被抛出
+    '''
+    start = time.perf_counter()
+    result: Dict[str, Any] = {'path': path, 'ok': False, 'compared': 0, 'divergence': None, 'error': None}
+    try:
+        fmt = detect_format(path)
+        compared, divergence = compare_balances(load_reference(path, fmt), adapter.run(path, fmt),
+                                                tolerances, defaultTolerance)
+        result['compared'] = compared
+        result['divergence'] = divergence.asdict() if divergence is not None else None
+        result['ok'] = divergence is None and compared > 0
+        if compared == 0:
+            result['error'] = 'No balance to compare'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def verify_corpus(paths: List[str],
+                  adapter: BacktesterAdapter,
+                  workers: Optional[int] = None,
+                  tolerances: Optional[Dict[str, float]] = None,
+                  defaultTolerance: float = DefaultTolerance,
+                  failFast: bool = False,
+                  summaryPath: Optional[str] = None,
+                  ) -> Dict[str, Any]:
+    '''
+    使用进程池验证一批测例, 返回汇总结果, 给定 summaryPath 时同时写入 JSON 文件
+    failFast: 出现第一个失败的测例后取消尚未开始的测例
+    '''
+    start = time.perf_counter()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(verify_case, adapter, path, tolerances, defaultTolerance): i
+                   for i, path in enumerate(paths)}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if failFast and not result['ok']:
+                for pending in futures:
+                    pending.cancel()
+                break
+    finished = [x for x in results if x is not None]
+    summary = {
+        'cases': len(paths),
+        'verified': len(finished),
+        'passed': sum(1 for x in finished if x['ok']),
+        'failed': sum(1 for x in finished if not x['ok'] and x['error'] is None),
+        'errors': sum(1 for x in finished if x['error'] is not None),
+        'seconds': time.perf_counter() - start,
+        'caseSeconds': sum(x['seconds'] for x in finished),
+        'results': finished,
+    }
+    if summaryPath is not None:
+        with open(summaryPath, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=4)
+    return summary
+
+def _parse_tolerance(text: str) -> Tuple[str, float]:
+    ccy, value = text.split('=')
+    return ccy, float(value)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Verify a back-test framework against generated test cases')
+    parser.add_argument('paths', nargs='+', help='test cases, or directories containing testcase-* entries')
+    parser.add_argument('--command', default=None,
+                        help='back-test command, {path} and {format} are substituted; checks the references themselves if omitted')
+    parser.add_argument('--timeout', type=float, default=None, help='time limit of each back-test run in seconds')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--tolerance', type=_parse_tolerance, action='append', default=[], metavar='CCY=VALUE',
+                        help='absolute tolerance of a currency, can be repeated')
+    parser.add_argument('--default-tolerance', type=float, default=DefaultTolerance, help='absolute tolerance of other currencies')
+    parser.add_argument('--fail-fast', action='store_true', help='stop after the first failing test case')
+    parser.add_argument('--summary', default=None, help='JSON file for the summary with per-case results and timings')
+    args = parser.parse_args()
+
+    adapter = CommandAdapter(shlex.split(args.command), args.timeout) if args.command else ReferenceAdapter()
+    paths = find_cases(args.paths)
+    summary = verify_corpus(paths, adapter, args.workers, dict(args.tolerance), args.default_tolerance,
+                            args.fail_fast, args.summary)
+    for result in summary['results']:
+        if not result['ok']:
+            reason = result['error'] or str(Divergence(**result['divergence']))
+            print(f"FAIL {result['path']}: {reason}")
+    print(f"{summary['passed']}/{summary['cases']} passed, {summary['failed']} failed, {summary['errors']} errors "
+          f"in {summary['seconds']:.2f}s")
+    if summary['passed'] != summary['cases']:
+        raise SystemExit(1)
+
+def test_verify_case():
+    # 被篡改的测例被报告为不一致; 没有任何输出而挂起的回测系统在超时后被结束
+    import sys
+    import tempfile
+    from benchmark import fixture_factory
+    tc = fixture_factory(2).produce(2, 1000, seed=4)
+    with tempfile.TemporaryDirectory() as d:
+        original, tampered = os.path.join(d, 'testcase-0'), os.path.join(d, 'testcase-1')
+        tc.save(original, 'txt')
+        tc.save(tampered, 'txt')
+        with open(os.path.join(tampered, REFERENCE_FILE), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        row = json.loads(lines[len(lines) // 2])
+        ccy = sorted(row['balance'])[0]
+        row['balance'][ccy] += 1
+        lines[len(lines) // 2] = json.dumps(row) + '\n'
+        with open(os.path.join(tampered, REFERENCE_FILE), 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        
+        assert verify_case(ReferenceAdapter(), tampered)['ok']
+        untampered = CommandAdapter(['cat', os.path.join(original, REFERENCE_FILE)])
+        assert verify_case(untampered, original)['ok']
+        result = verify_case(untampered, tampered)
+        assert not result['ok'] and result['error'] is None
+        assert result['divergence']['ts'] == row['ts'] and result['divergence']['ccy'] == ccy
+        assert result['divergence']['expected'] == row['balance'][ccy]
+        
+        silent = CommandAdapter([sys.executable, '-c', 'import time; time.sleep(60)'], timeout=0.5)
+        result = verify_case(silent, original)
+        assert not result['ok'] and result['error'].startswith('TimeoutError'), result
+        assert result['seconds'] < 10
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import heapq
+import json
+import os
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Any
+from Book import Book
+from instruction import Instruction
+from Balance import BalancesHistory
+
+'''
+以流的形式将测例写入 market.txt, instruction.txt 和 reference.txt
+每个文件的第一行为测例的元信息, 之后每行一个 JSON 对象:
+    market.txt:      {"pair": ..., "ts": ..., "asks": ["price:size", ...], "bids": [...]}, 按时间排序
+    instruction.txt: Instruction.asdict()
+    reference.txt:   {"ts": ..., "balance": {ccy: value, ...}}
+'''
+
+MARKET_FILE = 'market.txt'
+INSTRUCTION_FILE = 'instruction.txt'
+REFERENCE_FILE = 'reference.txt'
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, separators=(',', ':')) + '\n'
+
+class LineWriter:
+    '''
+    逐行写出 JSON 对象, 每积累 bufferLines 行批量写出一次
+    '''
+    def __init__(self, path: str, bufferLines: int = 4096) -> None:
+        self.file = open(path, 'w', encoding='utf-8')
+        self.bufferLines = bufferLines
+        self._buffer: List[str] = []
+
+    def write(self, obj: Any) -> None:
+        self._buffer.append(_dumps(obj))
+        if len(self._buffer) >= self.bufferLines:
+            self.flush()
+
+    def write_many(self, objs: Iterable[Any]) -> None:
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self) -> None:
+        self.file.write(''.join(self._buffer))
+        self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+    def __enter__(self) -> 'LineWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def iter_market(books: Dict[str, Book], skip: Optional[Dict[str, int]] = None) -> Iterator[Dict[str, Any]]:
+    '''
+    按时间顺序合并各个交易对的订单簿切片, 每次只持有每个交易对的一个切片
+    skip: 交易对 -> 跳过的开头切片数量, 用于跳过流式生成时接在前面的上一段的最后一个切片
+    '''
+    skip = skip or {}
+    def rows(pair: str, book: Book) -> Iterator[Tuple[int, str, Dict[str, List[str]]]]:
+        for ts, slice_dict in islice(book.iterdicts(), skip.get(pair, 0), None):
+            yield (ts, pair, slice_dict)
+    streams = [rows(pair, book) for pair, book in sorted(books.items())]
+    for ts, pair, slice_dict in heapq.merge(*streams, key=lambda x: (x[0], x[1])):
+        yield {'pair': pair, 'ts': ts, 'asks': slice_dict['asks'], 'bids': slice_dict['bids']}
+
+def iter_instructions(insts: List[Instruction]) -> Iterator[Dict[str, Any]]:
+    for inst in insts:
+        yield inst.asdict()
+
+def iter_reference(referredBalance: BalancesHistory) -> Iterator[Dict[str, Any]]:
+    for ts, balance in referredBalance.iterdicts():
+        yield {'ts': ts, 'balance': balance}
+
+def write_testcase(path: str,
+                   bt_period: Tuple[int, int],
+                   books: Dict[str, Book],
+                   insts: List[Instruction],
+                   referredBalance: BalancesHistory,
+                   seed: Any = None,
+                   bufferLines: int = 4096,
+                   manifest: Optional[Dict[str, Any]] = None,
+                   ) -> None:
+    '''
+    将测例写入目录 path 下的三个文件
+    manifest: 测例的清单(见 TestFactory.caseManifest), 只写入 market.txt 的文件头
+    '''
+    os.makedirs(path, exist_ok=True)
+    header = {'seed': seed, 'bt_period': list(bt_period), 'pairs': sorted(books)}
+    with LineWriter(os.path.join(path, MARKET_FILE), bufferLines) as w:
+        w.write(dict(header, manifest=manifest) if manifest is not None else header)
+        w.write_many(iter_market(books))
+    with LineWriter(os.path.join(path, INSTRUCTION_FILE), bufferLines) as w:
+        w.write(header)
+        w.write_many(iter_instructions(insts))
+    with LineWriter(os.path.join(path, REFERENCE_FILE), bufferLines) as w:
+        w.write(header)
+        w.write_many(iter_reference(referredBalance))
+
+
+class TextStreamWriter:
+    '''
+    与 write_testcase 相同的目录格式, 但数据流可以分多次写入, 接口与 chunked.ChunkWriter 相同
+    NOTICE: 文件头在创建时写出, 因此 header 必须事先确定
+    '''
+    def __init__(self, path: str, header: Dict[str, Any], bufferLines: int = 4096) -> None:
+        os.makedirs(path, exist_ok=True)
+        manifest = header.get('manifest')
+        header = {key: value for key, value in header.items() if key != 'manifest'}
+        self.writers: Dict[str, LineWriter] = {}
+        for stream, name in (('market', MARKET_FILE), ('insts', INSTRUCTION_FILE), ('reference', REFERENCE_FILE)):
+            self.writers[stream] = LineWriter(os.path.join(path, name), bufferLines)
+            self.writers[stream].write(dict(header, manifest=manifest) if stream == 'market' and manifest is not None else header)
+
+    def write_stream(self, stream: str, rows: Iterable[Dict[str, Any]]) -> None:
+        self.writers[stream].write_many(rows)
+
+    def close(self, header: Optional[Dict[str, Any]] = None) -> None:
+        '''
+        header 只是为了与 ChunkWriter 的接口一致, 文件头已经在创建时写出
+        '''
+        for writer in self.writers.values():
+            writer.close()
+
+
+def test_TextStreamWriter():
+    # 分段流式写出的文件与 to_dir 一次性写出的逐字节相同, 内容与 to_files 的 JSON 一致; 出错时文件被关闭
+    import tempfile
+    from benchmark import fixture_factory
+    def read(path: str) -> Dict[str, bytes]:
+        result = {}
+        for name in (MARKET_FILE, INSTRUCTION_FILE, REFERENCE_FILE):
+            with open(os.path.join(path, name), 'rb') as f:
+                result[name] = f.read()
+        return result
+    tc = fixture_factory(2).produce(3, 1000, seed=4)
+    with tempfile.TemporaryDirectory() as d:
+        whole, streamed = os.path.join(d, 'whole'), os.path.join(d, 'streamed')
+        tc.to_dir(whole)
+        writer = TextStreamWriter(streamed, {'seed': tc.seed, 'bt_period': list(tc.bt_period), 'pairs': sorted(tc.books),
+                                             'manifest': tc.manifest}, bufferLines=7)
+        for stream, rows in (('market', iter_market(tc.books)), ('insts', iter_instructions(tc.insts)),
+                             ('reference', iter_reference(tc.referredBalance))):
+            rows = list(rows)
+            for i in range(0, len(rows), 50):
+                writer.write_stream(stream, rows[i:i+50])
+        writer.close()
+        assert read(streamed) == read(whole)
+
+        baseline = json.loads(json.dumps(tc.asdict()))
+        lines = {name: [json.loads(line) for line in data.decode('utf-8').splitlines()[1:]] 
+                 for name, data in read(whole).items()}
+        assert lines[INSTRUCTION_FILE] == baseline['insts']
+        assert {str(row['ts']): row['balance'] for row in lines[REFERENCE_FILE]} == baseline['referredBalance']
+        for pair, book in baseline['books'].items():
+            assert {str(row['ts']): {'asks': row['asks'], 'bids': row['bids']} 
+                    for row in lines[MARKET_FILE] if row['pair'] == pair} == book['slices']
+
+        # 写出时出错, 已经打开的文件都被关闭
+        opened: List[LineWriter] = []
+        class RecordingWriter(LineWriter):
+            def __init__(self, *args, **kwargs) -> None:
+                super().__init__(*args, **kwargs)
+                opened.append(self)
+        def failing() -> Iterator[Instruction]:
+            yield from tc.insts[:3]
+            raise RuntimeError('disk full')
+        original = LineWriter
+        globals()['LineWriter'] = RecordingWriter
+        try:
+            try:
+                write_testcase(os.path.join(d, 'failed'), tc.bt_period, tc.books, failing(), tc.referredBalance)
+                assert False, "RuntimeError expected"
+            except RuntimeError:
+                pass
+            assert len(opened) == 2 and all(w.file.closed for w in opened)
+            opened.clear()
+            tf = fixture_factory(2)
+            calBalanceHist = tf.calBalanceHist
+            def failingLedger(insts, *args):
+                if insts and insts[0].ts > tc.bt_period[0]: # 第二段
+                    raise RuntimeError('ledger failed')
+                return calBalanceHist(insts, *args)
+            tf.calBalanceHist = failingLedger
+            try:
+                tf.produce_stream(os.path.join(d, 'failed-stream'), 3, 1000, 300, 'txt', seed=4)
+                assert False, "RuntimeError expected"
+            except RuntimeError:
+                pass
+            assert len(opened) == 3 and all(w.file.closed for w in opened)
+        finally:
+            globals()['LineWriter'] = original